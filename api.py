@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+    A library interface to dedup, for use from other python programs:
+
+        from api import Options, analyze
+
+        for result in analyze(['/some/path'], Options(database='cache')):
+            print(result)
+
+    Importing this module is cheap.  The rest of dedup is only imported
+    once analyze() is called.
+"""
+
+from __future__ import annotations
+
+import os
+from types import SimpleNamespace
+
+
+class Options():
+    """The options of an analyze() run.  These are the command line
+    options of dedup.py which affect what is found, with the same
+    names and defaults; sizes may be given as numbers or strings such
+    as '4K'.
+    """
+
+    archives: bool = False
+    adaptive_throttle: bool = False
+    byte_budget: int | str | None = None
+    checkpoint: str | None = None
+    checkpoint_interval: float = 60
+    chunk_index: int | str | None = None
+    compare_groups: int = 3
+    database: str | None = None
+    device_readahead: bool = False
+    device_workers: int = 8
+    gentle_io: bool = False
+    keep_empty_dirs: bool = False
+    keep_empty_files: bool = False
+    max_iops: float | None = None
+    max_read_rate: int | str | None = None
+    min_size: int | str | None = None
+    nuke_database: bool = False
+    resume: bool = False
+    reverse_selection: bool = False
+    rules: str | None = None
+    schedule_io: bool = False
+    stagger_paths: bool = False
+    time_budget: float | None = None
+    verify: bool = False
+    verbosity: int = 0
+
+    # options which take a size:
+    SIZES = ('byte_budget', 'chunk_index', 'max_read_rate', 'min_size')
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            if name not in Options.__annotations__:
+                raise TypeError('unknown option: ' + name)
+            setattr(self, name, value)
+
+    def __repr__(self):
+        changed = ['%s=%r' % (name, getattr(self, name))
+                   for name in Options.__annotations__
+                   if getattr(self, name) != getattr(Options, name)]
+        return 'Options(' + ', '.join(changed) + ')'
+
+    # Options.to_args
+    def to_args(self):
+        """Returns these options in the shape the rest of dedup expects:
+        like the result of parsing the command line.
+        """
+        from report import parse_size
+
+        args = SimpleNamespace(clean_database=False, serve=None,
+                               run_tests=-1, top=None)
+        for name in Options.__annotations__:
+            value = getattr(self, name)
+            if name in Options.SIZES and isinstance(value, str):
+                value = parse_size(value)
+            setattr(args, name, value)
+        return args
+
+
+class Group():
+    """A set of files or directories with identical contents: the one
+    kept (winner), and the pathnames of those marked for deletion.
+    """
+    __slots__ = ('digest', 'winner', 'losers')
+
+    def __init__(self, digest, winner, losers):
+        self.digest = digest
+        self.winner = winner
+        self.losers = losers
+
+    def __repr__(self):
+        return 'Group(%r, %r, %r)' % (self.digest, self.winner, self.losers)
+
+
+class Decision():
+    """A file or directory marked for deletion, and why: 'duplicate'
+    (of winner), 'archive' (every member exists loose, the largest as
+    winner), or 'empty'.
+    """
+    __slots__ = ('pathname', 'kind', 'reason', 'winner', 'bytes')
+
+    def __init__(self, pathname, kind, reason, winner, size):
+        self.pathname = pathname
+        self.kind = kind
+        self.reason = reason
+        self.winner = winner
+        self.bytes = size
+
+    def __repr__(self):
+        return 'Decision(%r, %r, %r, %r, %r)' % (
+            self.pathname, self.kind, self.reason, self.winner, self.bytes)
+
+
+class VerificationError(Exception):
+    """Raised by analyze() with Options(verify=True) when an entry about
+    to be yielded for deletion doesn't match its winner byte for byte.
+    """
+
+    def __init__(self, pathname, winner):
+        Exception.__init__(self, pathname + ' does not match ' + winner)
+        self.pathname = pathname
+        self.winner = winner
+
+
+def decision(entry, reason):
+    """builds the Decision for an entry which was just marked"""
+    from fileobj import FileObj
+
+    winner = None
+    if entry.winner is not None:
+        winner = entry.winner.pathname
+    kind = 'file' if isinstance(entry, FileObj) else 'directory'
+    return Decision(entry.pathname, kind, reason, winner, entry.bytes)
+
+
+def verify(entry, throttle):
+    """--verify for analyze(): byte-compares an entry marked as a
+    duplicate or redundant archive with what it duplicates, raising
+    VerificationError if they differ.
+    """
+    from fileobj import FileObj
+    from compare import verify_dirs, verify_pair
+
+    if isinstance(entry, FileObj):
+        same = verify_pair(entry.winner, entry, throttle)
+    else:
+        same = verify_dirs(entry.winner, entry, throttle)
+    if not same:
+        raise VerificationError(entry.pathname, entry.winner.pathname)
+
+
+def analyze(paths, options=None):
+    """A generator which analyzes a list of paths as dedup.py does, and
+    yields results as soon as they are final: a Group for every set of
+    duplicates as it is resolved, followed by a Decision for each of
+    its losers, and a Decision for every empty file or directory and
+    redundant archive.
+
+    Every file has to be hashed before any duplicates can be known, so
+    the first Group comes once hashing is done; resolving the rest then
+    proceeds as the caller consumes the results.  A winner is never
+    marked for deletion later, and neither is any directory holding
+    one.  A Decision for a directory covers everything within it, some
+    of which may have been decided on already.  With verify, every
+    duplicate and redundant archive is byte-compared with its winner
+    before it is yielded, and VerificationError is raised if they
+    differ.  Nothing is deleted.
+    """
+    from fileobj import FileObj
+    from dirlist import DirList
+    from hashmap import HashMap
+    from hashdbobj import HashDbObj, nuke_database
+
+    if options is None:
+        options = Options()
+    args = options.to_args()
+    devnull = open(os.devnull, 'w')
+    db = None
+    try:
+        if args.database is not None:
+            if args.nuke_database:
+                nuke_database(args.database, devnull)
+            db = HashDbObj(args, devnull)
+        all_files = DirList(paths, db, args)
+
+        # marked while walking and hashing:
+        for _, e in all_files.contents.items():
+            if isinstance(e, FileObj):
+                file_list = [e]
+            else:
+                file_list = [f for dir_entry in e.dirwalk()
+                             for _, f in dir_entry.files.items()]
+            for f in file_list:
+                if f.to_delete and f.archive_copies is None:
+                    yield decision(f, 'empty')
+        for f in all_files.redundant_archives:
+            if args.verify:
+                verify(f, all_files.throttle)
+            yield decision(f, 'archive')
+
+        hm = HashMap(all_files, args, devnull)
+        # directories which started empty are marked as the HashMap is
+        # built:
+        for _, e in all_files.contents.items():
+            if not isinstance(e, FileObj):
+                for dir_entry in e.dirwalk():
+                    if dir_entry.to_delete:
+                        yield decision(dir_entry, 'empty')
+        for hashval, marked in hm.resolve_iter():
+            if hashval is None:
+                for entry in marked:
+                    yield decision(entry, 'empty')
+                continue
+            if args.verify:
+                for entry in marked:
+                    verify(entry, all_files.throttle)
+            yield Group(hashval.decode('utf-8', 'surrogateescape'),
+                        marked[0].winner.pathname,
+                        [entry.pathname for entry in marked])
+            for entry in marked:
+                yield decision(entry, 'duplicate')
+
+        if all_files.checkpoint is not None:
+            all_files.checkpoint.finish()
+    finally:
+        if db is not None:
+            db.close()
+        devnull.close()
+
+# vim: set expandtab sw=4 ts=4:
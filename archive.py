@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module reads the members of zip and tar archives without
+    extracting them, see DirList.expand_archives()
+"""
+
+import io
+import sys
+import hashlib
+import tarfile
+import zipfile
+from fileio import BUF_SIZE, ThrottledFile, read_chunks
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+                '.tar.xz', '.txz')
+
+# what zipfile and tarfile raise for damaged, truncated or encrypted
+# archives:
+ARCHIVE_ERRORS = (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError,
+                  RuntimeError)
+
+
+def is_archive(name):
+    """true if a file name looks like an archive we can look into"""
+    lower = name.lower()
+    return lower.endswith(ZIP_SUFFIXES) or lower.endswith(TAR_SUFFIXES)
+
+
+def member_parts(name):
+    """splits an archive member name into path components, or returns
+    None for names we won't deal with (absolute, or climbing out with
+    '..')
+    """
+    parts = [p for p in name.split('/') if p not in ('', '.')]
+    if len(parts) == 0 or '..' in parts:
+        return None
+    return parts
+
+
+def gentle_flags(args):
+    """returns the (gentle, device_readahead) options of args, if any"""
+    if args is None:
+        return False, False
+    return args.gentle_io, args.device_readahead
+
+
+def open_members(pathname, args=None, throttle=None):
+    """A generator which decompresses an archive front to back, yielding
+    (name, size, stream) for every regular file within.  Each stream is
+    only readable until the next member is yielded.  Links and other
+    special tar members are yielded as (name, None, None), since
+    deleting the archive would lose them.  The archive itself is read
+    through the throttle, and with -g/--gentle-io like any other file.
+    """
+    raw = io.BufferedReader(ThrottledFile(pathname, *gentle_flags(args),
+                                          throttle=throttle), BUF_SIZE)
+    with raw:
+        if pathname.lower().endswith(ZIP_SUFFIXES):
+            with zipfile.ZipFile(raw) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    with zf.open(info) as stream:
+                        yield info.filename, info.file_size, stream
+        else:
+            # "r|*" reads the archive strictly sequentially, so
+            # compressed tarballs are only decompressed once
+            with tarfile.open(fileobj=raw, mode='r|*') as tf:
+                for info in tf:
+                    if info.isfile():
+                        yield info.name, info.size, tf.extractfile(info)
+                    elif not info.isdir():
+                        yield info.name, None, None
+
+
+def stream_digest(stream):
+    """computes the SHA1 hash of a stream, the same way compute_hash()
+    does for files
+    """
+    sha1 = hashlib.sha1()
+    while True:
+        data = stream.read(BUF_SIZE)
+        if not data:
+            break
+        sha1.update(data)
+    return sha1.hexdigest().encode('utf-8')
+
+
+def scan_members(pathname, args=None, throttle=None):
+    """Returns a list of (name, size, hexdigest) for every member of an
+    archive, or None if it isn't a readable archive after all.
+    """
+    try:
+        return [(name, size, stream and stream_digest(stream))
+                for name, size, stream in open_members(pathname, args,
+                                                       throttle)]
+    except ARCHIVE_ERRORS as e:
+        print('WARNING: could not read archive ' + pathname + ': ' +
+              str(e), file=sys.stderr)
+        return None
+
+
+def verify_archive(f, throttle=None):
+    """used by --verify: decompresses archive f again and byte-compares
+    every member with the loose copy it was matched with (see
+    DirList.mark_redundant_archives)
+    """
+    try:
+        for name, size, stream in open_members(f.pathname, f.args,
+                                               throttle):
+            if stream is None:
+                return False
+            parts = member_parts(name)
+            if parts is None:
+                return False
+            loose = f.archive_copies.get('/'.join(parts))
+            if not same_contents(stream, loose, f.args, throttle):
+                return False
+    except ARCHIVE_ERRORS:
+        return False
+    return True
+
+
+def same_contents(stream, loose, args=None, throttle=None):
+    """compares an archive member stream with its loose copy, if any"""
+    if loose is None:
+        # only empty members have no loose copy
+        return stream.read(1) == b''
+    for data in read_chunks(loose.pathname, *gentle_flags(args),
+                            throttle=throttle):
+        if stream.read(len(data)) != data:
+            return False
+    return stream.read(1) == b''
+
+# vim: set expandtab sw=4 ts=4:
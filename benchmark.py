@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Micro-benchmarks for the expensive parts of dedup.  Each benchmark is
+    a subcommand; run with -h for the list.
+"""
+import os
+import sys
+import time
+import json
+import mmap
+import socket
+import random
+import ctypes
+import ctypes.util
+import argparse
+import tempfile
+from argparse import Namespace
+from hashdbobj import compute_hash
+from fileio import advise, FADV_DONTNEED
+from report import sizeof_fmt
+
+
+def make_files(dirname, count, size):
+    """populates dirname with count files of size random bytes each"""
+    pathnames = []
+    for i in range(count):
+        pathname = os.path.join(dirname, 'bench%04d' % i)
+        with open(pathname, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                chunk = min(remaining, 1024 * 1024)
+                f.write(os.urandom(chunk))
+                remaining = remaining - chunk
+        pathnames.append(pathname)
+    return pathnames
+
+
+def cached_pages(pathname):
+    """Returns the number of pages of pathname resident in the page
+    cache, using mincore(2).  Returns None where that isn't available.
+    """
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None or os.path.getsize(pathname) == 0:
+        return None
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    pagesize = mmap.PAGESIZE
+    with open(pathname, 'rb') as f:
+        length = os.fstat(f.fileno()).st_size
+        mm = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_COPY)
+        try:
+            npages = (length + pagesize - 1) // pagesize
+            vec = (ctypes.c_ubyte * npages)()
+            addr = ctypes.addressof(ctypes.c_char.from_buffer(mm))
+            res = libc.mincore(ctypes.c_void_p(addr),
+                               ctypes.c_size_t(length), vec)
+            if res != 0:
+                return None
+            return sum(1 for v in vec if v & 1)
+        finally:
+            mm.close()
+
+
+def drop_cache(pathnames):
+    """asks the kernel to forget the (clean) cached pages of each file"""
+    for pathname in pathnames:
+        fd = os.open(pathname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            advise(fd, 0, 0, FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_io(opts):
+    """hash a set of files with -g/--gentle-io off and on, reporting the
+    throughput and how much of the data stays in the page cache.
+    """
+    workdir = None
+    if opts.paths:
+        pathnames = opts.paths
+    else:
+        workdir = tempfile.TemporaryDirectory(prefix='dedup-bench-')
+        pathnames = make_files(workdir.name, opts.count, opts.size)
+    total_bytes = sum(os.path.getsize(p) for p in pathnames)
+    print('# hashing %d files, %s total' %
+          (len(pathnames), sizeof_fmt(total_bytes)))
+
+    for gentle in (False, True):
+        args = Namespace(gentle_io=gentle,
+                         device_readahead=opts.device_readahead)
+        drop_cache(pathnames)
+        start = time.time()
+        for pathname in pathnames:
+            compute_hash(pathname, args)
+        elapsed = time.time() - start
+        resident = [cached_pages(p) for p in pathnames]
+        if None in resident:
+            footprint = 'n/a'
+        else:
+            footprint = sizeof_fmt(sum(resident) * mmap.PAGESIZE)
+        print('gentle-io %-3s  %10s/s  page cache footprint %s' %
+              ('on' if gentle else 'off',
+               sizeof_fmt(total_bytes / max(elapsed, 1e-9)), footprint))
+
+    if workdir is not None:
+        workdir.cleanup()
+    return 0
+
+
+def bench_query(opts):
+    """fire batches of queries at a running dedup.py --serve, reporting
+    the query rate and per-batch latency.
+    """
+    if opts.paths:
+        digests = [compute_hash(p).decode('utf-8') for p in opts.paths]
+    else:
+        # random digests: measures the (cheaper) cost of a miss
+        digests = ['%040x' % random.getrandbits(160) for _ in range(1000)]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(opts.socket)
+    reader = sock.makefile('rb')
+
+    latencies = []
+    found = 0
+    sent = 0
+    start = time.perf_counter()
+    while sent < opts.queries:
+        batch = [{'digest': random.choice(digests)}
+                 for _ in range(min(opts.batch, opts.queries - sent))]
+        request = json.dumps(batch).encode('utf-8') + b'\n'
+        sent_at = time.perf_counter()
+        sock.sendall(request)
+        results = json.loads(reader.readline())
+        latencies.append(time.perf_counter() - sent_at)
+        found = found + sum(1 for r in results if r.get('found'))
+        sent = sent + len(batch)
+    elapsed = time.perf_counter() - start
+    reader.close()
+    sock.close()
+
+    latencies.sort()
+    print('# %d queries in batches of %d, %d found' %
+          (sent, opts.batch, found))
+    print('%10.0f queries/s  batch latency p50 %.3f ms  p99 %.3f ms' %
+          (sent / max(elapsed, 1e-9),
+           latencies[len(latencies) // 2] * 1000,
+           latencies[int(len(latencies) * 0.99)] * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    io_parser = subparsers.add_parser('io', help=bench_io.__doc__)
+    io_parser.add_argument('--count', type=int, default=16,
+                           help='number of files to generate')
+    io_parser.add_argument('--size', type=int, default=16 * 1024 * 1024,
+                           help='size of each generated file, in bytes')
+    io_parser.add_argument('--device-readahead', action='store_true',
+                           help='size readahead windows per device')
+    io_parser.add_argument('paths', nargs='*',
+                           help='hash these files instead of generated ones')
+    io_parser.set_defaults(func=bench_io)
+
+    query_parser = subparsers.add_parser('query', help=bench_query.__doc__)
+    query_parser.add_argument('--socket', required=True,
+                              help='socket given to dedup.py --serve')
+    query_parser.add_argument('--queries', type=int, default=100000,
+                              help='total number of queries to send')
+    query_parser.add_argument('--batch', type=int, default=1,
+                              help='queries per request')
+    query_parser.add_argument('paths', nargs='*',
+                              help='query the digests of these files instead of random ones')
+    query_parser.set_defaults(func=bench_query)
+
+    opts = parser.parse_args()
+    sys.exit(opts.func(opts))
+
+# vim: set expandtab sw=4 ts=4:
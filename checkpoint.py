@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module describes the Checkpoint object, which lets a long scan
+    be resumed after a crash.
+"""
+
+import os
+import sys
+import time
+import pickle
+import threading
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+# bump this whenever the layout of the saved state changes:
+CHECKPOINT_VERSION = 3
+
+# options which change what the walk produces.  A checkpoint taken with
+# different values can't be resumed.
+WALK_OPTIONS = ['archives', 'chunk_index', 'keep_empty_files', 'min_size',
+                'rules', 'stagger_paths']
+
+
+def pickled_subtree(dir_entry):
+    """pickles a directory tree hanging off a parent, without the
+    parent (and so, the rest of the tree)
+    """
+    parent = dir_entry.parent
+    dir_entry.parent = None
+    try:
+        return pickle.dumps(dir_entry, pickle.HIGHEST_PROTOCOL)
+    finally:
+        dir_entry.parent = parent
+
+
+class Checkpoint():
+    """Periodically saves the progress of a scan to --checkpoint: the
+    trees of the paths already walked, the subdirectories completely
+    walked within the path being walked, and every digest computed so
+    far.
+
+    Saves are pickled to a temporary file which is fsync'd and then
+    atomically renamed over the previous checkpoint, so a crash at any
+    point leaves either the old or the new checkpoint intact.  Digests
+    are saved at most every --checkpoint-interval seconds, which bounds
+    the overhead; the number of saves and time spent are kept for the
+    report.
+    """
+
+    def __init__(self, args, paths):
+        self.args = args
+        self.filename = args.checkpoint
+        self.interval = args.checkpoint_interval
+        self.paths = list(paths)
+        self.options = [getattr(args, o) for o in WALK_OPTIONS]
+        # raw argument path -> (key in DirList.contents, pickled tree,
+        #                       stagger after walking it)
+        self.walked = {}
+        # raw argument path -> {pathname: DirObj} of the subdirectories
+        # walked so far, only the outermost of those nested
+        self.subtrees = {}
+        # the same, pickled, as saved by an interrupted run and not
+        # restored yet
+        self.saved_subtrees = {}
+        # pathname -> (bytes, mod_time, hexdigest)
+        self.digests = {}
+        self.last_save = time.monotonic()
+        self.saves = 0
+        self.save_time = 0.0
+        self.lock = threading.Lock()
+        if args.resume:
+            self.load()
+
+    # Checkpoint.from_args
+    @staticmethod
+    def from_args(args, paths):
+        """Returns a Checkpoint if --checkpoint was given, else None"""
+        if args.checkpoint is None:
+            if args.resume:
+                print('\nFATAL: --resume needs a --checkpoint file',
+                      file=sys.stderr)
+                sys.exit(-1)
+            return None
+        return Checkpoint(args, paths)
+
+    # Checkpoint.load
+    def load(self):
+        """Loads the state saved by a previous run of the same scan"""
+        try:
+            with open(self.filename, 'rb') as f:
+                state = pickle.load(f)
+        except OSError:
+            print('# no checkpoint at ' + self.filename +
+                  ', starting from scratch', file=sys.stderr)
+            return
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, IndexError, TypeError, ValueError):
+            state = None
+        try:
+            same_scan = (state['version'] == CHECKPOINT_VERSION
+                         and state['paths'] == self.paths
+                         and state['options'] == self.options)
+            walked = dict(state['walked'])
+            saved_subtrees = dict((path, dict(subtrees)) for path, subtrees
+                                  in state['walked_subtrees'].items())
+            digests = dict(state['digests'])
+        except (KeyError, TypeError, ValueError):
+            print('\nFATAL: ' + self.filename +
+                  ' is not a usable checkpoint', file=sys.stderr)
+            sys.exit(-1)
+        if not same_scan:
+            print('\nFATAL: ' + self.filename +
+                  ' was saved by a different scan', file=sys.stderr)
+            sys.exit(-1)
+        self.walked = walked
+        self.saved_subtrees = saved_subtrees
+        self.digests = digests
+        print('# resuming from ' + self.filename + ': ' +
+              str(len(self.walked)) + ' paths walked, ' +
+              str(sum(len(x) for x in saved_subtrees.values())) +
+              ' subdirectories walked, ' +
+              str(len(self.digests)) + ' digests', file=sys.stderr)
+
+    # Checkpoint.save
+    def save(self):
+        """Crash-safely writes the current state to the checkpoint"""
+        started = time.monotonic()
+        walked_subtrees = {}
+        for path, subtrees in self.saved_subtrees.items():
+            walked_subtrees[path] = dict(subtrees)
+        for path, subtrees in self.subtrees.items():
+            for pathname, dir_entry in subtrees.items():
+                walked_subtrees.setdefault(path, {})[pathname] = \
+                    pickled_subtree(dir_entry)
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'paths': self.paths,
+            'options': self.options,
+            'walked': self.walked,
+            'walked_subtrees': walked_subtrees,
+            'digests': self.digests}
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        # make the rename itself durable:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.filename)),
+                         os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.last_save = time.monotonic()
+        self.saves = self.saves + 1
+        self.save_time = self.save_time + (self.last_save - started)
+
+    # Checkpoint.restore
+    def restore(self, path):
+        """Returns (key, tree, stagger) for an argument path which was
+        completely walked before, or None.
+        """
+        if path not in self.walked:
+            return None
+        key, tree, stagger = self.walked[path]
+        return key, pickle.loads(tree), stagger
+
+    # Checkpoint.restore_subtree
+    def restore_subtree(self, path, pathname):
+        """Returns the tree of directory pathname, within argument path,
+        if it was completely walked before, or None.  The tree has no
+        parent yet.
+        """
+        tree = self.saved_subtrees.get(path, {}).pop(pathname, None)
+        if tree is None:
+            return None
+        return pickle.loads(tree)
+
+    # Checkpoint.subtree_done
+    def subtree_done(self, path, dir_entry):
+        """records that a directory within argument path has been
+        completely walked, saving the checkpoint if one is due
+        """
+        subtrees = self.subtrees.setdefault(path, {})
+        # it holds any of its subdirectories recorded before
+        for _, sub_entry in dir_entry.subdirs.items():
+            subtrees.pop(sub_entry.pathname, None)
+        subtrees[dir_entry.pathname] = dir_entry
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    # Checkpoint.walk_done
+    def walk_done(self, path, key, tree, stagger):
+        """records that an argument path has been completely walked"""
+        self.walked[path] = (key,
+                             pickle.dumps(tree, pickle.HIGHEST_PROTOCOL),
+                             stagger)
+        self.subtrees.pop(path, None)
+        self.saved_subtrees.pop(path, None)
+        self.save()
+
+    # Checkpoint.cached_hash
+    def cached_hash(self, f):
+        """returns the digest saved for this file, if it hasn't changed"""
+        saved = self.digests.get(f.pathname)
+        if saved is not None and saved[0] == f.bytes and saved[1] == f.mod_time:
+            return saved[2]
+        return None
+
+    # Checkpoint.hashed
+    def hashed(self, f):
+        """records a new digest, saving the checkpoint if one is due.
+        May be called from several threads at once.
+        """
+        with self.lock:
+            self.digests[f.pathname] = (f.bytes, f.mod_time, f.hexdigest)
+            if time.monotonic() - self.last_save >= self.interval:
+                self.save()
+
+    # Checkpoint.finish
+    def finish(self):
+        """the scan completed, so the checkpoint is no longer needed"""
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+# vim: set expandtab sw=4 ts=4:
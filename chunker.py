@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module splits large files into content-defined chunks, and
+    describes the ChunkIndex which finds files sharing many of them.
+"""
+
+import random
+import hashlib
+from collections import defaultdict
+from fileio import read_chunks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+# the gear table: a fixed pseudo-random 32 bit value for every byte.
+# Changing the seed changes every chunk boundary (and so invalidates
+# every cached chunk list).
+_gear_random = random.Random(0x6765617221)
+GEAR = [_gear_random.getrandbits(32) for _ in range(256)]
+
+if numpy is not None:
+    GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32)
+
+# the gear hash only "sees" the last 32 bytes.  A chunk ends wherever the
+# top MASK_BITS bits of the hash are all zero, so chunks average about
+# MIN_CHUNK + 2 ** MASK_BITS bytes.
+MASK_BITS = 20
+MASK = ((1 << MASK_BITS) - 1) << (32 - MASK_BITS)
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+
+# how much to read (and, with numpy, hash) at once:
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# chunks found in more files than this (runs of zeros, common headers)
+# say little about how similar two files are, and would make the index
+# quadratic, so they are left out of it:
+MAX_POSTINGS = 64
+
+# pairs of files sharing at least this fraction of the larger one are
+# reported:
+PARTIAL_RATIO = 0.5
+
+
+def boundaries_numpy(window, skip):
+    """Returns the offsets within window (after the first skip bytes)
+    at which the gear hash selects a chunk boundary.
+
+    The gear hash after byte i is sum(GEAR[window[i - k]] << k) for k
+    in 0..31 (modulo 2**32), so rather than rolling it one byte at a
+    time it is built for the whole window at once by doubling: sums of
+    1, 2, 4, 8, 16 and then 32 bytes, each from two shifted halves.
+    The first 31 bytes of the window are carried over from the previous
+    block, so every hash after them is complete.
+    """
+    h = numpy.take(GEAR_ARRAY, numpy.frombuffer(window, dtype=numpy.uint8))
+    span = 1
+    while span < 32:
+        # numpy buffers the overlapping operands, so this reads the
+        # sums of the previous round
+        h[span:] += h[:-span] << numpy.uint32(span)
+        span = span * 2
+    hits = numpy.flatnonzero((h[skip:] & numpy.uint32(MASK)) == 0)
+    return (hits + skip).tolist()
+
+
+def boundaries_python(block, state):
+    """Like boundaries_numpy(), one byte at a time.  state is a one
+    element list carrying the hash from block to block.
+    """
+    hits = []
+    h = state[0]
+    for i, b in enumerate(block):
+        h = ((h << 1) + GEAR[b]) & 0xFFFFFFFF
+        if not h & MASK:
+            hits.append(i)
+    state[0] = h
+    return hits
+
+
+def chunk_file(pathname, args=None, throttle=None):
+    """Reads a file once, returning its SHA1 hash (as compute_hash()
+    does) and a list of (length, digest) for each of its chunks.
+
+    A boundary follows any byte where the gear hash matches MASK, as
+    long as the chunk is at least MIN_CHUNK long; a chunk reaching
+    MAX_CHUNK is cut regardless.  Boundaries only depend on the 32 bytes
+    before them, so an insertion or deletion only changes the chunks
+    around it, and files that differ in a few places share most chunks.
+    """
+    gentle = False
+    device_readahead = False
+    if args is not None:
+        gentle = args.gentle_io
+        device_readahead = args.device_readahead
+
+    whole = hashlib.sha1()
+    chunks = []
+    chunk = hashlib.sha1()
+    chunk_start = 0
+    block_start = 0
+    carry = b''
+    state = [0]
+    for block in read_chunks(pathname, gentle, device_readahead, throttle,
+                             size=BLOCK_SIZE):
+        whole.update(block)
+        if numpy is not None:
+            hits = [block_start + i - len(carry) + 1
+                    for i in boundaries_numpy(carry + block, len(carry))]
+            carry = (carry + block)[-31:]
+        else:
+            hits = [block_start + i + 1
+                    for i in boundaries_python(block, state)]
+        block_end = block_start + len(block)
+        # what of this block has been added to a chunk digest yet:
+        fed = block_start
+        for cut in hits + [None]:
+            while ((cut is None or cut - chunk_start > MAX_CHUNK)
+                   and chunk_start + MAX_CHUNK <= block_end):
+                forced = chunk_start + MAX_CHUNK
+                chunk.update(block[fed - block_start:forced - block_start])
+                chunks.append((MAX_CHUNK, chunk.digest()))
+                chunk = hashlib.sha1()
+                chunk_start = fed = forced
+            if cut is not None and cut - chunk_start >= MIN_CHUNK:
+                chunk.update(block[fed - block_start:cut - block_start])
+                chunks.append((cut - chunk_start, chunk.digest()))
+                chunk = hashlib.sha1()
+                chunk_start = fed = cut
+        chunk.update(block[fed - block_start:])
+        block_start = block_end
+    if block_start > chunk_start:
+        chunks.append((block_start - chunk_start, chunk.digest()))
+    return whole.hexdigest().encode('utf-8'), chunks
+
+
+class ChunkIndex():
+    """An inverted index from chunk digests to the files containing
+    them.  Overlapping files are found by looking up each file's chunks,
+    so only files which actually share something are ever compared.
+    """
+
+    def __init__(self):
+        # chunk digest -> list of indexes into self.files
+        self.postings = defaultdict(lambda: [])
+        self.files = []
+
+    # ChunkIndex.add
+    def add(self, f):
+        """indexes a file with a list of chunks"""
+        for digest in set(digest for _, digest in f.chunks):
+            self.postings[digest].append(len(self.files))
+        self.files.append(f)
+
+    # ChunkIndex.pairs
+    def pairs(self, min_ratio=PARTIAL_RATIO):
+        """Returns (shared bytes, file, file) for every pair of files
+        sharing at least min_ratio of the larger one, most shared bytes
+        first.  Files with identical contents are not pairs.
+        """
+        pairs = []
+        for index, f in enumerate(self.files):
+            shared = defaultdict(lambda: 0)
+            seen = set()
+            for length, digest in f.chunks:
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                postings = self.postings[digest]
+                if len(postings) > MAX_POSTINGS:
+                    continue
+                for other in postings:
+                    # each pair is counted from its first file only
+                    if other > index:
+                        shared[other] = shared[other] + length
+            for other, shared_bytes in shared.items():
+                g = self.files[other]
+                if f.hexdigest == g.hexdigest:
+                    continue
+                if shared_bytes >= min_ratio * max(f.bytes, g.bytes):
+                    pairs.append((shared_bytes, f, g))
+        pairs.sort(key=lambda x: x[0], reverse=True)
+        return pairs
+
+# vim: set expandtab sw=4 ts=4:
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module holds the byte-by-byte comparison engine, used instead of
+    hashing for small groups of same-sized files, and for --verify.
+"""
+
+import sys
+from collections import defaultdict
+from fileio import read_chunks
+from archive import verify_archive
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+# how much of each candidate to read per comparison step:
+COMPARE_CHUNK = 1024 * 1024
+
+
+def partition_identical(files, args=None, throttle=None):
+    """Splits a list of same-sized FileObjs into groups of files with
+    identical contents.
+
+    All candidates are read in lockstep, one large chunk at a time.  As
+    soon as the contents of a group diverge it is split, and any file
+    left on its own is closed and not read any further.  So a group of
+    files which differ in their first chunk costs a single chunk each,
+    rather than a full hash of every byte.
+    """
+    gentle = False
+    device_readahead = False
+    if args is not None:
+        gentle = args.gentle_io
+        device_readahead = args.device_readahead
+
+    readers = {}
+    for f in files:
+        readers[f.pathname] = read_chunks(f.pathname, gentle,
+                                          device_readahead, throttle,
+                                          COMPARE_CHUNK)
+    finished = []
+    active = [files]
+    try:
+        while len(active) > 0:
+            next_active = []
+            for group in active:
+                if len(group) == 1:
+                    finished.append(group)
+                    continue
+                by_chunk = defaultdict(lambda: [])
+                for f in group:
+                    by_chunk[next(readers[f.pathname], b'')].append(f)
+                for chunk, subgroup in by_chunk.items():
+                    if len(chunk) == 0 or len(subgroup) == 1:
+                        # identical to the end, or unique: either way
+                        # we are done reading these.
+                        finished.append(subgroup)
+                    else:
+                        next_active.append(subgroup)
+            active = next_active
+    finally:
+        for reader in readers.values():
+            reader.close()
+    return finished
+
+
+def verify_files(winner, loser, throttle=None):
+    """Byte-compares a loser file with its winner before we commit to
+    deleting it.
+    """
+    if winner.bytes != loser.bytes:
+        return False
+    return len(partition_identical([winner, loser], loser.args,
+                                   throttle)) == 1
+
+
+def dir_pairs(winner, loser):
+    """Pairs every non-empty file under a loser directory with the file
+    it duplicates: its own winner, if it was resolved by itself, or
+    else a file under the winner directory with the same hash.  Returns
+    None if there is no such file for one of them.  (Redundant archives
+    are paired with their winner too, see verify_pair().)
+    """
+    kept = {}
+    for dir_entry in winner.dirwalk():
+        for _, f in dir_entry.files.items():
+            kept.setdefault(f.hexdigest, f)
+    pairs = []
+    for dir_entry in loser.dirwalk():
+        for _, f in dir_entry.files.items():
+            if f.winner is not None:
+                pairs.append((f.winner, f))
+            elif f.bytes == 0:
+                continue
+            elif f.hexdigest in kept:
+                pairs.append((kept[f.hexdigest], f))
+            else:
+                return None
+    return pairs
+
+
+def verify_dirs(winner, loser, throttle=None):
+    """Byte-compares a loser directory with its winner, file by file,
+    see dir_pairs()
+    """
+    pairs = dir_pairs(winner, loser)
+    if pairs is None:
+        return False
+    for kept, f in pairs:
+        if not verify_pair(kept, f, throttle):
+            return False
+    return True
+
+
+def verify_pair(winner, loser, throttle=None):
+    """verifies a file marked for deletion: a redundant archive against
+    the loose copies of its members, anything else against its winner
+    """
+    if loser.archive_copies is not None:
+        return verify_archive(loser, throttle)
+    return verify_files(winner, loser, throttle)
+
+
+def verification_failed(winner, loser):
+    """used by --verify, bail out before any output is written if a
+    loser isn't really a copy of its winner.
+    """
+    print('\nFATAL: --verify found that ' + loser.pathname +
+          ' does not match ' + winner.pathname, file=sys.stderr)
+    sys.exit(-1)
+
+# vim: set expandtab sw=4 ts=4:
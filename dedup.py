@@ -7,115 +7,14 @@
 import os
 import sys
 import time
-import shutil
 import argparse
-from json import loads
 from hashmap import HashMap
 from dirlist import DirList
-from hashdbobj import HashDbObj
-from report import generate_reports
-
-
-def run_test(args, parser, test_name, start_time):
-    """
-    executes a single test via several steps:
-        1. remove cruft from previous executions.
-        2. duplicate a "before" dir into a temporary dir called "ephemeral".
-        3. analyze "ephemeral" and produce "ephemeral.sh".
-        4. run "ephemeral.sh" (which deletes files from "ephemeral").
-        5. compare "ephemeral" dir to the "after" dir, expecting no difference.
-    """
-    print('Running test ' + test_name + ': ', end="")
-    ephemeral_dir = 'ephemeral'
-    before_dir = 'before'
-    after_dir = 'after'
-    test_config_filename = 'opts.json'
-    script_filename = 'ephemeral.sh'
-    scriptfile = open(script_filename, "w+")
-
-    # unconditonally remove the ephemeral_dir
-    shutil.rmtree(ephemeral_dir, ignore_errors=True)
-
-    # create the ephemeral_dir based on the before_dir
-    shutil.copytree(before_dir, ephemeral_dir, symlinks=False, ignore=None)
-
-    # pull arguments out of tests/${test_name}/opts.json, if they exist
-    test_args = []
-    expected_pass = 0
-    test_paths = [ephemeral_dir]
-    twice = False
-    runs = 1
-
-    try:
-        opts = loads(open(test_config_filename).read())
-    except OSError:
-        opts = {}
-
-    if "args" in opts:
-        test_args = opts["args"]
-    if "paths" in opts:
-        test_paths = opts["paths"]
-    if "twice" in opts and opts["twice"]:
-        runs = 2
-    if "expected_pass" in opts:
-        expected_pass = opts["expected_pass"]
-
-    # prepare arguments
-    args = parser.parse_args(test_args)
-
-    # run as many times as requested:
-    for i in range(1, runs+1):
-        print("# run number " + str(i), file=scriptfile)
-        results = analyze(args, test_paths, scriptfile)
-        if results is None:
-            if expected_pass:
-                print("FAILED (failed analyze")
-                return -1
-            print("PASSED")
-            return 0
-
-    generate_reports(results, scriptfile, start_time)
-    scriptfile.close()
-    # run the generated script to delete from the ephemeral dir
-    exec_result = os.system('sh ' + script_filename)
-    if exec_result != 0:
-        print('FAILED (script fail')
-        return -1
-
-    # compare tests/${test_name}/test with tests/${test_name}/after
-    test_result = os.system("diff --recursive --brief \"" +
-                            ephemeral_dir + "\" \"" + after_dir + "\"")
-    if test_result == 0:
-        print('PASSED')
-        return 0
-    print('FAILED (unexpected results)')
-    return -1
-
-
-def run_tests(args, parser, start_time):
-    """
-    run all the requested test cases, each described as a dir under "tests"
-    """
-    g = os.walk('tests')
-    _, test_list, _ = next(g)
-
-    # filter to just the requested test(s)
-    # this will be '00' if all tests are requested.
-    requested_test = ('%02d' % int(args.run_tests))
-    if requested_test != '00':
-        test_list = [x for x in test_list if x[:2] == requested_test]
-    else:
-        test_list.sort()
-
-    # run the requested test(s):
-    for test_name in test_list:
-        if test_name[:2] == requested_test or requested_test == '00':
-            newpwd = 'tests' + os.path.sep + test_name + os.path.sep
-            os.chdir(newpwd)
-            if -1 == run_test(args, parser, test_name, start_time):
-                return -1
-            os.chdir('../..')
-    return 0
+from hashdbobj import HashDbObj, clean_database, nuke_database
+from report import generate_reports, parse_size
+from server import serve
+from fixtures import run_fixtures
+from linker import LINK_MODES, link_redundant
 
 
 def analyze(args, paths, outfile=sys.stdout):
@@ -131,6 +30,8 @@ def analyze(args, paths, outfile=sys.stdout):
 
     db = None
     if args.database is not None:
+        if args.nuke_database:
+            nuke_database(args.database, outfile)
         db = HashDbObj(args, outfile)
 
     if len(paths) > 0:
@@ -138,22 +39,25 @@ def analyze(args, paths, outfile=sys.stdout):
 
         hm = HashMap(all_files, args, outfile)
 
-        # find and mark redundant files for deletion
-        deleted = hm.resolve()
-        # find and mark redundant empty directories for deletion
-        deleted = deleted + all_files.prune_empty()
+        # find and mark redundant files, and the directories left
+        # empty by them, for deletion
+        deleted = hm.resolve() + len(all_files.redundant_archives)
+        all_files.hash_map = hm
 
         print('# ' + str(deleted) + ' entries marked for deletion',
               file=outfile)
 
+        if all_files.checkpoint is not None:
+            all_files.checkpoint.finish()
+
         if db is not None:
             db.close()
         return all_files
     return None
 
 
-if __name__ == '__main__':
-    start_time = time.time()
+def build_parser():
+    """the command line parser, shared with the test harness"""
     desc = "generate commands to eliminate redundant files and directories"
     afterword = """
 Simplest Example:
@@ -169,31 +73,93 @@ Simplest Example:
     parser = argparse.ArgumentParser(description=desc,
                                      epilog=afterword,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-a", "--archives", action="store_true",
+                        help="look inside zip and tar files, and remove those whose contents all exist elsewhere")
+    parser.add_argument("--byte-budget", type=parse_size,
+                        help="stop hashing or comparing after reading this much (e.g. 500G)")
+    parser.add_argument("--checkpoint",
+                        help="periodically save scan progress to this file")
+    parser.add_argument("--checkpoint-interval", type=float, default=60, metavar="SECONDS",
+                        help="save --checkpoint at most this often (default 60)")
+    parser.add_argument("--chunk-index", type=parse_size, metavar="MIN_SIZE",
+                        help="split files of at least MIN_SIZE into chunks and report pairs sharing most of them (e.g. 1G)")
+    parser.add_argument("-c", "--clean-database", action="store_true",
+                        help="clean hash cache instead of normal operation")
+    parser.add_argument("--compare-groups", type=int, default=3, metavar="N",
+                        help="byte-compare groups of up to N same-sized files instead of hashing them (0 to always hash)")
     parser.add_argument("-d", "--database",
                         help="name of DBM file to use for hash cache")
+    parser.add_argument("--adaptive-throttle", action="store_true",
+                        help="back off further while read latency is elevated")
     parser.add_argument("-e", "--keep-empty-dirs", action="store_true",
                         help="do not delete empty directories (default to false)")
     parser.add_argument("-f", "--keep-empty-files", action="store_true",
                         help="do not delete empty files (default to false)")
+    parser.add_argument("-g", "--gentle-io", action="store_true",
+                        help="hash without updating atimes or evicting the page cache")
+    parser.add_argument("--device-workers", type=int, default=8, metavar="N",
+                        help="with -o/--schedule-io, allow up to N files to be read at once per device, where that is measured to be faster (default 8, 1 turns the tuning off)")
+    parser.add_argument("--device-readahead", action="store_true",
+                        help="size -g/--gentle-io readahead windows per device")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), metavar="N",
+                        help="with -t/--run-tests, run N tests at once (default: one per CPU)")
+    parser.add_argument("-l", "--link-mode", choices=LINK_MODES,
+                        help="replace redundant files with hard links or reflinks to the copy kept, right away, instead of generating a script")
+    parser.add_argument("--max-iops", type=float,
+                        help="limit files opened/stat'd per second")
+    parser.add_argument("--max-read-rate", type=parse_size,
+                        help="limit bytes read per second (e.g. 50M)")
+    parser.add_argument("--min-size", type=parse_size,
+                        help="do not hash or delete non-empty files smaller than this, nor the directories holding them (e.g. 4K)")
+    parser.add_argument("-n", "--nuke-database", action="store_true",
+                        help="delete the provided cache before starting")
+    parser.add_argument("-o", "--schedule-io", action="store_true",
+                        help="hash files in on-disk order, one reader per device")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted scan from its --checkpoint")
     parser.add_argument("-r", "--reverse-selection", action="store_true",
                         help="reverse the dir/file selection choices")
+    parser.add_argument("--rules",
+                        help="JSON file of rules to ignore, exclude or protect entries")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="answer duplicate queries on this unix socket instead of generating a script")
     parser.add_argument("-s", "--stagger-paths", action="store_true",
                         help="always prefer files in argument order")
     parser.add_argument("-t", "--run-tests", nargs='?', const=0, default=-1, type=int,
                         help="run selected test from 'test' subdir. -t alone runs all tests and ignores all other args")
     parser.add_argument('--foo', )
+    parser.add_argument("--test-scale", type=int, default=200, metavar="N",
+                        help="with -t/--run-tests, also run each test alongside N generated files (default 200, 0 to skip)")
+    parser.add_argument("--top", type=int, metavar="N",
+                        help="only summarize the N biggest savings of each section, without commands")
+    parser.add_argument("--time-budget", type=float, metavar="SECONDS",
+                        help="stop hashing this many seconds after the scan starts")
+    parser.add_argument("--verify", action="store_true",
+                        help="byte-compare every file marked for deletion with the one kept")
     parser.add_argument("-v", "--verbosity", action="count", default=0,
                         help="increase output verbosity")
+    return parser
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    parser = build_parser()
     args, paths = parser.parse_known_args()
 
     # if args.run_tests is -1, we do not run tests
-    if args.run_tests == -1:
+    if args.clean_database and args.run_tests == -1:
+        sys.exit(clean_database(args))
+    elif args.serve is not None and args.run_tests == -1:
+        sys.exit(serve(args, paths))
+    elif args.run_tests == -1:
         res = analyze(args, paths)
         if res is None:
             sys.exit(-1)
+        elif args.link_mode is not None:
+            sys.exit(link_redundant(res, sys.stdout, start_time))
         else:
             generate_reports(res, sys.stdout, start_time)
     else:
-        sys.exit(run_tests(args, parser, start_time))
+        sys.exit(run_fixtures(args))
 
 # vim: set expandtab sw=4 ts=4:
@@ -6,8 +6,20 @@
 import os
 import sys
 import stat
+import time
+import threading
+from collections import defaultdict
 from fileobj import FileObj
-from dirobj import DirObj, DELETE_DIR_LIST
+from dirobj import DirObj, DELETE_DIR_LIST, DO_NOT_DELETE_LIST
+from hashdbobj import compute_hash
+from scheduler import HashScheduler
+from compare import partition_identical, dir_pairs, verify_pair, \
+    verification_failed
+from throttle import Throttle
+from rules import RuleSet
+from checkpoint import Checkpoint
+from archive import is_archive, member_parts, scan_members
+from chunker import chunk_file
 
 # This list represents files that may linger in directories preventing
 # this algorithm from recognizing them as empty.  we mark them as
@@ -26,6 +38,16 @@ DELETE_FILE_LIST = [
     ".dropbox.attr",
     ".typeAttributes.dict"]
 
+# The lists above (and DO_NOT_DELETE_LIST) are the built-in rules, which
+# --rules can add to:
+DEFAULT_RULES = (
+    [{'action': 'ignore', 'type': 'dir', 'name': name}
+     for name in DELETE_DIR_LIST] +
+    [{'action': 'ignore', 'type': 'file', 'name': name}
+     for name in DELETE_FILE_LIST] +
+    [{'action': 'protect', 'name': name}
+     for name in DO_NOT_DELETE_LIST])
+
 
 def issocket(path):
     """For some reason python provides isfile and isdirectory but not
@@ -70,11 +92,135 @@ class DirList:
         self.db = db
         self.args = args
         self.stagger = 0
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        # files left unhashed by --time-budget/--byte-budget
+        self.unverified = []
+        self.throttle = Throttle.from_args(args)
+        self.rules = RuleSet.from_args(args, DEFAULT_RULES)
+        self.checkpoint = Checkpoint.from_args(args, paths)
+        # files found by walk() which still need a hash
+        self.pending = []
+        # with -o/--schedule-io, hashing is done by a HashScheduler which
+        # keeps its per-device concurrency for the whole run
+        self.scheduler = None
+        if args.schedule_io:
+            self.scheduler = HashScheduler(args, self.throttle,
+                                           self.file_hashed, self.hash_file)
+        # with -a/--archives, the archives we looked into, and the sizes
+        # of all their members
+        self.archives = []
+        self.member_sizes = set()
+        # ...and those marked for deletion
+        self.redundant_archives = []
+        # with --chunk-index, the files which were split into chunks
+        self.chunked = []
+        # the HashMap which resolved these files, which the report
+        # looks losers up in (see dedup.analyze())
+        self.hash_map = None
         for path in paths:
-            self.walk(path)
+            if self.checkpoint is None:
+                self.walk(path)
+                continue
+            restored = self.checkpoint.restore(path)
+            if restored is not None:
+                self.restore(*restored)
+                continue
+            key = self.walk(path)
+            if key is not None:
+                self.checkpoint.walk_done(path, key, self.contents[key],
+                                          self.stagger)
+        self.hash_pending()
+        if self.args.archives:
+            self.mark_redundant_archives()
+
+    # DirList.restore
+    def restore(self, key, entry, stagger):
+        """Adds a tree walked by a previous (interrupted) run, as saved
+        by Checkpoint.walk_done()
+        """
+        self.stagger = stagger
+        if isinstance(entry, FileObj):
+            entry.args = self.args
+            if self.recheck(entry):
+                self.contents[key] = entry
+                self.pending.append(entry)
+            return
+        self.contents[key] = entry
+        self.restore_tree(entry)
+
+    # DirList.restore_tree
+    def restore_tree(self, entry):
+        """Picks up the files of a restored directory tree, dropping
+        those which are gone, see recheck()
+        """
+        for dir_entry in entry.dirwalk():
+            dir_entry.args = self.args
+            for name, f in list(dir_entry.files.items()):
+                f.args = self.args
+                if not self.recheck(f):
+                    del dir_entry.files[name]
+                    continue
+                self.pending.append(f)
+
+    # DirList.restore_subtree
+    def restore_subtree(self, path, dir_entry, sub_name):
+        """Hangs the tree of subdirectory sub_name, walked by a previous
+        (interrupted) run, off dir_entry.  Returns False if there is
+        none, and the subdirectory has to be walked.
+        """
+        sub_entry = self.checkpoint.restore_subtree(
+            path, os.path.join(dir_entry.pathname, sub_name))
+        if sub_entry is None:
+            return False
+        sub_entry.parent = dir_entry
+        dir_entry.subdirs[sub_name] = sub_entry
+        self.restore_tree(sub_entry)
+        self.checkpoint.subtree_done(path, sub_entry)
+        return True
+
+    # DirList.subtrees_done
+    def subtrees_done(self, path, open_dirs, dir_entry):
+        """Called as os.walk() gets to dir_entry: it is done with every
+        directory on open_dirs which doesn't hold dir_entry, so those
+        are recorded with the checkpoint.
+        """
+        while (len(open_dirs) > 0
+               and not dir_entry.pathname.startswith(
+                   open_dirs[-1].pathname + os.path.sep)):
+            self.checkpoint.subtree_done(path, open_dirs.pop())
+        open_dirs.append(dir_entry)
+
+    # DirList.recheck
+    def recheck(self, f):
+        """The files of a restored tree may have changed since they
+        were walked.  Returns False for a file which is gone.  A file
+        whose size or modification time changed is updated, so that it
+        is hashed again rather than given its saved digest.
+        """
+        if self.throttle is not None:
+            self.throttle.op()
+        try:
+            stat_result = os.stat(f.pathname)
+        except OSError:
+            return False
+        if (stat_result.st_size != f.bytes
+                or stat_result.st_mtime != f.mod_time):
+            f.set_stat(stat_result)
+            f.to_delete = (f.bytes == 0
+                           and not self.args.keep_empty_files
+                           and not f.protected)
+        return True
 
     def walk(self, path):
-        """walk path adding files and directories"""
+        """walk path adding files and directories.  Returns the key of
+        the new entry in self.contents, if any.  With --checkpoint, each
+        subdirectory is recorded once walked, and those walked by an
+        interrupted run are restored rather than walked again.
+        """
+        # the checkpoint knows the path as it was given
+        checkpoint_path = path
+
         # strip trailing slashes, they are not needed
         path = path.rstrip(os.path.sep)
 
@@ -84,11 +230,13 @@ class DirList:
         if os.path.isfile(path):
             if self.args.stagger_paths:
                 weight_adjust = weight_adjust + self.stagger
-            new_file = FileObj(path, self.args, self.db,
+            new_file = FileObj(path, self.args,
                                weight_adjust=weight_adjust)
+            self.pending.append(new_file)
             if self.args.stagger_paths:
                 self.stagger = self.stagger + new_file.depth
             self.contents[path] = new_file
+            return path
         elif issocket(path):
             print('WARNING: Skipping a socket ' + path, file=sys.stderr)
         elif os.path.isdir(path):
@@ -96,38 +244,447 @@ class DirList:
                 weight_adjust = weight_adjust + self.stagger
             top_dir_entry = DirObj(path, self.args, weight_adjust)
             self.contents[path] = top_dir_entry
-            for dir_name, _, file_list in os.walk(path, topdown=False):
-                # we do not walk into or add names from our ignore list.
-                # We wont delete them if they are leaf nodes and we wont
-                # count them towards parent nodes.
-                if os.path.basename(dir_name) in DELETE_DIR_LIST:
-                    continue
-
+            # the directories os.walk() may not be done with yet
+            open_dirs = []
+            for dir_name, dir_list, file_list in os.walk(path):
                 dir_entry = top_dir_entry.place_dir(
                     dir_name, weight_adjust)
                 if dir_entry is None:
+                    dir_list[:] = []
                     continue
+                if self.checkpoint is not None:
+                    self.subtrees_done(checkpoint_path, open_dirs,
+                                       dir_entry)
+                if self.throttle is not None:
+                    self.throttle.op()
+
+                # decide which subdirectories os.walk may descend into.
+                # ignored ones are neither walked nor counted towards
+                # their parent, excluded ones aren't walked but keep
+                # their parent from being deleted.
+                walk_list = []
+                for sub_name in dir_list:
+                    action = self.rules.match(
+                        'dir', sub_name,
+                        os.path.join(dir_entry.pathname, sub_name))
+                    if action == 'ignore':
+                        continue
+                    if action == 'exclude':
+                        dir_entry.excluded = dir_entry.excluded + 1
+                        continue
+                    if (self.checkpoint is not None
+                            and self.restore_subtree(checkpoint_path,
+                                                     dir_entry, sub_name)):
+                        continue
+                    if action == 'protect':
+                        sub_entry = DirObj(sub_name, self.args,
+                                           weight_adjust, dir_entry)
+                        sub_entry.protected = True
+                        dir_entry.subdirs[sub_name] = sub_entry
+                    walk_list.append(sub_name)
+                dir_list[:] = walk_list
 
                 for fname in file_list:
                     pname = os.path.join(dir_entry.pathname, fname)
-                    if issocket(pname):
+                    action = self.rules.match('file', fname, pname)
+                    if action == 'ignore':
+                        continue
+                    if action == 'exclude':
+                        dir_entry.excluded = dir_entry.excluded + 1
+                        continue
+                    if self.throttle is not None:
+                        self.throttle.op()
+                    # stat once, here, and hand the result to FileObj
+                    stat_result = os.stat(pname)
+                    if stat.S_ISSOCK(stat_result.st_mode):
                         print('WARNING: Skipping a socket ' +
                               pname, file=sys.stderr)
-                    elif os.path.basename(fname) not in DELETE_FILE_LIST:
-                        new_file = FileObj(fname, self.args, self.db,
-                                           parent=dir_entry,
-                                           weight_adjust=weight_adjust)
-                        if new_file.bytes == 0 and not self.args.keep_empty_files:
-                            new_file.to_delete = True
-                        dir_entry.files[fname] = new_file
+                        continue
+                    if action is None:
+                        action = self.rules.match_size(
+                            fname, pname, stat_result.st_size)
+                        if action == 'ignore':
+                            continue
+                        if action == 'exclude':
+                            dir_entry.excluded = dir_entry.excluded + 1
+                            continue
+                    new_file = FileObj(fname, self.args,
+                                       parent=dir_entry,
+                                       weight_adjust=weight_adjust,
+                                       stat_result=stat_result)
+                    if action == 'protect':
+                        new_file.protected = True
+                    self.pending.append(new_file)
+                    if (new_file.bytes == 0
+                            and not self.args.keep_empty_files
+                            and not new_file.protected):
+                        new_file.to_delete = True
+                    dir_entry.files[fname] = new_file
 
             if self.args.stagger_paths:
                 self.stagger = self.stagger + top_dir_entry.max_depth()
+            return path
         else:
             print("\nFATAL ERROR: dont know what this is: " +
                   path, file=sys.stderr)
             sys.exit()
 
+    # DirList.hash_pending
+    def hash_pending(self):
+        """Computes (or looks up) the hash of every file found by
+        walk().  By default files are hashed in the order they were
+        found.  With -o/--schedule-io they are handed to a HashScheduler
+        which reads them in on-disk order instead.  With --time-budget
+        or --byte-budget, the most promising files are hashed first and
+        the rest may be left unverified.
+        """
+        pending = self.pending
+        self.pending = []
+
+        if self.args.archives:
+            self.expand_archives(pending)
+
+        budgeted = (self.args.time_budget is not None
+                    or self.args.byte_budget is not None)
+
+        # small groups are cheaper to compare than to hash, but the
+        # results of a comparison can't be cached.  With a budget, they
+        # are compared in turn with the groups being hashed instead.
+        if (self.db is None and self.args.compare_groups > 0
+                and not budgeted):
+            pending = self.compare_small_groups(pending)
+
+        # digests from an interrupted run, or the hash cache:
+        todo = []
+        for f in pending:
+            if self.checkpoint is not None:
+                f.hexdigest = self.checkpoint.cached_hash(f)
+            if f.hexdigest is None and self.db is not None:
+                f.hexdigest = self.db.cached_hash(f)
+            if f.hexdigest is not None and self.needs_chunks(f):
+                if self.db is not None:
+                    f.chunks = self.db.cached_chunks(f)
+                if f.chunks is None:
+                    # read it again after all, to split it into chunks
+                    f.hexdigest = None
+            if f.hexdigest is None:
+                todo.append(f)
+
+        if not budgeted:
+            self.hash_files(todo)
+        else:
+            self.hash_within_budget(pending, todo)
+        self.chunked.extend(f for f in pending if f.chunks is not None)
+
+    # DirList.needs_chunks
+    def needs_chunks(self, f):
+        """true if --chunk-index asks for this file to be chunked"""
+        return (self.args.chunk_index is not None
+                and f.bytes >= self.args.chunk_index)
+
+    # DirList.hash_file
+    def hash_file(self, f):
+        """Computes the hash of a single file.  Files big enough for
+        --chunk-index are split into chunks in the same pass.
+        """
+        if self.needs_chunks(f):
+            f.hexdigest, f.chunks = chunk_file(f.pathname, self.args,
+                                               self.throttle)
+        else:
+            f.hexdigest = compute_hash(f.pathname, self.args, self.throttle)
+
+    # DirList.hash_files
+    def hash_files(self, files, deadline=None):
+        """hashes files, giving up on any left once deadline passes"""
+        if self.scheduler is not None:
+            self.scheduler.run(files, deadline)
+            return
+        for f in files:
+            if deadline is not None and time.monotonic() > deadline:
+                return
+            self.hash_file(f)
+            self.file_hashed(f)
+
+    # DirList.file_hashed
+    def file_hashed(self, f):
+        """records a newly computed digest.  May be called from several
+        threads at once.
+        """
+        with self.lock:
+            if self.db is not None:
+                self.db.store_hash(f, f.hexdigest)
+                if f.chunks is not None:
+                    self.db.store_chunks(f, f.chunks)
+            if self.checkpoint is not None:
+                self.checkpoint.hashed(f)
+
+    # DirList.hash_within_budget
+    def hash_within_budget(self, pending, todo):
+        """The "anytime" mode.  Files are hashed a size group at a time,
+        starting with the groups which could reclaim the most bytes
+        (size * (count - 1)), until --time-budget seconds have passed
+        since the scan started or --byte-budget bytes have been read.
+        Groups small enough for --compare-groups are byte-compared
+        instead, out of the same budget.
+
+        Any file left unhashed gets a digest unique to it, so neither it
+        nor any directory containing it can be found redundant.  Only
+        what was fully verified gets resolved.
+        """
+        group_sizes = defaultdict(lambda: 0)
+        for f in pending:
+            group_sizes[f.bytes] = group_sizes[f.bytes] + 1
+        by_size = defaultdict(lambda: [])
+        for f in todo:
+            by_size[f.bytes].append(f)
+        # groups none of which has a digest yet may be compared
+        compared = set()
+        if self.db is None and self.args.compare_groups > 0:
+            for candidates in self.comparable_groups(todo):
+                size = candidates[0].bytes
+                if group_sizes[size] == len(candidates):
+                    compared.add(size)
+
+        deadline = None
+        if self.args.time_budget is not None:
+            deadline = self.start_time + self.args.time_budget
+        bytes_left = self.args.byte_budget
+
+        for size in sorted(by_size.keys(),
+                           key=lambda x: x * (group_sizes[x] - 1),
+                           reverse=True):
+            files = by_size[size]
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            if bytes_left is not None:
+                if size * len(files) > bytes_left:
+                    continue
+                bytes_left = bytes_left - size * len(files)
+            if size in compared:
+                if self.scheduler is not None:
+                    files = self.scheduler.disk_order(files)
+                self.compare_group(files)
+            else:
+                self.hash_files(files, deadline)
+
+        for f in todo:
+            if f.hexdigest is None:
+                f.hexdigest = ('unverified:' + f.pathname).encode(
+                    'utf-8', 'surrogateescape')
+                self.unverified.append(f)
+
+    # DirList.compare_small_groups
+    def compare_small_groups(self, pending):
+        """Files which share their size with at most --compare-groups
+        other files are byte-compared with each other instead of being
+        hashed (a file with a unique size isn't read at all).  Each
+        group of identical files gets a digest which is only meaningful
+        within this run.  With -o/--schedule-io the groups are compared
+        in on-disk order.  Returns the files which still need a hash.
+        """
+        compare_list = self.comparable_groups(pending)
+        if self.scheduler is not None:
+            compare_list = self.scheduler.disk_order(
+                [self.scheduler.disk_order(c) for c in compare_list],
+                key=lambda x: x[0])
+
+        for candidates in compare_list:
+            self.compare_group(candidates)
+
+        return [f for f in pending if f.hexdigest is None]
+
+    # DirList.comparable_groups
+    def comparable_groups(self, files):
+        """Returns the groups of same-sized files small enough for
+        --compare-groups, and not needing a real hash.
+        """
+        by_size = defaultdict(lambda: [])
+        for f in files:
+            by_size[f.bytes].append(f)
+
+        compare_list = []
+        for size, candidates in by_size.items():
+            if len(candidates) > self.args.compare_groups:
+                continue
+            if size in self.member_sizes or self.needs_chunks(candidates[0]):
+                # these need a real hash, to match archive members, or
+                # their chunks
+                continue
+            compare_list.append(candidates)
+        return compare_list
+
+    # DirList.compare_group
+    def compare_group(self, candidates):
+        """Byte-compares a group of same-sized files, giving each set of
+        identical files a digest of its own.
+        """
+        size = candidates[0].bytes
+        groups = partition_identical(candidates, self.args, self.throttle)
+        for index, group in enumerate(groups):
+            digest = ('cmp:' + str(size) + ':' + str(index))
+            for f in group:
+                f.hexdigest = digest.encode('utf-8')
+
+    # DirList.expand_archives
+    def expand_archives(self, pending):
+        """With -a/--archives, looks into every zip and tar file found.
+        Each archive is decompressed (at most) once, streaming, and the
+        members' digests are cached in the database.  The members are
+        hung off the archive as a tree of virtual FileObjs and DirObjs,
+        see expand_archive().
+        """
+        for f in pending:
+            if f.to_delete or not is_archive(f.name):
+                continue
+            members = None
+            if self.db is not None:
+                members = self.db.cached_members(f)
+            if members is None:
+                members = scan_members(f.pathname, self.args,
+                                       self.throttle)
+                if members is None:
+                    continue
+                if self.db is not None:
+                    self.db.store_members(f, members)
+            self.expand_archive(f, members)
+            self.archives.append(f)
+            for _, size, _ in members:
+                self.member_sizes.add(size)
+
+    # DirList.expand_archive
+    def expand_archive(self, f, members):
+        """Builds the virtual DirObj tree holding the members of archive
+        f.  Virtual entries are never added to the HashMap, they are
+        only there to be compared with loose files.  Members we can't
+        represent (links, odd names, and names used by more than one
+        member, which tar allows) are counted as excluded, which keeps
+        the archive from ever being found redundant.
+        """
+        if f.parent is None:
+            root = DirObj(f.pathname, self.args, f.weight_adjust)
+        else:
+            root = DirObj(f.name, self.args, f.weight_adjust, f.parent)
+        root.protected = True
+        for name, size, digest in members:
+            parts = member_parts(name)
+            if size is None or parts is None:
+                root.excluded = root.excluded + 1
+                continue
+            dir_entry = root
+            for part in parts[:-1]:
+                if part in dir_entry.files:
+                    dir_entry = None
+                    break
+                if part not in dir_entry.subdirs:
+                    dir_entry.subdirs[part] = DirObj(
+                        part, self.args, f.weight_adjust, dir_entry)
+                dir_entry = dir_entry.subdirs[part]
+            if (dir_entry is None or parts[-1] in dir_entry.files
+                    or parts[-1] in dir_entry.subdirs):
+                # a later member would replace this one on extraction,
+                # and the replaced version may have no loose copy
+                root.excluded = root.excluded + 1
+                continue
+            # members have no inode of their own, so borrow what we
+            # can from the archive
+            stat_result = os.stat_result((0, 0, f.device, 1, 0, 0, size,
+                                          f.mod_time, f.mod_time,
+                                          f.create_time))
+            member = FileObj(parts[-1], self.args, parent=dir_entry,
+                             weight_adjust=f.weight_adjust,
+                             stat_result=stat_result)
+            member.hexdigest = digest
+            dir_entry.files[parts[-1]] = member
+        f.archive = root
+
+    # DirList.mark_redundant_archives
+    def mark_redundant_archives(self):
+        """Marks every archive whose (non-empty) members all exist as
+        loose files for deletion.  The loose copy of each member is
+        remembered in archive_copies, and the copy of the largest one
+        becomes the archive's winner.  This runs before the HashMap is
+        built, so directories are resolved as if the redundant archives
+        were already gone.
+        """
+        loose = {}
+        for _, e in self.contents.items():
+            if isinstance(e, FileObj):
+                file_list = [e]
+            else:
+                file_list = [f for dir_entry in e.dirwalk()
+                             for _, f in dir_entry.files.items()]
+            for f in file_list:
+                if not f.to_delete and f.archive is None and f.bytes > 0:
+                    loose.setdefault(f.hexdigest, f)
+
+        for f in self.archives:
+            if f.protected:
+                continue
+            root = f.archive
+            copies = {}
+            for dir_entry in root.dirwalk():
+                if dir_entry.excluded > 0:
+                    copies = None
+                    break
+                for _, member in dir_entry.files.items():
+                    if member.bytes == 0:
+                        continue
+                    if member.hexdigest not in loose:
+                        copies = None
+                        break
+                    name = member.pathname[len(root.pathname) + 1:]
+                    copies[name] = loose[member.hexdigest]
+                if copies is None:
+                    break
+            if not copies:
+                continue
+            f.archive_copies = copies
+            f.winner = max(copies.values(), key=lambda x: x.bytes)
+            f.mark_for_delete()
+            self.redundant_archives.append(f)
+
+    # DirList.marked_pairs
+    def marked_pairs(self, entry):
+        """A generator yielding (winner, loser) for every file marked
+        for deletion within entry which duplicates another; files in a
+        duplicate directory are paired up by dir_pairs().
+        """
+        if isinstance(entry, FileObj):
+            if entry.to_delete and entry.winner is not None:
+                yield entry.winner, entry
+            return
+        if entry.to_delete:
+            if entry.winner is None:
+                return
+            pairs = dir_pairs(entry.winner, entry)
+            if pairs is None:
+                verification_failed(entry.winner, entry)
+            for pair in pairs:
+                yield pair
+            return
+        for _, f in entry.files.items():
+            for pair in self.marked_pairs(f):
+                yield pair
+        for _, dir_entry in entry.subdirs.items():
+            for pair in self.marked_pairs(dir_entry):
+                yield pair
+
+    # DirList.verify_marked
+    def verify_marked(self):
+        """--verify: byte-compares everything marked for deletion with
+        what it duplicates, and bails out if any of it differs.  Reads
+        go through the throttle, and with -o/--schedule-io are made in
+        on-disk order.
+        """
+        pairs = []
+        for _, e in self.contents.items():
+            pairs.extend(self.marked_pairs(e))
+        if self.scheduler is not None:
+            pairs = self.scheduler.disk_order(pairs, key=lambda x: x[1])
+        for winner, loser in pairs:
+            if not verify_pair(winner, loser, self.throttle):
+                verification_failed(winner, loser)
+
     # DirList.count_bytes
     def count_bytes(self, deleted=False):
         """Returns a btyecount of all the (deleted) objects within"""
@@ -144,16 +701,4 @@ class DirList:
             count = count + e.count_deleted()
         return count
 
-    # DirList.prune_empty
-    def prune_empty(self):
-        """
-        Flags all the children of the deleted objects within to also
-        be deleted.
-        """
-        prev_count = self.count_deleted()
-        if not self.args.keep_empty_dirs:
-            for _, e in self.contents.items():
-                e.prune_empty()
-        return self.count_deleted() - prev_count
-
 # vim: set expandtab sw=4 ts=4:
@@ -7,6 +7,7 @@
 import sys
 import os
 import hashlib
+from fileobj import path_depth
 
 # CONSTANTS:
 #
@@ -21,7 +22,7 @@ DELETE_DIR_LIST = [
 
 # This list describes files and directories we do not want to risk
 # messing with.  If we encounter these, never mark them for deletion.
-# TODO - implement this
+# (see also the "protect" action of --rules)
 DO_NOT_DELETE_LIST = []
 
 
@@ -40,10 +41,16 @@ class DirObj():
         self.weight_adjust = weight_adjust
         self.parent = parent
         self.hexdigest = None
+        # the size of every file within, see finalize()
+        self.bytes = 0
+        # how many entries within were excluded by --rules/--min-size
+        self.excluded = 0
+        # protected dirs (and their contents) are never deleted
+        self.protected = parent is not None and parent.protected
         ancestry = self.get_lineage()
         self.pathname = os.path.sep + os.path.join(*ancestry)
         self.pathnamelen = len(self.pathname)
-        self.depth = len(ancestry) + self.weight_adjust
+        self.depth = path_depth(self.pathname) + self.weight_adjust
 
     # DirObj.get_lineage
     def get_lineage(self):
@@ -135,12 +142,11 @@ class DirObj():
                 # this is a cheat wherein I use a magic value to designate
                 # empty dirs
                 if self.started_empty():
-                    started_empty_report['___started_empty___'].append(self)
+                    started_empty_report.add('___started_empty___', self)
                 else:
-                    empty_report['___empty___'].append(self)
+                    empty_report.add('___empty___', self)
             else:
-                loser_list = dir_report[self.winner.pathname]
-                loser_list.append(self)
+                dir_report.add(self.winner.pathname, self)
         else:
             for _, file_entry in self.files.items():
                 file_entry.generate_reports(reports)
@@ -152,7 +158,7 @@ class DirObj():
         """Checks if the dir was empty when the program was
         invoked.  If we see ignored items, we ignore them.
         """
-        if (len(self.subdirs) + len(self.files)) == 0:
+        if (len(self.subdirs) + len(self.files) + self.excluded) == 0:
             return True
         return False
 
@@ -163,6 +169,9 @@ class DirObj():
         ignored items won't protect a directory from being marked
         for deletion.)
         """
+        if self.excluded > 0 or self.protected:
+            return False
+
         for _, file_entry in self.files.items():
             if not file_entry.to_delete:
                 return False
@@ -176,38 +185,60 @@ class DirObj():
     # DirObj.prune_empty
     def prune_empty(self):
         """Crawls through all directories and marks the shallowest
-        empty entries for deletion.
+        empty entries for deletion.  Returns a list of the directories
+        it marked.
         """
         if (self.is_empty()
                 and not self.to_delete
                 and self.parent is None):
             self.mark_for_delete()
+            return [self]
         elif (self.is_empty()
               and not self.to_delete
               and self.parent is not None
               and not self.parent.is_empty()):
             self.mark_for_delete()
-        else:
-            for _, dir_entry in self.subdirs.items():
-                dir_entry.prune_empty()
+            return [self]
+        pruned = []
+        for _, dir_entry in self.subdirs.items():
+            pruned.extend(dir_entry.prune_empty())
+        return pruned
 
     # DirObj.finalize
     def finalize(self):
         """Once no more files or directories are to be added, we can
         create a meta-hash of all the hashes therein.  This allows us to
         test for duplicate directories.
+
+        Only entries which are not marked for deletion are included, so
+        this is called again whenever something within gets marked:
+        two directories with the same surviving contents are duplicates.
         """
         digests = []
+        # a deleted directory always goes with everything in it, so
+        # this is also what it frees, without walking it again:
+        self.bytes = (sum(f.bytes for _, f in self.files.items()) +
+                      sum(d.bytes for _, d in self.subdirs.items()))
         for _, file_entry in self.files.items():
-            digests.append(file_entry.hexdigest)
+            if file_entry.protected:
+                self.protected = True
+            if not file_entry.to_delete:
+                digests.append(file_entry.hexdigest)
         for _, dir_entry in self.subdirs.items():
-            digests.append(dir_entry.hexdigest)
+            if dir_entry.protected:
+                self.protected = True
+            if not dir_entry.to_delete:
+                digests.append(dir_entry.hexdigest)
         digests.sort()
         sha1 = hashlib.sha1()
         for d in digests:
             sha1.update(d)
+        if self.excluded > 0:
+            # we never looked at the excluded entries, so this dir can't
+            # be shown to duplicate any other.
+            sha1.update(self.pathname.encode('utf-8', 'surrogateescape'))
         self.hexdigest = sha1.hexdigest().encode('utf-8')
-        if (len(self.files) + len(self.subdirs)) == 0:
+        if (len(self.files) + len(self.subdirs)) == 0 and self.is_empty():
             self.to_delete = not self.args.keep_empty_dirs
 
     # DirObj.count_bytes
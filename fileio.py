@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module holds the low-level helpers used to read file contents
+    for hashing and comparison.
+"""
+
+import io
+import os
+import time
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+# size of reading buffer:
+BUF_SIZE = 65536
+
+# how far ahead of (and behind) the read position we advise the kernel
+# when reading in "gentle" mode, unless sized per device:
+READAHEAD_WINDOW = 1024 * 1024
+
+# not every platform has O_NOATIME or posix_fadvise:
+O_NOATIME = getattr(os, 'O_NOATIME', 0)
+FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 0)
+FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 0)
+FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 0)
+
+# cache of readahead window sizes, indexed by st_dev
+_device_windows = {}
+
+
+def advise(fd, offset, length, advice):
+    """posix_fadvise wrapper which silently does nothing where the
+    platform or filesystem does not support it.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+
+def device_window(st_dev):
+    """Returns a readahead window sized for the block device holding
+    st_dev, based on the readahead the kernel already uses for it.
+    Falls back to READAHEAD_WINDOW when the device can't be inspected
+    (NFS, tmpfs, non-linux, ...).
+    """
+    if st_dev in _device_windows:
+        return _device_windows[st_dev]
+    window = READAHEAD_WINDOW
+    sysdir = os.path.realpath('/sys/dev/block/%d:%d' %
+                              (os.major(st_dev), os.minor(st_dev)))
+    # partitions keep their queue settings on the parent device
+    for queue in (os.path.join(sysdir, 'queue'),
+                  os.path.join(os.path.dirname(sysdir), 'queue')):
+        try:
+            with open(os.path.join(queue, 'read_ahead_kb')) as f:
+                kb = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        # read a few kernel readahead units ahead, but never less
+        # than a single buffer:
+        window = max(BUF_SIZE, kb * 1024 * 4)
+        break
+    _device_windows[st_dev] = window
+    return window
+
+
+def open_noatime(pathname):
+    """Opens a file read-only without updating its access time, where
+    permitted.  O_NOATIME fails with EPERM unless we own the file, in
+    which case we quietly fall back to a regular open.
+    """
+    if O_NOATIME:
+        try:
+            return os.open(pathname, os.O_RDONLY | O_NOATIME)
+        except PermissionError:
+            pass
+    return os.open(pathname, os.O_RDONLY)
+
+
+class ThrottledFile(io.RawIOBase):
+    """A read-only file object whose reads are accounted to a Throttle
+    (if any), for libraries which want a file rather than chunks, such
+    as zipfile and tarfile.  In "gentle" mode it is opened and advised
+    like read_chunks() does: the kernel reads a window ahead of the
+    read position and drops what is left behind.
+    """
+
+    def __init__(self, pathname, gentle=False, device_readahead=False,
+                 throttle=None):
+        super().__init__()
+        if throttle is not None:
+            throttle.op()
+        self.gentle = gentle
+        self.throttle = throttle
+        if gentle:
+            self.fd = open_noatime(pathname)
+        else:
+            self.fd = os.open(pathname, os.O_RDONLY)
+        self.window = READAHEAD_WINDOW
+        if gentle and device_readahead:
+            self.window = device_window(os.fstat(self.fd).st_dev)
+        # how far the kernel was told to read ahead, and where we last
+        # dropped pages up to
+        self.advised = 0
+        self.dropped = 0
+        if gentle:
+            advise(self.fd, 0, 0, FADV_SEQUENTIAL)
+
+    # ThrottledFile.readable
+    def readable(self):
+        return True
+
+    # ThrottledFile.seekable
+    def seekable(self):
+        return True
+
+    # ThrottledFile.seek
+    def seek(self, offset, whence=os.SEEK_SET):
+        return os.lseek(self.fd, offset, whence)
+
+    # ThrottledFile.readinto
+    def readinto(self, buffer):
+        pos = os.lseek(self.fd, 0, os.SEEK_CUR)
+        if self.gentle and pos + self.window > self.advised:
+            advise(self.fd, pos, self.window, FADV_WILLNEED)
+            self.advised = pos + self.window
+        started = time.monotonic()
+        nbytes = os.readv(self.fd, [buffer])
+        if self.throttle is not None and nbytes > 0:
+            self.throttle.read(nbytes, time.monotonic() - started)
+        if self.gentle and pos + nbytes - self.dropped >= self.window:
+            advise(self.fd, self.dropped, pos + nbytes - self.dropped,
+                   FADV_DONTNEED)
+            self.dropped = pos + nbytes
+        return nbytes
+
+    # ThrottledFile.close
+    def close(self):
+        if not self.closed:
+            if self.gentle:
+                advise(self.fd, 0, 0, FADV_DONTNEED)
+            os.close(self.fd)
+        super().close()
+
+
+def read_chunks(pathname, gentle=False, device_readahead=False,
+                throttle=None, size=BUF_SIZE):
+    """A generator which yields the contents of a file in chunks of
+    "size" bytes.  If a Throttle is provided, the open and every read
+    are accounted to it (and may be delayed by it).
+
+    In "gentle" mode the file is opened with O_NOATIME and the kernel
+    is told to read ahead of us (SEQUENTIAL/WILLNEED) and to drop the
+    pages we are done with (DONTNEED), so hashing a large volume does
+    not evict the page cache other processes depend on.
+    """
+    if throttle is not None:
+        throttle.op()
+
+    if not gentle:
+        with open(pathname, 'rb') as f:
+            while True:
+                if throttle is not None:
+                    started = time.monotonic()
+                data = f.read(size)
+                if not data:
+                    break
+                if throttle is not None:
+                    throttle.read(len(data), time.monotonic() - started)
+                yield data
+        return
+
+    fd = open_noatime(pathname)
+    try:
+        if device_readahead:
+            window = device_window(os.fstat(fd).st_dev)
+        else:
+            window = READAHEAD_WINDOW
+        advise(fd, 0, 0, FADV_SEQUENTIAL)
+        pos = 0
+        advised = 0
+        dropped = 0
+        while True:
+            # stay one window ahead of the read position:
+            if pos + window > advised:
+                advise(fd, advised, window, FADV_WILLNEED)
+                advised = advised + window
+            if throttle is not None:
+                started = time.monotonic()
+            data = os.read(fd, size)
+            if not data:
+                break
+            if throttle is not None:
+                throttle.read(len(data), time.monotonic() - started)
+            pos = pos + len(data)
+            # and drop everything more than a window behind it:
+            if pos - dropped >= window:
+                advise(fd, dropped, pos - dropped, FADV_DONTNEED)
+                dropped = pos
+            yield data
+    finally:
+        advise(fd, 0, 0, FADV_DONTNEED)
+        os.close(fd)
+
+# vim: set expandtab sw=4 ts=4:
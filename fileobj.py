@@ -6,41 +6,65 @@
 
 import os
 import sys
-from hashdbobj import compute_hash
+
+
+def path_depth(pathname):
+    """The depth of a (walked) file or directory before any weight is
+    added: one for each component of its pathname, counting the empty
+    one before the leading separator.
+    """
+    return len(pathname.split(os.path.sep))
 
 
 class FileObj():
     """A file object which stores some metadata"""
 
-    def __init__(self, name, args, db, parent=None, weight_adjust=0):
+    def __init__(self, name, args, parent=None, weight_adjust=0,
+                 stat_result=None):
         self.name = name
         self.args = args
-        self.db = db
         self.winner = None
         self.parent = parent
         self.weight_adjust = weight_adjust
+        # protected files are never deleted
+        self.protected = parent is not None and parent.protected
 
         if self.parent is not None:
             ancestry = self.parent.get_lineage()
             ancestry.append(self.name)
             self.pathname = os.path.sep + os.path.join(*ancestry)
-            self.depth = len(ancestry) + self.weight_adjust
+            self.depth = path_depth(self.pathname) + self.weight_adjust
         else:
             self.pathname = self.name
             self.depth = self.weight_adjust
 
         self.pathnamelen = len(self.pathname)
 
-        stat_result = os.stat(self.pathname)
+        if stat_result is None:
+            stat_result = os.stat(self.pathname)
+        self.set_stat(stat_result)
+
+        # computed later, once all files have been found.
+        # see DirList.hash_pending()
+        self.hexdigest = None
+        self.to_delete = False
+        # with -a/--archives, the virtual DirObj holding an archive's
+        # members, and (if it is redundant) the loose copy of each one.
+        # see DirList.expand_archives()
+        self.archive = None
+        self.archive_copies = None
+        # with --chunk-index, (length, digest) of each chunk of a large
+        # file.  see chunker.chunk_file()
+        self.chunks = None
+
+    # FileObj.set_stat
+    def set_stat(self, stat_result):
+        """takes the file's size, times and identity from stat_result"""
         self.mod_time = stat_result.st_mtime
         self.create_time = stat_result.st_ctime
         self.bytes = stat_result.st_size
-
-        if self.db is not None:
-            self.hexdigest = self.db.lookup_hash(self)
-        else:
-            self.hexdigest = compute_hash(self.pathname)
-        self.to_delete = False
+        self.device = stat_result.st_dev
+        self.inode = stat_result.st_ino
 
     # FileObj.is_empty
     def is_empty(self):
@@ -63,15 +87,17 @@ class FileObj():
         # this is a cheat wherein I use the empty_report as a list of keys
         # and I disregard the values
         if self.winner is None:
-            empty_report['___empty___'].append(self)
+            empty_report.add('___empty___', self)
+            return
+        if self.archive_copies is not None:
+            reports['archives'].add(self.winner.pathname, self)
             return
         # just a trivial check to confirm hash matches:
         if self.bytes != self.winner.bytes:
             print('\nFATAL: BIRTHDAY LOTTERY CRISIS!', file=sys.stderr)
             print('FATAL: matched hashes and mismatched sizes!', file=sys.stderr)
             sys.exit(-1)
-        loser_list = file_report[self.winner.pathname]
-        loser_list.append(self)
+        file_report.add(self.winner.pathname, self)
 
     # FileObj.count_bytes
     def count_bytes(self, to_delete=False):
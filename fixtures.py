@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+    The test harness behind -t/--run-tests.  Each fixture under "tests"
+    is a directory holding:
+
+        before/     the tree to analyze
+        after/      what should be left of it
+        opts.json   optionally: "args", "paths", "twice", "expected_pass",
+                    and "linked", pairs of files that must end up
+                    sharing an inode (--link-mode)
+
+    Fixtures run in parallel, each in a temporary directory of its own,
+    and everything (running the script, comparing trees) happens
+    in-process.  The unit tests in tests/test_*.py run afterwards, and
+    can also be run on their own with "python -m unittest discover -s
+    tests" (or pytest).
+"""
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import hashlib
+import tempfile
+import unittest
+from io import StringIO
+from json import loads
+from concurrent.futures import ProcessPoolExecutor
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+
+# options naming a file.  Relative names refer to the fixture's own
+# directory if such a file exists there (e.g. --rules), and otherwise
+# to the temporary directory (e.g. -d).
+FILE_OPTIONS = ['database', 'checkpoint', 'rules']
+
+# how many noise files go in each directory of a scaled variant:
+NOISE_PER_DIR = 100
+
+# noise files come in groups of up to this many files of the same size...
+NOISE_GROUP = 6
+
+# ...and this often, a copy of one of them:
+NOISE_COPY = 3
+
+
+def snapshot(root):
+    """Returns a comparable picture of a tree: relative path -> None for
+    directories, or the size and SHA1 hash of a file.  A missing tree
+    looks empty.
+    """
+    picture = {}
+    for dir_name, dir_list, file_list in os.walk(root):
+        rel_dir = os.path.relpath(dir_name, root)
+        for name in dir_list:
+            picture[os.path.normpath(os.path.join(rel_dir, name))] = None
+        for name in file_list:
+            with open(os.path.join(dir_name, name), 'rb') as f:
+                data = f.read()
+            picture[os.path.normpath(os.path.join(rel_dir, name))] = (
+                len(data), hashlib.sha1(data).hexdigest())
+    return picture
+
+
+def apply_script(script, root):
+    """Carries out the rm commands of a generated script, in-process.
+    Refuses to touch anything outside of root.
+    """
+    for line in script.splitlines():
+        if not line.startswith('rm -rf '):
+            continue
+        pathname = shlex.split(line)[2]
+        if os.path.commonpath([root, pathname]) != root:
+            raise ValueError('script removes ' + pathname +
+                             ' which is outside of ' + root)
+        if os.path.isdir(pathname) and not os.path.islink(pathname):
+            shutil.rmtree(pathname)
+        elif os.path.lexists(pathname):
+            os.remove(pathname)
+
+
+def make_noise(root, count, min_size, tag):
+    """Adds count files to root, for a fixture to run alongside.  They
+    come in groups of one to NOISE_GROUP files sharing a size (at least
+    min_size), so that both byte-comparing and hashing get exercised,
+    and every NOISE_COPY-th file gets an identical copy in a "dup"
+    directory one level deeper.  Returns their snapshot.
+    """
+    made = 0
+    group = 0
+    while made < count:
+        size = min_size + group
+        for member in range(1 + group % NOISE_GROUP):
+            if made >= count:
+                break
+            dir_name = os.path.join(root, 'd%04d' % (made // NOISE_PER_DIR))
+            data = (tag + ':' + str(group) + ':' + str(member) + ':').encode(
+                'utf-8').ljust(size, b'.')
+            names = [os.path.join(dir_name, 'n%06d' % made)]
+            if made % NOISE_COPY == 0 and made + 1 < count:
+                names.append(os.path.join(dir_name, 'dup', 'n%06d' % made))
+            for pathname in names:
+                os.makedirs(os.path.dirname(pathname), exist_ok=True)
+                with open(pathname, 'wb') as f:
+                    f.write(data)
+                made = made + 1
+        group = group + 1
+    return snapshot(root)
+
+
+def check_noise(before, after, deduplicated):
+    """Checks what a run left of the noise: no file may have changed,
+    and every content must survive somewhere.  If deduplicated, exactly
+    one copy of each must be left.  Returns a complaint, or None.
+    """
+    files = dict((k, v) for k, v in after.items() if v is not None)
+    for pathname, contents in files.items():
+        if before.get(pathname) != contents:
+            return 'noise was changed'
+    kept = set(v for v in before.values() if v is not None)
+    if set(files.values()) != kept:
+        return 'noise was lost'
+    if deduplicated and len(files) != len(kept):
+        return 'noise was not deduplicated'
+    return None
+
+
+def load_opts(test_dir):
+    """reads a fixture's opts.json, if it has one"""
+    try:
+        with open(os.path.join(test_dir, 'opts.json')) as f:
+            return loads(f.read())
+    except OSError:
+        return {}
+
+
+def scalable(test_dir):
+    """Whether a fixture can have noise added: not if it is about
+    analyze() failing, or about having no paths at all.
+    """
+    opts = load_opts(test_dir)
+    return (opts.get('expected_pass', True)
+            and len(opts.get('paths', ['ephemeral'])) > 0)
+
+
+def fixture_paths(paths, workdir):
+    """points the "paths" of opts.json, which are relative to the
+    fixture directory, at the temporary directory instead
+    """
+    from dirlist import check_level
+
+    new_paths = []
+    for path in paths:
+        weight, pathname = check_level(path)
+        pathname = os.path.join(workdir, pathname)
+        if weight != 0 or path.startswith('0:'):
+            pathname = str(weight) + ':' + pathname
+        new_paths.append(pathname)
+    return new_paths
+
+
+def run_fixture(test_name, scale=0):
+    """Runs a single fixture, optionally with scale noise files next to
+    it, and returns (test_name, scale, passed, message, seconds spent
+    analyzing and applying the results):
+        1. copy "before" into a temporary dir called "ephemeral".
+        2. analyze "ephemeral" and generate the script.
+        3. carry out the script's deletions.
+        4. compare "ephemeral" with "after", and check what is left of
+           the noise, see check_noise().
+    """
+    from dedup import analyze, build_parser
+    from report import generate_reports
+    from linker import link_redundant
+
+    test_dir = os.path.join(TESTS_DIR, test_name)
+    workdir = tempfile.mkdtemp(prefix='dedup-test-')
+    try:
+        ephemeral_dir = os.path.join(workdir, 'ephemeral')
+        shutil.copytree(os.path.join(test_dir, 'before'), ephemeral_dir)
+
+        opts = load_opts(test_dir)
+        runs = 2 if opts.get('twice') else 1
+        expected_pass = opts.get('expected_pass', True)
+        test_paths = fixture_paths(opts.get('paths', ['ephemeral']),
+                                   workdir)
+
+        args = build_parser().parse_args(opts.get('args', []))
+        for name in FILE_OPTIONS:
+            value = getattr(args, name)
+            if value is not None and not os.path.isabs(value):
+                if os.path.exists(os.path.join(test_dir, value)):
+                    setattr(args, name, os.path.join(test_dir, value))
+                else:
+                    setattr(args, name, os.path.join(workdir, value))
+
+        noise = None
+        if scale > 0:
+            noise_dir = os.path.join(workdir, 'noise')
+            # bigger than anything in the fixture (or its --min-size and
+            # --byte-budget), so the fixture's size groups are unchanged
+            min_size = max([0] + [v[0] for v in
+                                  snapshot(ephemeral_dir).values()
+                                  if v is not None])
+            min_size = max(min_size, args.min_size or 0,
+                           args.byte_budget or 0) + 1
+            noise = make_noise(noise_dir, scale, min_size, test_name)
+            test_paths.append(noise_dir)
+
+        script = StringIO()
+        start_time = time.time()
+        try:
+            for i in range(1, runs + 1):
+                print("# run number " + str(i), file=script)
+                results = analyze(args, test_paths, script)
+                if results is None:
+                    break
+        except SystemExit:
+            results = None
+        if results is None:
+            if expected_pass:
+                return test_name, scale, False, 'failed analyze', 0
+            return test_name, scale, True, '', time.time() - start_time
+        if args.link_mode is not None:
+            if link_redundant(results, script, start_time) != 0:
+                return test_name, scale, False, 'failed to link', 0
+        else:
+            generate_reports(results, script, start_time)
+            apply_script(script.getvalue(), workdir)
+        elapsed = time.time() - start_time
+
+        if snapshot(ephemeral_dir) != snapshot(os.path.join(test_dir, 'after')):
+            return test_name, scale, False, 'unexpected results', elapsed
+        for pair in opts.get('linked', []):
+            inodes = set(os.stat(os.path.join(ephemeral_dir, name)).st_ino
+                         for name in pair)
+            if len(inodes) != 1:
+                return (test_name, scale, False,
+                        'not linked: ' + ', '.join(pair), elapsed)
+        if noise is not None:
+            # budgets may leave copies, links leave them all in place
+            deduplicated = (args.link_mode is None
+                            and args.time_budget is None
+                            and args.byte_budget is None)
+            complaint = check_noise(noise, snapshot(noise_dir), deduplicated)
+            if complaint is not None:
+                return test_name, scale, False, complaint, elapsed
+        return test_name, scale, True, '', elapsed
+    except Exception as e:
+        return test_name, scale, False, repr(e), 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_unit_tests():
+    """runs the unit tests, printing their output only if they fail"""
+    suite = unittest.defaultTestLoader.discover(TESTS_DIR,
+                                                pattern='test_*.py')
+    stream = StringIO()
+    start_time = time.time()
+    result = unittest.TextTestRunner(stream=stream).run(suite)
+    elapsed = time.time() - start_time
+    if result.wasSuccessful():
+        print('Running ' + str(result.testsRun) + ' unit tests: ' +
+              'PASSED (%.2fs)' % elapsed)
+        return True
+    print('Running ' + str(result.testsRun) + ' unit tests: FAILED')
+    print(stream.getvalue())
+    return False
+
+
+def run_fixtures(args):
+    """Runs the requested fixture (or all of them, followed by the unit
+    tests), in parallel, each once as it is and (where that makes
+    sense) once more with --test-scale noise files added.
+    """
+    test_list = sorted(name for name in os.listdir(TESTS_DIR)
+                       if os.path.isdir(os.path.join(TESTS_DIR, name)))
+    # this will be '00' if all tests are requested.
+    requested_test = '%02d' % int(args.run_tests)
+    if requested_test != '00':
+        test_list = [x for x in test_list if x[:2] == requested_test]
+
+    jobs = []
+    for test_name in test_list:
+        jobs.append((test_name, 0))
+        if (args.test_scale > 0
+                and scalable(os.path.join(TESTS_DIR, test_name))):
+            jobs.append((test_name, args.test_scale))
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(run_fixture, *job) for job in jobs]
+        for future in futures:
+            test_name, scale, passed, message, elapsed = future.result()
+            variant = ''
+            if scale > 0:
+                variant = ' (+' + str(scale) + ' noise files)'
+            if passed:
+                print('Running test ' + test_name + variant +
+                      ': PASSED (%.2fs)' % elapsed)
+            else:
+                failed = failed + 1
+                print('Running test ' + test_name + variant +
+                      ': FAILED (' + message + ')')
+    if requested_test == '00' and not run_unit_tests():
+        failed = failed + 1
+    if failed > 0:
+        print(str(failed) + ' of ' + str(len(jobs)) + ' tests failed',
+              file=sys.stderr)
+        return -1
+    return 0
+
+# vim: set expandtab sw=4 ts=4:
@@ -6,36 +6,298 @@
 
 import os
 import sys
+import stat
+import shutil
 import hashlib
+import tempfile
 import time
 import dbm
+import importlib
+from json import dumps, loads
+from fileio import read_chunks
+from report import sizeof_fmt
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # CONSTANTS:
 #
 # Python doesn't really have constants so I'll use ALLCAPS to indicate
 # that I do not expect these values to change. ¯\_(ツ)_/¯
 
-# size of hashing buffer:
-BUF_SIZE = 65536
+# depending on which dbm module python picked, a "dbm" database is
+# stored in one or more files named after it, with these suffixes:
+DBM_SUFFIXES = ['', '.db', '.dat', '.dir', '.bak', '.pag']
+
+# keys of entries which aren't a file's hash start with one of these,
+# followed by the pathname of the file they describe:
+ENTRY_PREFIXES = ('archive:', 'chunks:')
+
+# the sidecar file locked by everything using a database, see
+# lock_database():
+LOCK_SUFFIX = '.lock'
+
+# how many times -c/--clean-database tries to copy a database which is
+# being written to:
+SNAPSHOT_TRIES = 3
 
 
-def compute_hash(pathname):
+def compute_hash(pathname, args=None, throttle=None):
     """reads a file and computes a SHA1 hash"""
     # open and read the file
 
     # TODO - parameterize this to optionally check less
     #   than the whole file.
 
+    gentle = False
+    device_readahead = False
+    if args is not None:
+        gentle = args.gentle_io
+        device_readahead = args.device_readahead
+
     sha1 = hashlib.sha1()
-    with open(pathname, 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            sha1.update(data)
+    for data in read_chunks(pathname, gentle, device_readahead, throttle):
+        sha1.update(data)
     return sha1.hexdigest().encode('utf-8')
 
 
+def database_files(name):
+    """returns the suffixes of the files which make up database name"""
+    return [suffix for suffix in DBM_SUFFIXES
+            if os.path.isfile(name + suffix)]
+
+
+def database_signature(name):
+    """Returns something which changes whenever database name is
+    written to: the size and modification time of each of its files.
+    """
+    signature = []
+    for suffix in database_files(name):
+        stat_result = os.stat(name + suffix)
+        signature.append((suffix, stat_result.st_size,
+                          stat_result.st_mtime_ns))
+    return signature
+
+
+def database_mod_time(name):
+    """Returns when database name was last modified, or None if it
+    doesn't exist
+    """
+    signature = database_signature(name)
+    if len(signature) == 0:
+        return None
+    return max(x[2] for x in signature) / 1e9
+
+
+def lock_database(name, exclusive=False, wait=True):
+    """Locks database name through a sidecar file, which is never
+    removed: scans share the lock for as long as they have the database
+    open, -c/--clean-database holds it exclusively while swapping in
+    the compacted database, and -n/--nuke-database while removing it.
+    Returns the open lock file; closing it releases the lock.  Raises
+    BlockingIOError if wait is False and the lock is held elsewhere.
+    Without fcntl (not on a unix), nothing is locked.
+    """
+    lock_file = open(name + LOCK_SUFFIX, 'a')
+    if fcntl is not None:
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not wait:
+            operation = operation | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file.fileno(), operation)
+        except BaseException:
+            lock_file.close()
+            raise
+    return lock_file
+
+
+def nuke_database(name, outfile):
+    """-n/--nuke-database: removes the files of database name, which
+    no other scan may be using
+    """
+    try:
+        lock_file = lock_database(name, exclusive=True, wait=False)
+    except BlockingIOError:
+        print('\nFATAL: ' + name + ' is in use by another scan, it ' +
+              'was not removed', file=sys.stderr)
+        sys.exit(-1)
+    try:
+        for suffix in database_files(name):
+            os.remove(name + suffix)
+            print('# removed ' + name + suffix, file=outfile)
+    finally:
+        lock_file.close()
+
+
+def snapshot_database(name, snapshot):
+    """Copies the files of database name to snapshot, holding the
+    shared lock so that it can't be swapped out meanwhile.  Scans may
+    write to it as it is copied, so the copy only counts if nothing
+    changed.  Returns the signature of the database copied, or None.
+    """
+    lock_file = lock_database(name)
+    try:
+        signature = database_signature(name)
+        for suffix, _, _ in signature:
+            shutil.copy2(name + suffix, snapshot + suffix)
+        if database_signature(name) != signature:
+            return None
+        return signature
+    finally:
+        lock_file.close()
+
+
+def entry_is_current(key, value, mod_time):
+    """Decides whether a database entry is still worth keeping: its
+    path must still be a regular file, and (as in HashDbObj) it must
+    not have been modified since the database was last written.
+    Archive member and chunk lists must still match the file's size and
+    modification time.
+    """
+    prefix = ''
+    for p in ENTRY_PREFIXES:
+        if key.startswith(p):
+            prefix = p
+    pathname = key[len(prefix):]
+    try:
+        stat_result = os.stat(pathname)
+    except OSError:
+        return False
+    if not stat.S_ISREG(stat_result.st_mode):
+        return False
+    if prefix:
+        entry = loads(value)
+        return (entry['bytes'] == stat_result.st_size
+                and entry['mod_time'] == stat_result.st_mtime)
+    return stat_result.st_mtime < mod_time
+
+
+def clean_database(args, outfile=sys.stdout):
+    """-c/--clean-database: drops stale entries from the hash cache and
+    rewrites it compactly, while scans carry on using it.
+
+    The database is copied to a snapshot (see snapshot_database()),
+    which is read once, front to back, and every entry which is still
+    current goes into a fresh database.  Only then is the lock on the
+    database taken exclusively, waiting for the scans using it to
+    finish (they share the lock, see lock_database()), and the fresh
+    database replaces the original one file at a time.  If the
+    original was written to since the snapshot, the clean is abandoned
+    rather than losing those entries.  Should the swap fail part way,
+    the original files are put back.
+    """
+    name = args.database
+    if name is None:
+        print('\nFATAL: -c/--clean-database needs a -d database',
+              file=sys.stderr)
+        sys.exit(-1)
+    if len(database_files(name)) == 0:
+        print('\nFATAL: ' + name + ' does not exist', file=sys.stderr)
+        sys.exit(-1)
+
+    workdir = tempfile.mkdtemp(prefix='.dedup-clean-',
+                               dir=os.path.dirname(os.path.abspath(name)))
+    try:
+        snapshot = os.path.join(workdir, 'snapshot')
+        for _ in range(SNAPSHOT_TRIES):
+            signature = snapshot_database(name, snapshot)
+            if signature is not None:
+                break
+        else:
+            print('\nFATAL: ' + name + ' kept changing while it was ' +
+                  'copied, try again later', file=sys.stderr)
+            sys.exit(-1)
+        mod_time = max(x[2] for x in signature) / 1e9
+        before_bytes = sum(x[1] for x in signature)
+
+        # write the same kind of database we read:
+        kind = dbm.whichdb(snapshot)
+        if not kind:
+            print('\nFATAL: ' + name + ' is not a database',
+                  file=sys.stderr)
+            sys.exit(-1)
+        module = importlib.import_module(kind)
+        compacted = os.path.join(workdir, 'compacted')
+        before = 0
+        after = 0
+        old_db = module.open(snapshot, 'r')
+        new_db = module.open(compacted, 'n')
+        try:
+            for key in old_db.keys():
+                value = old_db[key]
+                before = before + 1
+                if isinstance(key, bytes):
+                    key = key.decode('utf-8')
+                if entry_is_current(key, value, mod_time):
+                    new_db[key] = value
+                    after = after + 1
+        finally:
+            old_db.close()
+            new_db.close()
+
+        new_suffixes = database_files(compacted)
+        after_bytes = sum(os.path.getsize(compacted + suffix)
+                          for suffix in new_suffixes)
+        print('# ' + name + ': ' + str(before) + ' entries (' +
+              sizeof_fmt(before_bytes) + ') before, ' + str(after) +
+              ' entries (' + sizeof_fmt(after_bytes) + ') after',
+              file=outfile)
+
+        try:
+            lock_file = lock_database(name, exclusive=True, wait=False)
+        except BlockingIOError:
+            print('# waiting for the scans using ' + name + ' to finish',
+                  file=outfile)
+            lock_file = lock_database(name, exclusive=True)
+        try:
+            if database_signature(name) != signature:
+                print('WARNING: ' + name + ' was written to while it was ' +
+                      'cleaned, so it was left as it was; try again',
+                      file=sys.stderr)
+                return -1
+            swap_database(name, [x[0] for x in signature], compacted,
+                          new_suffixes, os.path.join(workdir, 'original'))
+        finally:
+            lock_file.close()
+        print('# replaced ' + name + ' with the compacted database',
+              file=outfile)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+def swap_database(name, old_suffixes, compacted, new_suffixes, backup):
+    """Replaces the files of database name with those of database
+    compacted.  Each rename is atomic, but a dbm module may use several
+    files, so the originals are first linked to backup, and put back if
+    any step fails.  Must be called with the database locked.
+    """
+    try:
+        for suffix in old_suffixes:
+            os.link(name + suffix, backup + suffix)
+    except OSError as e:
+        print('\nFATAL: could not back up ' + name + ': ' + str(e),
+              file=sys.stderr)
+        sys.exit(-1)
+    try:
+        for suffix in new_suffixes:
+            os.replace(compacted + suffix, name + suffix)
+        for suffix in old_suffixes:
+            if suffix not in new_suffixes:
+                os.remove(name + suffix)
+    except OSError as e:
+        for suffix in new_suffixes:
+            if suffix not in old_suffixes and os.path.exists(name + suffix):
+                os.remove(name + suffix)
+        for suffix in old_suffixes:
+            os.replace(backup + suffix, name + suffix)
+        print('\nFATAL: could not replace ' + name + ', it was left ' +
+              'as it was: ' + str(e), file=sys.stderr)
+        sys.exit(-1)
+
+
 class HashDbObj():
     """
     The HashDbObj is a wrapper for a "dbm" cache file.
@@ -45,9 +307,16 @@ class HashDbObj():
     def __init__(self, args, outfile):
         self.args = args
         self.outfile = outfile
+        # held until close(), so -c/--clean-database can't swap the
+        # database out from under us (waits while it is being swapped)
         try:
-            self.mod_time = os.stat(self.args.database).st_mtime
-        except OSError:
+            self.lock_file = lock_database(self.args.database)
+        except OSError as e:
+            print("\nFATAL: " + self.args.database +
+                  " could not be locked: " + str(e), file=sys.stderr)
+            sys.exit(-1)
+        self.mod_time = database_mod_time(self.args.database)
+        if self.mod_time is None:
             print("# db " + self.args.database +
                   " doesn't exist yet", file=self.outfile)
             self.mod_time = time.time()
@@ -62,8 +331,10 @@ class HashDbObj():
                   " could not be loaded", file=sys.stderr)
             sys.exit(-1)
 
-    def lookup_hash(self, f):
-        """look up this path to see if it has already been computed"""
+    def cached_hash(self, f):
+        """returns the cached hash for this path, or None if it has not
+        been computed (or the file changed since it was)
+        """
         if f.pathname in self.db:
             # we've a cached hash value for this pathname
             if f.mod_time < self.mod_time:
@@ -73,12 +344,77 @@ class HashDbObj():
                     print('# hash ' + str(digest) + ' for ' +
                           f.pathname + ' already in db.', file=self.outfile)
                 return digest
-        digest = compute_hash(f.pathname)
-        # add/update the cached hash value for this entry:
+        return None
+
+    def store_hash(self, f, digest):
+        """add/update the cached hash value for this entry"""
         self.db[f.pathname] = digest
+
+    def lookup_hash(self, f, throttle=None):
+        """look up this path to see if it has already been computed"""
+        digest = self.cached_hash(f)
+        if digest is None:
+            digest = compute_hash(f.pathname, self.args, throttle)
+            self.store_hash(f, digest)
         return digest
 
+    def cached_members(self, f):
+        """returns the (name, size, hexdigest) list cached for the
+        members of archive f, or None.  Entries are keyed by the
+        archive's pathname, and only used if its size and modification
+        time haven't changed since.
+        """
+        key = 'archive:' + f.pathname
+        if key not in self.db:
+            return None
+        entry = loads(self.db[key])
+        if entry['bytes'] != f.bytes or entry['mod_time'] != f.mod_time:
+            return None
+        return [(name, size, digest and digest.encode('utf-8'))
+                for name, size, digest in entry['members']]
+
+    def store_members(self, f, members):
+        """add/update the cached member list of archive f"""
+        self.db['archive:' + f.pathname] = dumps({
+            'bytes': f.bytes,
+            'mod_time': f.mod_time,
+            'members': [(name, size, digest and digest.decode('utf-8'))
+                        for name, size, digest in members]})
+
+    def cached_chunks(self, f):
+        """returns the (length, digest) chunk list cached for file f, or
+        None.  Like archive member lists, these are only used if the
+        file's size and modification time haven't changed.
+        """
+        key = 'chunks:' + f.pathname
+        if key not in self.db:
+            return None
+        entry = loads(self.db[key])
+        if entry['bytes'] != f.bytes or entry['mod_time'] != f.mod_time:
+            return None
+        return [(length, bytes.fromhex(digest))
+                for length, digest in entry['chunks']]
+
+    def store_chunks(self, f, chunks):
+        """add/update the cached chunk list of file f"""
+        self.db['chunks:' + f.pathname] = dumps({
+            'bytes': f.bytes,
+            'mod_time': f.mod_time,
+            'chunks': [(length, digest.hex()) for length, digest in chunks]})
+
+    def entries(self):
+        """A generator yielding (pathname, digest) for every cached file
+        hash, regardless of whether it is still current.
+        """
+        for key in self.db.keys():
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            if key.startswith(ENTRY_PREFIXES):
+                continue
+            yield key, self.db[key]
+
     def close(self):
         self.db.close()
+        self.lock_file.close()
 
 # vim: set expandtab sw=4 ts=4:
@@ -5,6 +5,7 @@
 """
 
 import sys
+import heapq
 from collections import defaultdict
 import operator
 from fileobj import FileObj
@@ -20,6 +21,16 @@ def member_is_type(tup, typ):
     return isinstance(l[0], typ)
 
 
+def rank_candidates(candidates, reverse_selection=False):
+    """Sorts a list of entries with identical contents so that the one
+    to keep comes first, see HashMap.resolve_candidates()
+    """
+    candidates.sort(
+        key=operator.attrgetter('depth', 'pathnamelen', 'pathname'),
+        reverse=reverse_selection)
+    candidates.sort(key=lambda x: not x.protected)
+
+
 class HashMap:
     """
     A wrapper to a python dict with some helper functions.
@@ -36,6 +47,13 @@ class HashMap:
         self.all_files = all_files
         # reference to launch instructions
         self.args = args
+        # ids of the winners picked so far, and of everything holding
+        # one.  none of these may be deleted, or a winner would go with
+        # it.  the loose copies of redundant archives were picked first.
+        self.kept = set()
+        for archive in all_files.redundant_archives:
+            for _, copy in archive.archive_copies.items():
+                self.keep(copy)
 
         for _, e in all_files.contents.items():
             if isinstance(e, FileObj):
@@ -64,17 +82,28 @@ class HashMap:
         if entry.depth < self.min_depth:
             self.min_depth = entry.depth
 
+    # HashMap.keep
+    def keep(self, entry):
+        """Records that entry must survive, and so everything above it"""
+        while entry is not None and id(entry) not in self.kept:
+            self.kept.add(id(entry))
+            entry = entry.parent
+
     # HashMap.prune
     def prune(self):
-        """Removes deleted objects from the HashMap"""
+        """Removes deleted objects from the HashMap, except for losers,
+        which stay in their bucket for losers() to find.  Everything
+        within a deleted directory is marked for deletion too.
+        """
         delete_list = []
         for hashval, l in self.content_hash.items():
             trimmed_list = []
             for entry in l:
                 if entry.to_delete:
                     entry.mark_for_delete()
-                else:
-                    trimmed_list.append(entry)
+                    if entry.winner is None:
+                        continue
+                trimmed_list.append(entry)
             # store the trimmed list
             if len(trimmed_list) > 0:
                 self.content_hash[hashval] = trimmed_list
@@ -87,6 +116,23 @@ class HashMap:
         for entry in delete_list:
             del self.content_hash[entry]
 
+    # HashMap.losers
+    def losers(self, winner_name, digests):
+        """Returns the entries which lost to winner_name in the buckets
+        of digests, leaving out those within a directory deleted as a
+        whole.  This is how the report finds them, one winner at a time,
+        rather than listing every loser as it is marked.
+        """
+        losers = []
+        for digest in digests:
+            for entry in self.content_hash.get(digest, []):
+                if (entry.to_delete and entry.winner is not None
+                        and entry.winner.pathname == winner_name
+                        and (entry.parent is None
+                             or not entry.parent.to_delete)):
+                    losers.append(entry)
+        return losers
+
     # HashMap.resolve_candidates
     def resolve_candidates(self, candidates):
         """Helper function which examines a list of candidate objects with
@@ -95,11 +141,14 @@ class HashMap:
         are designated losers.  The winner is selected by comparing the
         depths of the candidates.  If reverse_selection is true, the deepest
         candidate is chosen, else the shallowest is chosen.  In the case
-        of a tie, the length of the full path is compared.
+        of a tie, the length of the full path is compared.  Protected
+        candidates are always preferred, and never designated losers.
+        Neither is a candidate holding the winner of an earlier decision;
+        it is preferred as the winner next, since it has to stay anyway.
         """
-        candidates.sort(
-            key=operator.attrgetter('depth', 'pathnamelen', 'pathname'),
-            reverse=self.args.reverse_selection)
+        rank_candidates(candidates, self.args.reverse_selection)
+        candidates.sort(key=lambda x: (not x.protected,
+                                       id(x) not in self.kept))
 
         winner = candidates.pop(0)
 
@@ -107,31 +156,132 @@ class HashMap:
             # we trim empty directories using DirObj.prune_empty()
             # because it produces less confusing output.
             # we also trim empty files elsewhere.
-            return
+            return []
 
         # mark all the other candidates as losers
+        losers = []
         for candidate in candidates:
-            if candidate != winner:
-                if not candidate.to_delete:
+            if candidate != winner and not candidate.protected:
+                if not candidate.to_delete and id(candidate) not in self.kept:
                     candidate.mark_for_delete()
                     candidate.winner = winner
+                    losers.append(candidate)
+        if len(losers) > 0:
+            self.keep(winner)
+        return losers
 
     # HashMap.resolve
     def resolve(self):
         """Compares all entries and where hash collisions exists, pick a
-        keeper.
+        keeper.  Returns the number of entries marked for deletion.
         """
         prev_deleted = self.all_files.count_deleted()
+        for _ in self.resolve_iter():
+            pass
+        return self.all_files.count_deleted() - prev_deleted
 
-        # do away with hash values that have no duplicates:
-        self.content_hash = {k: v for k,
-                             v in self.content_hash.items() if len(v) != 1}
+    # HashMap.resolve_iter
+    def resolve_iter(self):
+        """A generator which does the work of resolve(), yielding
+        (hashval, losers) as each bucket is resolved, and (None, dirs)
+        whenever directories are found empty.  Marks are never undone,
+        so whatever is yielded is final.
 
-        for _, candidates in self.content_hash.items():
-            self.resolve_candidates(candidates)
+        This is repeated until nothing more gets marked, but only for
+        what could have changed: whenever an entry is marked for
+        deletion (as a loser, or as an empty directory) the digests of
+        the directories above it are recomputed from what survives
+        within them, and only the buckets those directories land in are
+        resolved again.
+        """
+        # dicts rather than sets, so buckets are resolved in a stable
+        # order: the outcome mustn't depend on PYTHONHASHSEED
+        dirty = dict.fromkeys(k for k, v in self.content_hash.items()
+                              if len(v) > 1)
+        first_pass = True
+        while True:
+            marked = []
+            for hashval in dirty:
+                # losers stay in the bucket, see losers()
+                candidates = [x for x in self.content_hash[hashval]
+                              if not x.to_delete]
+                if len(candidates) > 1:
+                    losers = self.resolve_candidates(list(candidates))
+                    if len(losers) > 0:
+                        marked.extend(losers)
+                        yield hashval, losers
+            if not self.args.keep_empty_dirs:
+                pruned = []
+                if first_pass:
+                    for _, e in self.all_files.contents.items():
+                        if isinstance(e, DirObj):
+                            pruned.extend(e.prune_empty())
+                else:
+                    pruned = self.prune_around(marked)
+                if len(pruned) > 0:
+                    marked.extend(pruned)
+                    yield None, pruned
+            first_pass = False
+            dirty = self.refinalize(marked)
+            if len(dirty) == 0:
+                break
 
         self.prune()
 
-        return self.all_files.count_deleted() - prev_deleted
+    # HashMap.prune_around
+    def prune_around(self, marked):
+        """Like DirObj.prune_empty(), but only looks above the entries
+        which were just marked, since nothing else can have become
+        empty.  Returns a list of the directories it marked.
+        """
+        pruned = []
+        for entry in marked:
+            shallowest = None
+            dir_entry = entry.parent
+            while (dir_entry is not None
+                   and not dir_entry.to_delete
+                   and dir_entry.is_empty()):
+                shallowest = dir_entry
+                dir_entry = dir_entry.parent
+            if shallowest is not None:
+                shallowest.mark_for_delete()
+                pruned.append(shallowest)
+        return pruned
+
+    # HashMap.refinalize
+    def refinalize(self, marked):
+        """Recomputes the digests of the directories above the marked
+        entries, deepest first, moving each to its new bucket.  Returns
+        the buckets which may now hold new duplicates.
+        """
+        dirty = {}
+        heap = []
+        queued = set()
+        for entry in marked:
+            parent = entry.parent
+            if parent is not None and id(parent) not in queued:
+                queued.add(id(parent))
+                heapq.heappush(heap, (-len(parent.get_lineage()),
+                                      parent.pathname, id(parent), parent))
+        while len(heap) > 0:
+            _, _, _, dir_entry = heapq.heappop(heap)
+            if dir_entry.to_delete:
+                continue
+            old_digest = dir_entry.hexdigest
+            dir_entry.finalize()
+            if dir_entry.hexdigest == old_digest:
+                continue
+            if dir_entry in self.content_hash[old_digest]:
+                self.content_hash[old_digest].remove(dir_entry)
+            bucket = self.content_hash[dir_entry.hexdigest]
+            bucket.append(dir_entry)
+            if len(bucket) > 1:
+                dirty[dir_entry.hexdigest] = None
+            parent = dir_entry.parent
+            if parent is not None and id(parent) not in queued:
+                queued.add(id(parent))
+                heapq.heappush(heap, (-len(parent.get_lineage()),
+                                      parent.pathname, id(parent), parent))
+        return dirty
 
 # vim: set expandtab sw=4 ts=4:
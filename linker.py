@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module describes the LinkExecutor, which (with --link-mode)
+    replaces redundant files with hard links to, or reflink clones of,
+    the copy being kept, instead of generating commands to remove them.
+"""
+
+import os
+import sys
+import stat
+import time
+import errno
+from fileobj import FileObj
+from compare import verify_files
+from report import sizeof_fmt
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+LINK_MODES = ['hardlink', 'reflink']
+
+# _IOW(0x94, 9, int) from linux/fs.h: make the destination share the
+# source's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# links are made under this name (plus the pid and a counter) before
+# being renamed over the file they replace
+TEMP_PREFIX = '.dedup-link-'
+
+
+def quoted(pathname):
+    """quotes a pathname for a comment, like generate_delete() does"""
+    if any((c in "'()") for c in pathname):
+        return '"' + pathname + '"'
+    return "'" + pathname + "'"
+
+
+class LinkExecutor():
+    """Swaps files for links to an identical file, in a single batch.
+
+    Each file is re-checked immediately before it is swapped: if it or
+    its target no longer has the size and modification time seen when
+    it was hashed, it is left alone.  The link is made under a
+    temporary name in the same directory and then renamed over the
+    file, so the pathname always exists, holding one copy or the other.
+    """
+
+    def __init__(self, args, throttle=None, outfile=sys.stdout):
+        self.args = args
+        self.throttle = throttle
+        self.outfile = outfile
+        # list of (file, file to link it to)
+        self.swaps = []
+        # devices which turned out not to support reflinks
+        self.unsupported = set()
+        self.linked = 0
+        self.linked_bytes = 0
+        self.skipped = 0
+        self.failed = 0
+        # makes the temporary names unique, see link_beside()
+        self.temp_count = 0
+
+    # LinkExecutor.plan
+    def plan(self, all_files):
+        """Pairs every file marked for deletion with a surviving file
+        holding the same contents, as found by HashMap.resolve().  Whole
+        directories marked for deletion are taken file by file.
+
+        Links can't cross filesystems, so a file is linked to a copy on
+        its own device; where there is none, the first such file is
+        kept and the others are linked to it.
+        """
+        survivors = {}
+        losers = []
+        for _, e in all_files.contents.items():
+            if isinstance(e, FileObj):
+                file_list = [e]
+            else:
+                file_list = [f for dir_entry in e.dirwalk(topdown=True)
+                             for _, f in sorted(dir_entry.files.items())]
+            for f in file_list:
+                if f.bytes == 0 or f.hexdigest is None:
+                    continue
+                if f.to_delete:
+                    losers.append(f)
+                else:
+                    survivors.setdefault((f.hexdigest, f.device), f)
+        for f in losers:
+            key = (f.hexdigest, f.device)
+            if key not in survivors:
+                survivors[key] = f
+            elif survivors[key].inode != f.inode:
+                self.swaps.append((f, survivors[key]))
+
+    # LinkExecutor.unchanged
+    def unchanged(self, f):
+        """true if f still looks as it did when it was hashed"""
+        try:
+            stat_result = os.lstat(f.pathname)
+        except OSError:
+            return False
+        return (stat.S_ISREG(stat_result.st_mode)
+                and stat_result.st_size == f.bytes
+                and stat_result.st_mtime == f.mod_time)
+
+    # LinkExecutor.make_link
+    def make_link(self, f, target, temp_name):
+        """Creates temp_name as a hard link to, or reflink clone of,
+        target.  A clone keeps the permissions and times of f.
+        """
+        if self.args.link_mode == 'hardlink':
+            os.link(target.pathname, temp_name)
+            return
+        src_fd = os.open(target.pathname, os.O_RDONLY)
+        try:
+            dst_fd = os.open(temp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                stat_result = os.stat(f.pathname)
+                try:
+                    os.fchown(dst_fd, stat_result.st_uid, stat_result.st_gid)
+                except PermissionError:
+                    pass
+                os.fchmod(dst_fd, stat.S_IMODE(stat_result.st_mode))
+                os.utime(dst_fd, ns=(stat_result.st_atime_ns,
+                                     stat_result.st_mtime_ns))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    # LinkExecutor.link_beside
+    def link_beside(self, f, target):
+        """Links target to a new temporary name in the directory of f,
+        and returns that name.  Names already taken (a file of our own,
+        another dedup, or one left over by an interrupted run) are
+        skipped, never overwritten.
+        """
+        directory = os.path.dirname(f.pathname)
+        while True:
+            self.temp_count = self.temp_count + 1
+            temp_name = os.path.join(directory, TEMP_PREFIX +
+                                     str(os.getpid()) + '-' +
+                                     str(self.temp_count))
+            try:
+                self.make_link(f, target, temp_name)
+            except FileExistsError:
+                continue
+            except BaseException:
+                if os.path.lexists(temp_name):
+                    os.remove(temp_name)
+                raise
+            return temp_name
+
+    # LinkExecutor.swap
+    def swap(self, f, target):
+        """Replaces f with a link to target.  Returns True once done."""
+        if f.device in self.unsupported:
+            self.skipped = self.skipped + 1
+            return False
+        if self.throttle is not None:
+            self.throttle.op(2)
+        if not self.unchanged(f) or not self.unchanged(target):
+            print('# skipped ' + quoted(f.pathname) +
+                  ': changed since it was hashed', file=self.outfile)
+            self.skipped = self.skipped + 1
+            return False
+        if (self.args.verify
+                and not verify_files(target, f, self.throttle)):
+            print('# skipped ' + quoted(f.pathname) + ': --verify found ' +
+                  'it does not match ' + quoted(target.pathname),
+                  file=self.outfile)
+            self.skipped = self.skipped + 1
+            return False
+        temp_name = None
+        try:
+            temp_name = self.link_beside(f, target)
+            os.replace(temp_name, f.pathname)
+            temp_name = None
+        except OSError as e:
+            if self.args.link_mode == 'reflink' and e.errno in (
+                    errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV):
+                print('WARNING: the filesystem holding ' + f.pathname +
+                      ' does not support reflinks, skipping it',
+                      file=sys.stderr)
+                self.unsupported.add(f.device)
+            else:
+                print('WARNING: could not link ' + f.pathname + ': ' +
+                      str(e), file=sys.stderr)
+            self.failed = self.failed + 1
+            return False
+        finally:
+            # whatever went wrong, the link made under a temporary
+            # name goes (and it was ours: the name didn't exist before)
+            if temp_name is not None and os.path.lexists(temp_name):
+                os.remove(temp_name)
+        return True
+
+    # LinkExecutor.run
+    def run(self):
+        """carries out every planned swap, logging each as a comment"""
+        verb = 'hard linked ' if self.args.link_mode == 'hardlink' \
+            else 'reflinked '
+        for f, target in self.swaps:
+            if self.swap(f, target):
+                print('# ' + verb + quoted(f.pathname) + ' to ' +
+                      quoted(target.pathname), file=self.outfile)
+                self.linked = self.linked + 1
+                self.linked_bytes = self.linked_bytes + f.bytes
+        return self.failed == 0
+
+
+def link_redundant(all_files, outfile, start_time):
+    """--link-mode: links every redundant file to a kept copy in place,
+    rather than generating a script to remove them.  Returns -1 if any
+    link could not be made.
+    """
+    if all_files.args.link_mode == 'reflink' and fcntl is None:
+        print('\nFATAL: --link-mode reflink is not supported here',
+              file=sys.stderr)
+        sys.exit(-1)
+    executor = LinkExecutor(all_files.args, all_files.throttle, outfile)
+    executor.plan(all_files)
+    print("\n" + '#' * 72, file=outfile)
+    print('# ' + str(len(executor.swaps)) + ' files to replace with a ' +
+          all_files.args.link_mode, file=outfile)
+    ok = executor.run()
+    end_time = time.time()
+    print('\n# ' + str(executor.linked) + ' files (' +
+          sizeof_fmt(executor.linked_bytes) + ') linked, ' +
+          str(executor.skipped) + ' skipped, ' + str(executor.failed) +
+          ' failed', file=outfile)
+    print('# total dedup running time: ' +
+          str(end_time - start_time) + ' seconds.', file=outfile)
+    if not ok:
+        return -1
+    return 0
+
+# vim: set expandtab sw=4 ts=4:
@@ -5,9 +5,13 @@
 
    this whole thing should be refactored for OOP
 """
+import os
 import sys
 import time
+import heapq
 from itertools import chain
+from operator import itemgetter
+from chunker import ChunkIndex
 from collections import defaultdict
 
 
@@ -21,6 +25,23 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+def parse_size(text):
+    """helper function to convert values like '10M' or '1.5GiB' to a
+    number of bytes.  The inverse of sizeof_fmt(), more or less.
+    """
+    prefix_list = ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']
+    text = text.strip().upper()
+    for suffix in ('IB', 'B'):
+        if text.endswith(suffix) and len(text) > len(suffix):
+            text = text[:-len(suffix)]
+            break
+    multiplier = 1
+    if text and text[-1] in prefix_list[1:]:
+        multiplier = pow(1024, prefix_list.index(text[-1]))
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+
 def generate_delete(filename, outfile):
     """generates not-quite-safe rm commands.  TODO does not handle
     pathnames which contain both the ' and " characters.
@@ -33,62 +54,117 @@ def generate_delete(filename, outfile):
         print("rm -rf '" + filename + "'", file=outfile)
 
 
-def synthesize_report(results):
-    """transforms a results object into a report structure"""
-    winner_list = []
-    all_marked_bytes = 0
-    all_marked_count = 0
-    for winner_name, loser_list in results.items():
-        marked_count = len(loser_list)
-        all_marked_count = all_marked_count + marked_count
-        total_marked_bytes = 0
-        if marked_count > 0:
-            loser_list.sort(key=lambda x: x.pathname)
-            for loser in loser_list:
-                total_marked_bytes = total_marked_bytes + \
-                    loser.count_bytes(True)
-        all_marked_bytes = all_marked_bytes + total_marked_bytes
-        new_result = {}
-        new_result['winner_name'] = winner_name
-        new_result['marked_count'] = marked_count
-        new_result['total_marked_bytes'] = total_marked_bytes
-        new_result['loser_list'] = loser_list
-        winner_list.append(new_result)
-
-    # set the order to present each result from this report:
-    winner_list.sort(key=lambda x: x['total_marked_bytes'], reverse=True)
-    return winner_list, all_marked_bytes, all_marked_count
-
-
-def synthesize_reports(report_map):
-    """transforms a results object into several report structures,
-    each of which reflects a category of file or dir to be deleted"""
-    report_list = []
-    for report_name, report in report_map.items():
-        new_report = {}
-        new_report['report_name'] = report_name
-        win = 'winner_list'
-        total = 'total_marked_bytes'
-        marked = 'marked_count'
-        new_report[win], new_report[total], new_report[marked] = synthesize_report(
-            report)
-        report_list.append(new_report)
-
-    report_list.sort(key=lambda x: x['total_marked_bytes'], reverse=True)
-    return report_list
-
-
-def generate_map_commands(report, empty_report_names, outfile):
+class ReportMap():
+    """One category of entries to delete, indexed by "winner".
+
+    Only the bytes and number of losers of each winner are totalled as
+    they are added, which is all it takes to order the report.  The
+    losers themselves aren't kept: sections() asks find_losers for
+    those of one winner at a time, as its section is written (see
+    generate_reports()).
+    """
+
+    def __init__(self, report_name, find_losers=None):
+        self.report_name = report_name
+        # called as find_losers(winner name, digests) for the losers of
+        # a winner
+        self.find_losers = find_losers
+        # winner name -> the digests of its losers
+        self.digests = defaultdict(lambda: set())
+        # winner name -> total bytes of its losers
+        self.marked_bytes = defaultdict(lambda: 0)
+        # winner name -> number of losers
+        self.marked_counts = defaultdict(lambda: 0)
+        self.total_marked_bytes = 0
+        self.marked_count = 0
+
+    # ReportMap.add
+    def add(self, winner_name, loser):
+        """records a loser.  Deleted directories always go with
+        everything in them, so their size is loser.bytes.
+        """
+        self.marked_bytes[winner_name] = \
+            self.marked_bytes[winner_name] + loser.bytes
+        self.marked_counts[winner_name] = \
+            self.marked_counts[winner_name] + 1
+        self.total_marked_bytes = self.total_marked_bytes + loser.bytes
+        self.marked_count = self.marked_count + 1
+        self.digests[winner_name].add(loser.hexdigest)
+
+    # ReportMap.winners
+    def winners(self, top=None):
+        """A generator yielding (winner name, bytes) for the winners
+        which save the most, in that order.  Only the first top are
+        selected, if given; otherwise they are popped off a heap as
+        the caller consumes them.
+        """
+        if top is not None:
+            for winner_name, marked_bytes in heapq.nlargest(
+                    top, self.marked_bytes.items(), key=itemgetter(1)):
+                yield winner_name, marked_bytes
+            return
+        heap = [(-b, winner_name)
+                for winner_name, b in self.marked_bytes.items()]
+        heapq.heapify(heap)
+        while len(heap) > 0:
+            b, winner_name = heapq.heappop(heap)
+            yield winner_name, -b
+
+    # ReportMap.sections
+    def sections(self, top=None):
+        """A generator yielding (winner name, bytes, count, losers) in
+        the order of winners(), the losers sorted by pathname.  They are
+        only looked up as each winner comes up, and not at all with top
+        (losers is None), which only summarizes.
+        """
+        for winner_name, marked_bytes in self.winners(top):
+            digests = self.digests.pop(winner_name)
+            losers = None
+            if top is None and self.find_losers is not None:
+                losers = sorted(self.find_losers(winner_name, digests),
+                                key=lambda x: x.pathname)
+            del self.marked_bytes[winner_name]
+            yield (winner_name, marked_bytes,
+                   self.marked_counts.pop(winner_name), losers)
+
+
+class LoserList():
+    """Stands in for a ReportMap when walking the tree again, keeping
+    the losers of a single winner (see walk_losers())
+    """
+
+    def __init__(self, winner_name=None):
+        self.winner_name = winner_name
+        self.losers = []
+
+    # LoserList.add
+    def add(self, winner_name, loser):
+        if winner_name == self.winner_name:
+            self.losers.append(loser)
+
+
+def walk_losers(all_files, report_name, winner_name):
+    """finds the losers of a winner in report_name by walking the tree
+    again, as generate_reports() first did
+    """
+    reports = defaultdict(LoserList)
+    reports[report_name] = LoserList(winner_name)
+    for _, e in all_files.contents.items():
+        e.generate_reports(reports)
+    return reports[report_name].losers
+
+
+def generate_map_commands(report, empty_report_names, outfile, top=None):
     """transforms an analyzer report into a script that can be
-    easily reviewed"""
-    winner_list = report['winner_list']
-    win_count = len(winner_list)
+    easily reviewed.  With top, only summarizes the top winners.
+    """
+    win_count = len(report.marked_bytes)
     # dont generate empty sections
     if win_count == 0:
         return
-    report_name = report['report_name']
-    total_marked_bytes = report['total_marked_bytes']
-    marked_count = report['marked_count']
+    report_name = report.report_name
+    total_marked_bytes = report.total_marked_bytes
+    marked_count = report.marked_count
 
     print("\n" + '#' * 72, file=outfile)
     if report_name in empty_report_names:
@@ -102,15 +178,41 @@ def generate_map_commands(report, empty_report_names, outfile):
         print('# This section could make ' +
               sizeof_fmt(total_marked_bytes) + ' of file data redundant', file=outfile)
 
-    for winner in winner_list:
+    for winner_name, marked_bytes, count, losers in report.sections(top):
         print("\n# This subsection could save " +
-              sizeof_fmt(winner['total_marked_bytes']), file=outfile)
+              sizeof_fmt(marked_bytes), file=outfile)
         if report_name not in empty_report_names:
-            print("#      '" + winner['winner_name'] + "'", file=outfile)
-        for loser in winner['loser_list']:
+            print("#      '" + winner_name + "'", file=outfile)
+        if top is not None:
+            print('#      ' + str(count) + ' to remove', file=outfile)
+            continue
+        for loser in losers:
             generate_delete(loser.pathname, outfile)
 
 
+def generate_partial_report(chunked, outfile):
+    """reports pairs of (surviving) files which share most of their
+    chunks.  These are only listed, never removed.
+    """
+    index = ChunkIndex()
+    for f in chunked:
+        if not f.to_delete:
+            index.add(f)
+    pairs = index.pairs()
+    if len(pairs) == 0:
+        return
+    print("\n" + '#' * 72, file=outfile)
+    print('# partially duplicated files: ' + str(len(pairs)) +
+          ' pairs to review by hand', file=outfile)
+    print('# These pairs share ' +
+          sizeof_fmt(sum(x[0] for x in pairs)) + ' of file data', file=outfile)
+    for shared_bytes, f, g in pairs:
+        print('#   %5.1f%% shared (%s): ' %
+              (100.0 * shared_bytes / max(f.bytes, g.bytes),
+               sizeof_fmt(shared_bytes)) +
+              "'" + f.pathname + "' and '" + g.pathname + "'", file=outfile)
+
+
 def generate_reports(all_files, outfile, start_time):
     """
     transforms an annotated structure describing all analyzed files and dirs
@@ -119,30 +221,87 @@ def generate_reports(all_files, outfile, start_time):
     """
     # a list of report names we will generate.  Note that these are later
     # indexed elsewhere, so be careful renaming
-    regular_report_names = ['directories', 'files']
+    regular_report_names = ['directories', 'files', 'archives']
     empty_report_names = ['directories that are empty after reduction',
                           'directories that started empty', 'empty files']
 
     # create each category for files to delete in its own report.
-    # reports are a dict indexed by "winner" that points to a metadata
-    # and a list of losers
+    # reports are indexed by "winner", see ReportMap.  The losers of
+    # each winner are only looked up as its section is written: those
+    # of duplicates in the buckets of the HashMap which resolved them,
+    # those of archives among the redundant archives, and empty
+    # entries (which all share a single winner) by walking the tree.
+    top = all_files.args.top
+    hash_map = all_files.hash_map
+
+    def find_matched(winner_name, digests):
+        return hash_map.losers(winner_name, digests)
+
+    def find_archives(winner_name, digests):
+        return [f for f in all_files.redundant_archives
+                if f.winner.pathname == winner_name
+                and (f.parent is None or not f.parent.to_delete)]
+
+    def find_walked(report_name):
+        return lambda winner_name, digests: walk_losers(
+            all_files, report_name, winner_name)
+
     report_maps = {}
     for report_name in chain(regular_report_names, empty_report_names):
-        report_maps[report_name] = defaultdict(lambda: [])
+        if report_name == 'archives':
+            find_losers = find_archives
+        elif report_name in regular_report_names:
+            find_losers = find_matched
+        else:
+            find_losers = find_walked(report_name)
+        report_maps[report_name] = ReportMap(report_name, find_losers)
+
+    # before any output is written:
+    if all_files.args.verify:
+        all_files.verify_marked()
 
     for _, e in all_files.contents.items():
         e.generate_reports(report_maps)
 
-    report_lists = synthesize_reports(report_maps)
+    # set the order to present each report, and write them out
+    for report in sorted(report_maps.values(),
+                         key=lambda x: x.total_marked_bytes, reverse=True):
+        generate_map_commands(report, empty_report_names, outfile, top)
 
-    for report in report_lists:
-        generate_map_commands(report, empty_report_names, outfile)
+    if len(all_files.chunked) > 0:
+        generate_partial_report(all_files.chunked, outfile)
 
     end_time = time.time()
     print('\n# total file data bytes marked for deletion ' +
           sizeof_fmt(all_files.count_bytes(deleted=True)), file=outfile)
     print('# total dedup running time: ' +
           str(end_time - start_time) + ' seconds.', file=outfile)
+    if len(all_files.unverified) > 0:
+        sizes = set(f.bytes for f in all_files.unverified)
+        print('# budget exhausted: ' + str(len(all_files.unverified)) +
+              ' files (' + sizeof_fmt(sum(f.bytes for f in all_files.unverified)) +
+              ') in ' + str(len(sizes)) +
+              ' size groups were not hashed, and were left alone.',
+              file=outfile)
+    if all_files.checkpoint is not None:
+        print('# checkpointing: ' + str(all_files.checkpoint.saves) +
+              ' saves, ' + str(all_files.checkpoint.save_time) +
+              ' seconds.', file=outfile)
+    if all_files.scheduler is not None:
+        for device, budget in sorted(all_files.scheduler.budgets.items()):
+            print('# device ' + str(os.major(device)) + ':' +
+                  str(os.minor(device)) + ': ' +
+                  str(all_files.scheduler.scheduled[device]) +
+                  ' files read in on-disk order, finished with ' +
+                  str(budget.level) + ' concurrent readers (peak ' +
+                  str(budget.peak) + ', ' + str(budget.increases) +
+                  ' increases, ' + str(budget.decreases) + ' decreases).',
+                  file=outfile)
+    if all_files.throttle is not None:
+        print('# time spent throttled: ' +
+              str(all_files.throttle.throttled_time) + ' seconds (' +
+              str(all_files.throttle.backoffs) + ' latency backoffs).',
+              file=outfile)
 
     # safe to ignore the following, just here to flex a helper function:
     ignore_this = sizeof_fmt(pow(1024, 8))
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module describes the RuleSet object, which decides during the
+    walk which files and directories to ignore, exclude or protect.
+"""
+
+import re
+import sys
+import fnmatch
+from json import loads
+from report import parse_size
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+# What a rule can do to a matching entry, in order of precedence:
+#
+#   protect - scan it, but never mark it (or anything containing it) for
+#             deletion.
+#   exclude - don't descend into it or hash it, and don't touch it.  The
+#             directory containing it will never be deleted.
+#   ignore  - cruft: don't descend into it or hash it, and don't let it
+#             keep its parent directory from being deleted.
+ACTIONS = ['protect', 'exclude', 'ignore']
+
+# which kinds of entry a rule may apply to:
+TYPES = ['file', 'dir']
+
+# the keys a rule may use to match entries:
+MATCHERS = ['name', 'path', 'name_regex', 'path_regex']
+
+# characters which make a name pattern a glob rather than a literal:
+GLOB_CHARS = set('*?[')
+
+
+class RuleSet():
+    """A compiled set of rules.
+
+    Rules are loaded from a JSON file shaped like this:
+
+        {
+            "min_size": "4K",
+            "rules": [
+                {"action": "exclude", "type": "dir", "name": "node_modules"},
+                {"action": "exclude", "path": "*/build/*.o"},
+                {"action": "protect", "name_regex": "\\\\.lock$"},
+                {"action": "exclude", "name": "*.iso", "min_size": "4G"}
+            ]
+        }
+
+    Literal names are kept in sets, and every other pattern sharing an
+    action, type and target is folded into a single compiled regex, so
+    matching an entry costs a few set lookups and regex searches no
+    matter how many rules there are.  Rules with a size range only apply
+    to files (a "dir" type is refused), and are only consulted after they
+    are stat'd.
+    """
+
+    def __init__(self, rules, min_size=0):
+        self.min_size = min_size
+        # (action, type) -> set of literal names
+        self.literals = {}
+        # (action, type, 'name'|'path') -> list of regex sources
+        sources = {}
+        # rules which also need a file size:
+        # (action, target, regex, lo, hi)
+        self.sized = []
+
+        for rule in rules:
+            action = rule.get('action', 'exclude')
+            if action not in ACTIONS:
+                raise ValueError('unknown rule action: ' + str(action))
+            types = TYPES
+            if 'type' in rule:
+                if rule['type'] not in TYPES:
+                    raise ValueError('unknown rule type: ' + str(rule['type']))
+                types = [rule['type']]
+
+            matchers = [k for k in MATCHERS if k in rule]
+            if len(matchers) > 1:
+                raise ValueError('a rule may only use one of ' +
+                                 ', '.join(MATCHERS))
+
+            lo = rule.get('min_size')
+            hi = rule.get('max_size')
+            if lo is not None or hi is not None:
+                if 'file' not in types:
+                    raise ValueError('a size range only applies to files: ' +
+                                     str(rule))
+                if lo is not None:
+                    lo = parse_size(str(lo))
+                if hi is not None:
+                    hi = parse_size(str(hi))
+                target = 'name'
+                source = ''
+                if len(matchers) == 1:
+                    target, source = rule_source(matchers[0], rule)
+                self.sized.append((action, target, re.compile(source),
+                                   lo, hi))
+                continue
+
+            if len(matchers) == 0:
+                raise ValueError('rule matches nothing: ' + str(rule))
+            matcher = matchers[0]
+            for typ in types:
+                if matcher == 'name' and not GLOB_CHARS & set(rule['name']):
+                    self.literals.setdefault((action, typ), set()).add(
+                        rule['name'])
+                    continue
+                target, source = rule_source(matcher, rule)
+                sources.setdefault((action, typ, target), []).append(source)
+
+        self.patterns = {}
+        for key, source_list in sources.items():
+            self.patterns[key] = re.compile('|'.join(
+                '(?:' + source + ')' for source in source_list))
+        self.sized.sort(key=lambda x: ACTIONS.index(x[0]))
+
+    # RuleSet.from_args
+    @staticmethod
+    def from_args(args, default_rules):
+        """Builds the RuleSet for a run: the built-in rules, followed by
+        those from --rules, and the --min-size threshold.
+        """
+        rules = list(default_rules)
+        min_size = args.min_size or 0
+        if args.rules is not None:
+            try:
+                config = loads(open(args.rules).read())
+            except (OSError, ValueError) as e:
+                print('\nFATAL: could not load rules from ' + args.rules +
+                      ': ' + str(e), file=sys.stderr)
+                sys.exit(-1)
+            rules.extend(config.get('rules', []))
+            if 'min_size' in config and not args.min_size:
+                min_size = parse_size(str(config['min_size']))
+        try:
+            return RuleSet(rules, min_size)
+        except (ValueError, re.error) as e:
+            print('\nFATAL: bad rule in ' + str(args.rules) + ': ' + str(e),
+                  file=sys.stderr)
+            sys.exit(-1)
+
+    # RuleSet.match
+    def match(self, typ, name, pathname):
+        """Returns the action for an entry of the given type, or None if
+        no (size independent) rule applies to it.
+        """
+        for action in ACTIONS:
+            literals = self.literals.get((action, typ))
+            if literals is not None and name in literals:
+                return action
+            pattern = self.patterns.get((action, typ, 'name'))
+            if pattern is not None and pattern.search(name):
+                return action
+            pattern = self.patterns.get((action, typ, 'path'))
+            if pattern is not None and pattern.search(pathname):
+                return action
+        return None
+
+    # RuleSet.match_size
+    def match_size(self, name, pathname, size):
+        """Returns the action for a file of the given size, or None.
+        Non-empty files smaller than --min-size are excluded: they are
+        not hashed, but still keep their directory.
+        """
+        for action, target, pattern, lo, hi in self.sized:
+            if lo is not None and size < lo:
+                continue
+            if hi is not None and size > hi:
+                continue
+            if target == 'name' and pattern.search(name):
+                return action
+            if target == 'path' and pattern.search(pathname):
+                return action
+        if 0 < size < self.min_size:
+            return 'exclude'
+        return None
+
+
+def rule_source(matcher, rule):
+    """returns the target ('name' or 'path') and the regex source for
+    a rule's matcher.  Globs must match the whole name or path, regexes
+    may match any part of it.
+    """
+    if matcher == 'name':
+        return 'name', '^' + fnmatch.translate(rule['name'])
+    if matcher == 'path':
+        return 'path', '^' + fnmatch.translate(rule['path'])
+    if matcher == 'name_regex':
+        return 'name', rule['name_regex']
+    return 'path', rule['path_regex']
+
+# vim: set expandtab sw=4 ts=4:
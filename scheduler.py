@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module describes the HashScheduler, which orders pending hash
+    work to minimize seeking on spinning disks, and the DeviceBudget
+    which sets how much of it runs at once on each device.
+"""
+
+import os
+import time
+import struct
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from hashdbobj import compute_hash
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+# linux FIEMAP ioctl, see linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+
+# struct fiemap header: start, length, flags, mapped_extents,
+# extent_count, reserved
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+
+# struct fiemap_extent: logical, physical, length, 2 reserved,
+# flags, 3 reserved
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+# how long a DeviceBudget measures before adjusting its level:
+BUDGET_WINDOW = 0.5
+
+# a drop in throughput bigger than this is taken as congestion...
+BUDGET_DROP = 0.1
+
+# ...as is the time per byte read growing to this multiple of the best
+# seen, unless throughput grew as well:
+BUDGET_LATENCY_FACTOR = 2.0
+
+# an extra reader is only kept, and another one tried, if throughput
+# grew by more than this:
+BUDGET_GAIN = 0.1
+
+# how many windows a device stays at a level before trying one more
+# reader again:
+BUDGET_PROBE_WINDOWS = 20
+
+
+def physical_offset(pathname):
+    """Returns the physical byte offset of the first extent of a file,
+    using the FIEMAP ioctl.  Returns None if the platform or filesystem
+    doesn't support FIEMAP, or the file has no extents (empty files,
+    data inlined in the inode, ...).
+    """
+    if fcntl is None:
+        return None
+    buf = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        fd = os.open(pathname, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    mapped_extents = FIEMAP_HEADER.unpack_from(buf, 0)[3]
+    if mapped_extents == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)[1]
+
+
+class DeviceBudget():
+    """Decides how many files are read at once from one device.
+
+    Starts with a single reader, and every BUDGET_WINDOW seconds
+    compares the throughput and latency (time per byte) of the window
+    that just ended with what was seen before.  One more reader is
+    tried at a time (additive increase): it is kept, and another one
+    tried, only if throughput grew by BUDGET_GAIN, and withdrawn
+    otherwise.  A device which gains nothing stays put, trying again
+    every BUDGET_PROBE_WINDOWS windows.  When throughput drops, or
+    latency balloons without any gain in throughput, the device is
+    taken to be congested and the number of readers is halved
+    (multiplicative decrease).  Spinning disks stay at one reader,
+    SSDs and network mounts climb as far as it pays off.
+    """
+
+    def __init__(self, device, max_level):
+        self.device = device
+        self.max_level = max_level
+        self.level = 1
+        self.peak = 1
+        self.increases = 0
+        self.decreases = 0
+        self.active = 0
+        self.cond = threading.Condition()
+        self.last_rate = None
+        self.best_latency = None
+        # whether the last window ran with a reader on trial
+        self.probing = False
+        # windows since the level last changed
+        self.steady = 0
+        self.start_window(time.monotonic())
+
+    # DeviceBudget.start_window
+    def start_window(self, now):
+        """starts a new measurement window"""
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_files = 0
+        self.window_busy = 0.0
+
+    # DeviceBudget.acquire
+    def acquire(self):
+        """waits until another reader is allowed on this device"""
+        with self.cond:
+            while self.active >= self.level:
+                self.cond.wait()
+            self.active = self.active + 1
+
+    # DeviceBudget.release
+    def release(self, nbytes=0, elapsed=None):
+        """a reader is done, having read nbytes in elapsed seconds"""
+        with self.cond:
+            self.active = self.active - 1
+            if elapsed is not None:
+                self.window_bytes = self.window_bytes + nbytes
+                self.window_files = self.window_files + 1
+                self.window_busy = self.window_busy + elapsed
+                now = time.monotonic()
+                if (now - self.window_start >= BUDGET_WINDOW
+                        and self.window_files >= self.level):
+                    self.adjust(now)
+            self.cond.notify_all()
+
+    # DeviceBudget.adjust
+    def adjust(self, now):
+        """the AIMD step, at the end of a measurement window"""
+        rate = self.window_bytes / (now - self.window_start)
+        latency = self.window_busy / max(self.window_bytes, 1)
+        congested = False
+        gained = False
+        if self.last_rate is not None:
+            if rate < self.last_rate * (1 - BUDGET_DROP):
+                congested = True
+            elif (latency > self.best_latency * BUDGET_LATENCY_FACTOR
+                  and rate <= self.last_rate):
+                congested = True
+            gained = rate > self.last_rate * (1 + BUDGET_GAIN)
+        # what the next window is compared with
+        baseline = rate
+        if congested:
+            if self.level > 1:
+                self.level = max(1, self.level // 2)
+                self.decreases = self.decreases + 1
+            self.probing = False
+            self.steady = 0
+        elif self.probing and not gained:
+            # the reader on trial didn't pay off
+            self.level = self.level - 1
+            self.decreases = self.decreases + 1
+            self.probing = False
+            self.steady = 0
+            baseline = self.last_rate
+        elif (self.probing or self.last_rate is None
+              or self.steady >= BUDGET_PROBE_WINDOWS):
+            self.probing = self.level < self.max_level
+            self.steady = 0
+            if self.probing:
+                self.level = self.level + 1
+                self.increases = self.increases + 1
+                self.peak = max(self.peak, self.level)
+        else:
+            self.steady = self.steady + 1
+        self.last_rate = baseline
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        self.start_window(now)
+
+
+class HashScheduler():
+    """Collects files pending a hash and reads them in physical order.
+
+    Every block device gets its own queue, sorted by physical extent
+    offset where FIEMAP is available and by inode number otherwise.
+    The queues are drained concurrently, so several devices are busy at
+    once.  How many files are read at once from each device is decided
+    by its DeviceBudget, up to --device-workers; readers take files
+    from the front of the queue, so reads stay close to sequential.
+    """
+
+    def __init__(self, args, throttle=None, done=None, hash_file=None):
+        self.args = args
+        self.throttle = throttle
+        # called with each file once it has been hashed
+        self.done = done
+        # called to fill in the hexdigest of each file, if not
+        # compute_hash()
+        self.hash_file = hash_file
+        # st_dev -> DeviceBudget, kept for the whole run
+        self.budgets = {}
+        # st_dev -> number of files queued, for the report
+        self.scheduled = defaultdict(lambda: 0)
+
+    # HashScheduler.sort_key
+    def sort_key(self, f):
+        """Orders files with a known physical offset by that offset,
+        followed by the rest in inode order.
+        """
+        offset = physical_offset(f.pathname)
+        if offset is None:
+            return (1, f.inode)
+        return (0, offset)
+
+    # HashScheduler.disk_order
+    def disk_order(self, items, key=lambda x: x):
+        """Sorts items by the device and on-disk position of a file,
+        key(item), for reads which don't go through run(): byte
+        comparisons and --verify.
+        """
+        return sorted(items,
+                      key=lambda item: (key(item).device,) +
+                      self.sort_key(key(item)))
+
+    # HashScheduler.queues
+    def queues(self, files):
+        """Splits files into sorted per-device queues"""
+        by_device = defaultdict(lambda: [])
+        for f in files:
+            by_device[f.device].append(f)
+        for device, queue in by_device.items():
+            queue.sort(key=self.sort_key)
+        return by_device
+
+    # HashScheduler.drain
+    def drain(self, budget, queue, deadline=None):
+        """One reader: hashes files from the front of a device's queue,
+        whenever the device's budget allows it.  Files still queued
+        once deadline (a time.monotonic time) has passed are left
+        unhashed.
+        """
+        while True:
+            budget.acquire()
+            if deadline is not None and time.monotonic() > deadline:
+                budget.release()
+                return
+            try:
+                f = queue.popleft()
+            except IndexError:
+                budget.release()
+                return
+            started = time.monotonic()
+            try:
+                if self.hash_file is not None:
+                    self.hash_file(f)
+                else:
+                    f.hexdigest = compute_hash(f.pathname, self.args,
+                                               self.throttle)
+                if self.done is not None:
+                    self.done(f)
+            except BaseException:
+                budget.release()
+                raise
+            budget.release(f.bytes, time.monotonic() - started)
+
+    # HashScheduler.run
+    def run(self, files, deadline=None):
+        """hashes all files, filling in their hexdigest"""
+        by_device = self.queues(files)
+        if len(by_device) == 0:
+            return
+        workers = []
+        for device, queue in by_device.items():
+            self.scheduled[device] = self.scheduled[device] + len(queue)
+            if device not in self.budgets:
+                self.budgets[device] = DeviceBudget(
+                    device, self.args.device_workers)
+            budget = self.budgets[device]
+            shared_queue = deque(queue)
+            for _ in range(min(budget.max_level, len(queue))):
+                workers.append((budget, shared_queue))
+        with ThreadPoolExecutor(max_workers=len(workers)) as pool:
+            futures = [pool.submit(self.drain, budget, queue, deadline)
+                       for budget, queue in workers]
+            # so that any exception from a worker is raised here
+            for future in futures:
+                future.result()
+
+# vim: set expandtab sw=4 ts=4:
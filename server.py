@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module describes the QueryIndex, and the Unix domain socket
+    server which answers "do we already have this file?" from it.
+"""
+
+import os
+import sys
+import stat
+import json
+import signal
+import socketserver
+from fileobj import FileObj, path_depth
+from dirlist import DirList
+from hashmap import HashMap, rank_candidates
+from hashdbobj import HashDbObj, nuke_database
+
+
+class IndexEntry():
+    """What the QueryIndex knows about a file found in the hash cache.
+    Has the attributes rank_candidates() sorts on, computed the same
+    way FileObj does for a walked file with no weight.
+    """
+
+    def __init__(self, pathname, size):
+        self.pathname = pathname
+        self.pathnamelen = len(pathname)
+        self.depth = path_depth(pathname)
+        self.bytes = size
+        self.protected = False
+
+
+class QueryIndex():
+    """An in-memory index of file contents, by digest and by path.
+
+    Every bucket of files sharing a digest is ranked once, when the
+    index is loaded, with the same ordering HashMap.resolve_candidates()
+    uses.  So the first entry is the file a dedup run would keep, and
+    answering a query is a couple of dict lookups.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        # digest -> list of entries, winner first
+        self.by_digest = {}
+        # pathname -> digest
+        self.by_path = {}
+
+    # QueryIndex.from_hashmap
+    @staticmethod
+    def from_hashmap(hm, args):
+        """indexes every file in a (not yet resolved) HashMap"""
+        index = QueryIndex(args)
+        for hashval, entries in hm.content_hash.items():
+            if hashval.startswith(b'unverified:'):
+                continue
+            for entry in entries:
+                if isinstance(entry, FileObj) and entry.bytes > 0:
+                    index.add(hashval, entry)
+        index.rank()
+        return index
+
+    # QueryIndex.from_db
+    @staticmethod
+    def from_db(db, args):
+        """indexes every file in the hash cache which still exists and
+        hasn't been modified since it was hashed
+        """
+        index = QueryIndex(args)
+        for pathname, digest in db.entries():
+            try:
+                stat_result = os.stat(pathname)
+            except OSError:
+                continue
+            if (not stat.S_ISREG(stat_result.st_mode)
+                    or stat_result.st_mtime >= db.mod_time
+                    or stat_result.st_size == 0):
+                continue
+            index.add(digest, IndexEntry(pathname, stat_result.st_size))
+        index.rank()
+        return index
+
+    # QueryIndex.add
+    def add(self, digest, entry):
+        """adds a file with the given digest"""
+        if isinstance(digest, bytes):
+            digest = digest.decode('utf-8', 'surrogateescape')
+        self.by_digest.setdefault(digest, []).append(entry)
+        self.by_path[entry.pathname] = digest
+
+    # QueryIndex.rank
+    def rank(self):
+        """puts the would-be winner first in every bucket"""
+        for _, entries in self.by_digest.items():
+            rank_candidates(entries, self.args.reverse_selection)
+
+    # QueryIndex.query
+    def query(self, q):
+        """Answers a single query, which is a dict holding a "digest"
+        (optionally with a "size"), or a "path".
+        """
+        if not isinstance(q, dict):
+            return {'error': 'a query must be an object'}
+        if 'path' in q:
+            if not isinstance(q['path'], str):
+                return {'error': '"path" must be a string'}
+            digest = self.by_path.get(q['path'])
+        elif 'digest' in q:
+            if not isinstance(q['digest'], str):
+                return {'error': '"digest" must be a string'}
+            digest = q['digest']
+        else:
+            return {'error': 'a query needs a "digest" or a "path"'}
+        entries = self.by_digest.get(digest)
+        if entries is None:
+            return {'found': False}
+        if 'size' in q and q['size'] != entries[0].bytes:
+            return {'found': False}
+        return {'found': True,
+                'digest': digest,
+                'size': entries[0].bytes,
+                'winner': entries[0].pathname,
+                'copies': [e.pathname for e in entries[1:]]}
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """Reads queries, one JSON value per line, and writes one JSON line
+    back for each.  A line holding a list is a batch: the answer is a
+    list of results, in the same order.
+    """
+
+    # QueryHandler.handle
+    def handle(self):
+        index = self.server.index
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'error': 'not JSON'}
+            else:
+                if isinstance(request, list):
+                    response = [index.query(q) for q in request]
+                else:
+                    response = index.query(request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class QueryServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """Serves a QueryIndex on a Unix domain socket, one thread per
+    client connection.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, index):
+        self.index = index
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               QueryHandler)
+
+
+def serve(args, paths, outfile=sys.stdout):
+    """--serve: builds the index from a scan of paths, or from the hash
+    cache if no paths are given, then answers queries until killed.
+    """
+    db = None
+    if args.database is not None:
+        if args.nuke_database:
+            nuke_database(args.database, outfile)
+        db = HashDbObj(args, outfile)
+    if len(paths) > 0:
+        # compared groups get digests which mean nothing outside of
+        # this run, so have every file hashed:
+        args.compare_groups = 0
+        all_files = DirList(paths, db, args)
+        index = QueryIndex.from_hashmap(HashMap(all_files, args, outfile),
+                                        args)
+    elif db is not None:
+        index = QueryIndex.from_db(db, args)
+    else:
+        print('\nFATAL: --serve needs paths to scan or a -d database',
+              file=sys.stderr)
+        sys.exit(-1)
+    if db is not None:
+        db.close()
+
+    if os.path.exists(args.serve):
+        if not stat.S_ISSOCK(os.stat(args.serve).st_mode):
+            print('\nFATAL: ' + args.serve + ' exists and is not a socket',
+                  file=sys.stderr)
+            sys.exit(-1)
+        os.remove(args.serve)
+    server = QueryServer(args.serve, index)
+    print('# serving ' + str(len(index.by_path)) + ' files with ' +
+          str(len(index.by_digest)) + ' distinct digests on ' +
+          args.serve, file=outfile)
+    outfile.flush()
+    # clean up the socket when killed, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.serve)
+    return 0
+
+# vim: set expandtab sw=4 ts=4:
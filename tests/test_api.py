@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the library interface, api.analyze().
+"""
+
+import os
+import unittest
+
+from api import Decision, Group, Options, VerificationError, analyze
+from hashdbobj import compute_hash
+from unit import TempDirTestCase
+
+
+class TestOptions(unittest.TestCase):
+
+    def test_unknown(self):
+        with self.assertRaises(TypeError):
+            Options(no_such_option=True)
+
+    def test_to_args(self):
+        args = Options(min_size='4K', verify=True).to_args()
+        self.assertEqual(args.min_size, 4096)
+        self.assertTrue(args.verify)
+        self.assertIsNone(args.top)
+
+
+class TestAnalyze(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('a/x', b'duplicate file')
+        self.write('a/deeper/x', b'duplicate file')
+        self.write('d1/f', b'a duplicate directory')
+        self.write('dd/d2/f', b'a duplicate directory')
+        self.write('a/empty', b'')
+        self.write('a/unique', b'only one')
+        os.mkdir(self.path('a/empty dir'))
+
+    def results(self, **options):
+        groups = {}
+        decisions = {}
+        for result in analyze([self.dir_name], Options(**options)):
+            if isinstance(result, Group):
+                groups[result.winner] = result
+            else:
+                self.assertIsInstance(result, Decision)
+                decisions[result.pathname] = result
+        return groups, decisions
+
+    def check(self, groups, decisions):
+        self.assertEqual(
+            sorted((g.winner, g.losers) for g in groups.values()),
+            [(self.path('a/x'), [self.path('a/deeper/x')]),
+             (self.path('d1'), [self.path('dd/d2')]),
+             (self.path('d1/f'), [self.path('dd/d2/f')])])
+        self.assertEqual(
+            sorted((d.pathname, d.kind, d.reason, d.winner, d.bytes)
+                   for d in decisions.values()),
+            [(self.path('a/deeper'), 'directory', 'empty', None, 14),
+             (self.path('a/deeper/x'), 'file', 'duplicate',
+              self.path('a/x'), 14),
+             (self.path('a/empty'), 'file', 'empty', None, 0),
+             (self.path('a/empty dir'), 'directory', 'empty', None, 0),
+             (self.path('dd'), 'directory', 'empty', None, 21),
+             (self.path('dd/d2'), 'directory', 'duplicate',
+              self.path('d1'), 21),
+             (self.path('dd/d2/f'), 'file', 'duplicate',
+              self.path('d1/f'), 21)])
+
+    def test_results(self):
+        self.check(*self.results())
+
+    def test_digests(self):
+        groups, decisions = self.results(compare_groups=0)
+        self.check(groups, decisions)
+        self.assertEqual(groups[self.path('a/x')].digest,
+                         compute_hash(self.path('a/x')).decode('utf-8'))
+
+    def test_verify(self):
+        self.check(*self.results(verify=True))
+
+    def test_verify_fails(self):
+        results = analyze([self.dir_name], Options(verify=True))
+        # hashing is done by the first result, an empty file
+        first = next(results)
+        self.assertEqual(first.reason, 'empty')
+        # now the loser changes, keeping its size
+        self.write('a/deeper/x', b'DUPLICATE FILE')
+        with self.assertRaises(VerificationError) as caught:
+            for result in results:
+                if isinstance(result, Decision):
+                    self.assertNotEqual(result.pathname,
+                                        self.path('a/deeper/x'))
+        self.assertEqual(caught.exception.pathname, self.path('a/deeper/x'))
+        self.assertEqual(caught.exception.winner, self.path('a/x'))
+
+# vim: set expandtab sw=4 ts=4:
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for looking into archives (-a/--archives).
+"""
+
+import io
+import os
+import tarfile
+import zipfile
+from unittest import mock
+
+import fileio
+from archive import scan_members
+from dedup import build_parser
+from dirlist import DirList
+from throttle import Throttle
+from unit import TempDirTestCase
+
+
+class TestArchives(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quiet()
+
+    def tar(self, name, members):
+        """writes a tarball holding members, a list of (name, data)
+        which may use a name more than once
+        """
+        pathname = self.path(name)
+        with tarfile.open(pathname, 'w:gz') as tf:
+            for member_name, data in members:
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+        return pathname
+
+    def redundant(self, *options):
+        args = build_parser().parse_args(['-a'] + list(options))
+        all_files = DirList([self.dir_name], None, args)
+        return [f.pathname for f in all_files.redundant_archives]
+
+    def test_redundant(self):
+        self.write('loose/x', b'the latest version')
+        archive = self.tar('backup.tar.gz', [('x', b'the latest version')])
+        self.assertEqual(self.redundant(), [archive])
+
+    def test_duplicate_names(self):
+        # extracting this gives the second x, but the first one has no
+        # loose copy anywhere
+        self.write('loose/x', b'the latest version')
+        self.tar('backup.tar.gz', [('x', b'an older version'),
+                                   ('x', b'the latest version')])
+        self.assertEqual(self.redundant(), [])
+
+    def test_file_and_dir_names(self):
+        self.write('loose/x', b'a file')
+        self.write('loose/y', b'in a directory')
+        self.tar('backup.tar.gz', [('x', b'a file'),
+                                   ('x/y', b'in a directory')])
+        self.assertEqual(self.redundant(), [])
+
+    def test_throttled(self):
+        tarball = self.tar('backup.tar.gz', [('x', b'some data' * 1000)])
+        zip_name = self.path('backup.zip')
+        with zipfile.ZipFile(zip_name, 'w') as zf:
+            zf.writestr('x', b'some data' * 1000)
+        args = build_parser().parse_args(['--max-read-rate', '1G'])
+        for pathname in [tarball, zip_name]:
+            throttle = Throttle(args)
+            with mock.patch.object(throttle, 'read',
+                                   wraps=throttle.read) as read:
+                members = scan_members(pathname, args, throttle)
+            self.assertEqual(len(members), 1)
+            # every byte of the archive is accounted for
+            read_bytes = sum(c.args[0] for c in read.call_args_list)
+            self.assertGreaterEqual(read_bytes, os.path.getsize(pathname))
+
+    def test_gentle(self):
+        tarball = self.tar('backup.tar.gz', [('x', b'some data')])
+        args = build_parser().parse_args(['-g'])
+        with mock.patch.object(fileio, 'advise') as advise:
+            scan_members(tarball, args)
+        self.assertIn(fileio.FADV_DONTNEED,
+                      [c.args[3] for c in advise.call_args_list])
+
+# vim: set expandtab sw=4 ts=4:
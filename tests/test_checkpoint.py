@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for --checkpoint and --resume.
+"""
+
+import os
+import pickle
+from unittest import mock
+
+import checkpoint
+from dedup import build_parser
+from dirlist import DirList
+from hashdbobj import compute_hash
+from unit import TempDirTestCase
+
+
+class Interrupted(Exception):
+    """stands in for a crash, or ^C"""
+
+
+class TestResume(TempDirTestCase):
+    """a scan which dies while hashing picks up where it left off"""
+
+    def setUp(self):
+        super().setUp()
+        self.filename = self.path('checkpoint.pickle')
+        self.paths = [self.path('p1'),
+                      self.path('p2')]
+        self.write('p1/same', b'same contents')
+        self.write('p1/changed', b'before')
+        self.write('p1/kept', b'kept contents')
+        self.write('p2/same', b'same contents')
+        self.write('p2/gone', b'soon deleted')
+        self.quiet()
+
+    def scan(self, *options, interrupt_after=None):
+        """runs a scan, returning it and the pathnames it hashed"""
+        args = build_parser().parse_args(
+            ['--checkpoint', self.filename, '--checkpoint-interval', '0',
+             '--compare-groups', '0'] + list(options))
+        hashed = []
+        hash_file = DirList.hash_file
+
+        def counting_hash_file(all_files, f):
+            if interrupt_after is not None and len(hashed) == interrupt_after:
+                raise Interrupted()
+            hashed.append(f.pathname)
+            hash_file(all_files, f)
+
+        with mock.patch.object(DirList, 'hash_file', counting_hash_file):
+            return DirList(self.paths, None, args), hashed
+
+    def files(self, all_files):
+        found = {}
+        for _, entry in all_files.contents.items():
+            for dir_entry in entry.dirwalk():
+                for _, f in dir_entry.files.items():
+                    found[f.pathname] = f
+        return found
+
+    def test_resume(self):
+        with self.assertRaises(Interrupted):
+            self.scan(interrupt_after=2)
+        with open(self.filename, 'rb') as f:
+            state = pickle.load(f)
+        self.assertEqual(sorted(state['walked'].keys()), self.paths)
+        saved = sorted(state['digests'].keys())
+        self.assertEqual(len(saved), 2)
+
+        # meanwhile: one file is deleted, one changed and one created
+        os.remove(self.path('p2/gone'))
+        changed = self.path('p1/changed')
+        if changed in saved:
+            saved.remove(changed)
+        self.write('p1/changed', b'after, and longer')
+        self.write('p1/created', b'too late')
+
+        all_files, hashed = self.scan('--resume')
+        found = self.files(all_files)
+        # the trees were restored, not walked again
+        self.assertNotIn(self.path('p1/created'), found)
+        self.assertNotIn(self.path('p2/gone'), found)
+        # only the files without a usable saved digest were read
+        self.assertEqual(sorted(hashed), sorted(set(found) - set(saved)))
+        self.assertIn(changed, hashed)
+        for pathname, f in found.items():
+            self.assertEqual(f.hexdigest, compute_hash(pathname))
+
+    def test_resume_walk(self):
+        top = self.paths[0]
+        for name in ['a/x', 'a/deep/y', 'a/deep/er/z', 'b/w', 'c/v',
+                     'd/u']:
+            self.write('p1/' + name, name.encode())
+        subtree_done = checkpoint.Checkpoint.subtree_done
+        done = []
+
+        def interrupted_subtree_done(cp, path, dir_entry):
+            subtree_done(cp, path, dir_entry)
+            done.append(dir_entry.pathname)
+            if len(done) == 4:
+                raise Interrupted()
+
+        with mock.patch.object(checkpoint.Checkpoint, 'subtree_done',
+                               interrupted_subtree_done):
+            with self.assertRaises(Interrupted):
+                self.scan()
+        with open(self.filename, 'rb') as f:
+            state = pickle.load(f)
+        self.assertEqual(state['walked'], {})
+        saved = sorted(state['walked_subtrees'][top].keys())
+        # everything done is kept, but only the outermost of nested
+        # subtrees (the order os.walk() goes in varies)
+        def within(pathname, dir_name):
+            return (pathname == dir_name
+                    or pathname.startswith(dir_name + os.path.sep))
+        for pathname in done:
+            self.assertEqual(len([x for x in saved if within(pathname, x)]),
+                             1)
+        self.assertTrue(all(pathname in done for pathname in saved))
+
+        # created within a walked subtree, and outside of them
+        for pathname in saved:
+            self.write(os.path.join(pathname, 'created'), b'too late')
+        self.write('p1/created', b'in time')
+
+        walk = os.walk
+        walked = []
+
+        def recording_walk(path):
+            for dir_name, dir_list, file_list in walk(path):
+                walked.append(dir_name)
+                yield dir_name, dir_list, file_list
+
+        with mock.patch('os.walk', recording_walk):
+            all_files, _ = self.scan('--resume')
+        for pathname in saved:
+            self.assertFalse(any(within(x, pathname) for x in walked))
+        found = self.files(all_files)
+        self.assertIn(os.path.join(top, 'created'), found)
+        for pathname in saved:
+            self.assertNotIn(os.path.join(pathname, 'created'), found)
+        for name in ['a/x', 'a/deep/y', 'a/deep/er/z', 'b/w', 'c/v', 'd/u']:
+            pathname = os.path.join(top, name)
+            self.assertEqual(found[pathname].hexdigest,
+                             compute_hash(pathname))
+            # restored trees are hung off the right parents
+            parent = found[pathname].parent
+            self.assertEqual(parent.pathname, os.path.dirname(pathname))
+            self.assertIs(parent.parent.subdirs[parent.name], parent)
+
+    def test_different_scan(self):
+        self.scan()
+        with self.assertRaises(SystemExit):
+            self.scan('--resume', '--archives')
+
+    def test_malformed(self):
+        for state in [[], {}, {'version': checkpoint.CHECKPOINT_VERSION},
+                      b'not even pickled']:
+            with open(self.filename, 'wb') as f:
+                if isinstance(state, bytes):
+                    f.write(state)
+                else:
+                    pickle.dump(state, f)
+            with self.assertRaises(SystemExit):
+                self.scan('--resume')
+
+# vim: set expandtab sw=4 ts=4:
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for content-defined chunking (--chunk-index), with the
+    chunk sizes shrunk so that small files have many chunks.
+"""
+
+import os
+import random
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import chunker
+from chunker import ChunkIndex, chunk_file
+from hashdbobj import compute_hash
+from unit import TempDirTestCase
+
+# chunks average about MIN_CHUNK + 2 ** MASK_BITS bytes:
+MASK_BITS = 6
+SMALL = {'MASK': ((1 << MASK_BITS) - 1) << (32 - MASK_BITS),
+         'MIN_CHUNK': 32,
+         'MAX_CHUNK': 256,
+         # not a multiple of anything above, so chunks span blocks
+         'BLOCK_SIZE': 1000}
+
+
+class ChunkerTestCase(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, value in SMALL.items():
+            patcher = mock.patch.object(chunker, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.data = random.Random(42).randbytes(20000)
+
+    def chunks(self, name, data, python=False):
+        pathname = self.write(name, data)
+        if python:
+            with mock.patch.object(chunker, 'numpy', None):
+                return chunk_file(pathname)
+        return chunk_file(pathname)
+
+
+class TestChunkFile(ChunkerTestCase):
+
+    def test_chunks(self):
+        digest, chunks = self.chunks('f', self.data)
+        self.assertEqual(digest, compute_hash(self.path('f')))
+        self.assertEqual(sum(length for length, _ in chunks),
+                         len(self.data))
+        self.assertGreater(len(chunks), 100)
+        for length, _ in chunks[:-1]:
+            self.assertGreaterEqual(length, SMALL['MIN_CHUNK'])
+            self.assertLessEqual(length, SMALL['MAX_CHUNK'])
+
+    @unittest.skipIf(chunker.numpy is None, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+        self.assertEqual(self.chunks('f', self.data),
+                         self.chunks('f', self.data, python=True))
+
+    def test_max_chunk(self):
+        # a constant stream never hits the mask: every cut is forced
+        _, chunks = self.chunks('zeros', bytes(3000))
+        self.assertEqual([length for length, _ in chunks],
+                         [256] * 11 + [184])
+        _, python_chunks = self.chunks('zeros', bytes(3000), python=True)
+        self.assertEqual(chunks, python_chunks)
+
+    def test_inserted_byte(self):
+        _, before = self.chunks('before', self.data)
+        middle = len(self.data) // 2
+        changed = self.data[:middle] + b'!' + self.data[middle:]
+        _, after = self.chunks('after', changed)
+        # only the chunks around the insertion differ
+        digests = set(digest for _, digest in before)
+        different = [length for length, digest in after
+                     if digest not in digests]
+        self.assertLessEqual(len(different), 3)
+        self.assertLessEqual(sum(different), 3 * SMALL['MAX_CHUNK'])
+        # and they are where the byte went
+        offset = 0
+        for length, digest in after:
+            if digest not in digests:
+                self.assertGreater(offset + length,
+                                   middle - SMALL['MAX_CHUNK'])
+                self.assertLess(offset, middle + 2 * SMALL['MAX_CHUNK'])
+            offset = offset + length
+
+
+class TestChunkIndex(ChunkerTestCase):
+
+    def fake_file(self, name, chunks, hexdigest=None):
+        return SimpleNamespace(
+            pathname=name, chunks=[(100, c.encode()) for c in chunks],
+            bytes=100 * len(chunks), hexdigest=hexdigest or name.encode())
+
+    def test_pairs(self):
+        index = ChunkIndex()
+        a = self.fake_file('a', 'ABCD')
+        b = self.fake_file('b', 'ABCE')
+        c = self.fake_file('c', 'AFGH')
+        same = self.fake_file('same', 'ABCD', b'a')
+        for f in [a, b, c, same]:
+            index.add(f)
+        # a and same have identical contents, so aren't a pair; c
+        # shares too little with any of them
+        self.assertEqual(index.pairs(), [(300, a, b), (300, b, same)])
+        self.assertEqual(len(index.pairs(min_ratio=0.2)), 5)
+
+    def test_partial_overlap(self):
+        # a file, and the same file with a few bytes changed
+        changed = bytearray(self.data)
+        changed[5000] = changed[5000] ^ 0xFF
+        changed[15000:15000] = b'inserted'
+        files = []
+        for name, data in [('original', self.data),
+                           ('changed', bytes(changed)),
+                           ('unrelated', random.Random(7).randbytes(20000))]:
+            pathname = self.write(name, data)
+            digest, chunks = chunk_file(pathname)
+            files.append(SimpleNamespace(pathname=pathname, chunks=chunks,
+                                         bytes=len(data), hexdigest=digest))
+        index = ChunkIndex()
+        for f in files:
+            index.add(f)
+        pairs = index.pairs()
+        self.assertEqual(len(pairs), 1)
+        shared_bytes, f, g = pairs[0]
+        self.assertEqual((f.pathname, g.pathname),
+                         (files[0].pathname, files[1].pathname))
+        self.assertGreater(shared_bytes, 0.9 * len(self.data))
+        self.assertLess(shared_bytes, len(self.data))
+
+# vim: set expandtab sw=4 ts=4:
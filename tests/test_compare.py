@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the byte comparison engine (--compare-groups) and
+    --verify.
+"""
+
+import io
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import compare
+import dirlist
+import scheduler
+from compare import partition_identical, verify_files
+from dedup import build_parser
+from dirlist import DirList
+from hashmap import HashMap
+from unit import TempDirTestCase
+
+
+class RecordingThrottle():
+    """counts what goes through the throttle, without ever waiting"""
+
+    def __init__(self):
+        self.ops = 0
+        self.bytes = 0
+
+    def op(self, count=1):
+        self.ops = self.ops + count
+
+    def read(self, nbytes, latency):
+        self.bytes = self.bytes + nbytes
+
+
+class TreeTestCase(TempDirTestCase):
+    """a temporary directory to write files into"""
+
+    def file(self, name, data):
+        pathname = self.write(name, data)
+        return SimpleNamespace(pathname=pathname, bytes=len(data),
+                               args=None)
+
+
+class TestPartition(TreeTestCase):
+
+    def test_groups(self):
+        a = self.file('a', b'0123456789')
+        b = self.file('b', b'0123456789')
+        c = self.file('c', b'012345678X')
+        d = self.file('d', b'X123456789')
+        groups = partition_identical([a, b, c, d])
+        self.assertEqual(sorted(sorted(f.pathname for f in g) for g in groups),
+                         [[a.pathname, b.pathname], [c.pathname],
+                          [d.pathname]])
+
+    def test_stops_reading_once_different(self):
+        a = self.file('a', b'A' * 64)
+        b = self.file('b', b'B' * 64)
+        throttle = RecordingThrottle()
+        with mock.patch.object(compare, 'COMPARE_CHUNK', 4):
+            self.assertEqual(len(partition_identical([a, b], None,
+                                                     throttle)), 2)
+        # a single chunk each, not the whole files
+        self.assertEqual(throttle.bytes, 8)
+
+    def test_verify_files_is_throttled(self):
+        a = self.file('a', b'same')
+        b = self.file('b', b'same')
+        c = self.file('c', b'diff')
+        throttle = RecordingThrottle()
+        self.assertTrue(verify_files(a, b, throttle))
+        self.assertFalse(verify_files(a, c, throttle))
+        self.assertEqual(throttle.ops, 4)
+        self.assertEqual(throttle.bytes, 16)
+
+
+class TestDirList(TreeTestCase):
+    """comparisons and --verify as done during a scan"""
+
+    def scan(self, *options):
+        args = build_parser().parse_args(list(options))
+        return DirList([self.dir_name], None, args)
+
+    def test_compare_groups_in_disk_order(self):
+        # one group of two files per size, each on "disk" in reverse
+        # order of their names
+        offsets = {}
+        for i in range(5):
+            for name in ('a%d' % i, 'b%d' % i):
+                pathname = self.write(name, name.encode('utf-8') * (i + 1))
+                offsets[pathname] = 1000 - i * 10 - (name[0] == 'b')
+        compared = []
+
+        def recording_partition(files, args=None, throttle=None):
+            compared.append([os.path.basename(f.pathname) for f in files])
+            return partition_identical(files, args, throttle)
+
+        with mock.patch.object(scheduler, 'physical_offset', offsets.get), \
+                mock.patch.object(dirlist, 'partition_identical',
+                                  recording_partition):
+            self.scan('-o')
+        self.assertEqual(compared, [['b4', 'a4'], ['b3', 'a3'], ['b2', 'a2'],
+                                    ['b1', 'a1'], ['b0', 'a0']])
+
+    def test_verify_marked(self):
+        self.write('a/x', b'1234')
+        loser = self.write('b/x', b'1234')
+        all_files = self.scan('--verify')
+        HashMap(all_files, all_files.args, io.StringIO()).resolve()
+        all_files.throttle = RecordingThrottle()
+        all_files.verify_marked()
+        self.assertEqual(all_files.throttle.bytes, 8)
+        # the same size, different contents: caught before any output
+        with open(loser, 'r+b') as f:
+            f.write(b'4321')
+        with self.assertRaises(SystemExit), \
+                mock.patch('sys.stderr', io.StringIO()):
+            all_files.verify_marked()
+
+# vim: set expandtab sw=4 ts=4:
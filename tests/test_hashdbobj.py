@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the hash cache, and -c/--clean-database.
+"""
+
+import io
+import os
+import dbm
+import time
+import threading
+from json import dumps
+from types import SimpleNamespace
+
+from dedup import build_parser
+from hashdbobj import HashDbObj, clean_database, database_files, \
+    lock_database, nuke_database
+from unit import TempDirTestCase
+
+
+class TestCleanDatabase(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.name = self.path('cache')
+        self.args = build_parser().parse_args(['-d', self.name])
+        self.quiet()
+
+    def write(self, name, data, age=3600):
+        """writes a file last modified age seconds ago"""
+        pathname = super().write(name, data)
+        mod_time = time.time() - age
+        os.utime(pathname, (mod_time, mod_time))
+        return pathname
+
+    def keys(self):
+        db = dbm.open(self.name, 'r')
+        try:
+            return sorted(k.decode('utf-8') for k in db.keys())
+        finally:
+            db.close()
+
+    def test_stale_entries_go(self):
+        kept = self.write('kept', b'kept')
+        gone = self.write('gone', b'gone')
+        changed = self.write('changed', b'changed')
+        archive = self.write('archive.zip', b'not really a zip')
+        stat_result = os.stat(archive)
+
+        db = HashDbObj(self.args, io.StringIO())
+        for pathname in [kept, gone, changed]:
+            db.store_hash(SimpleNamespace(pathname=pathname), b'0' * 40)
+        current = SimpleNamespace(pathname=archive,
+                                  bytes=stat_result.st_size,
+                                  mod_time=stat_result.st_mtime)
+        db.store_members(current, [('member', 4, b'1' * 40)])
+        db.store_chunks(current, [(4, b'\x02' * 20)])
+        db.db['chunks:' + kept] = dumps({'bytes': 1, 'mod_time': 0,
+                                         'chunks': []})
+        db.close()
+
+        os.remove(gone)
+        # modified after the cache was last written:
+        self.write('changed', b'changed again', age=-3600)
+
+        out = io.StringIO()
+        self.assertEqual(clean_database(self.args, out), 0)
+        self.assertEqual(self.keys(), sorted(['archive:' + archive,
+                                              'chunks:' + archive, kept]))
+        self.assertIn('6 entries', out.getvalue())
+        self.assertIn('3 entries', out.getvalue())
+        self.assertIn('replaced', out.getvalue())
+        # no working files are left behind
+        self.assertEqual(sorted(x for x in os.listdir(self.dir_name)
+                                if x.startswith('.dedup-clean-')), [])
+
+    def clean_in_background(self):
+        """starts a clean, returns once it waits for the scans"""
+        out = io.StringIO()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            clean_database(self.args, out)))
+        thread.start()
+        deadline = time.monotonic() + 10
+        while 'waiting' not in out.getvalue():
+            self.assertTrue(thread.is_alive())
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        return thread, results
+
+    def test_alongside_scan(self):
+        kept = self.write('kept', b'kept')
+        gone = self.write('gone', b'gone')
+        db = HashDbObj(self.args, io.StringIO())
+        db.store_hash(SimpleNamespace(pathname=kept), b'0' * 40)
+        db.store_hash(SimpleNamespace(pathname=gone), b'1' * 40)
+        db.close()
+        os.remove(gone)
+
+        # a scan which only reads the cache doesn't stop a clean
+        db = HashDbObj(self.args, io.StringIO())
+        thread, results = self.clean_in_background()
+        self.assertEqual(db.cached_hash(SimpleNamespace(
+            pathname=kept, mod_time=0)), b'0' * 40)
+        db.close()
+        thread.join()
+        self.assertEqual(results, [0])
+        self.assertEqual(self.keys(), [kept])
+
+    def test_abandoned_if_written(self):
+        kept = self.write('kept', b'kept')
+        gone = self.write('gone', b'gone')
+        db = HashDbObj(self.args, io.StringIO())
+        db.store_hash(SimpleNamespace(pathname=gone), b'1' * 40)
+        db.close()
+        os.remove(gone)
+
+        db = HashDbObj(self.args, io.StringIO())
+        thread, results = self.clean_in_background()
+        db.store_hash(SimpleNamespace(pathname=kept), b'0' * 40)
+        db.close()
+        thread.join()
+        self.assertEqual(results, [-1])
+        # nothing the scan wrote is lost
+        self.assertEqual(self.keys(), sorted([gone, kept]))
+
+    def test_locks(self):
+        kept = self.write('kept', b'kept')
+        db = HashDbObj(self.args, io.StringIO())
+        db.store_hash(SimpleNamespace(pathname=kept), b'0' * 40)
+        try:
+            with self.assertRaises(SystemExit):
+                nuke_database(self.name, io.StringIO())
+        finally:
+            db.close()
+        self.assertEqual(self.keys(), [kept])
+        # and a scan can't start while the cache is being swapped
+        lock_file = lock_database(self.name, exclusive=True)
+        try:
+            with self.assertRaises(BlockingIOError):
+                lock_database(self.name, wait=False).close()
+        finally:
+            lock_file.close()
+        nuke_database(self.name, io.StringIO())
+        self.assertEqual(database_files(self.name), [])
+
+# vim: set expandtab sw=4 ts=4:
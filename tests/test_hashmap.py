@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the HashMap resolver.
+"""
+
+import io
+import os
+import sys
+import subprocess
+
+from dedup import build_parser
+from dirlist import DirList
+from hashmap import HashMap
+from unit import TempDirTestCase
+
+# the tree from which every copy of f used to be deleted: the two f
+# dirs, then AAAA and BBBBB, are each duplicates of each other
+TREE = {'x/AAAA/qqqqqq/f': b'f\n', 'x/BBBBB/p/f': b'f\n',
+        'x/AAAA/g': b'g\n', 'x/BBBBB/g': b'g\n'}
+
+DEDUP = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'dedup.py')
+
+
+class TestResolve(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, data in TREE.items():
+            self.write(name, data)
+
+    def surviving(self, *options):
+        """the contents of the files left once the losers are gone"""
+        args = build_parser().parse_args(list(options))
+        all_files = DirList([self.dir_name], None, args)
+        HashMap(all_files, args, io.StringIO()).resolve()
+        left = []
+        for _, e in all_files.contents.items():
+            for dir_entry in e.dirwalk():
+                if dir_entry.to_delete:
+                    continue
+                for _, f in dir_entry.files.items():
+                    if not f.to_delete:
+                        left.append(TREE[f.pathname[len(self.dir_name) + 1:]])
+        return sorted(left)
+
+    def test_a_copy_of_everything_is_kept(self):
+        self.assertEqual(self.surviving(), [b'f\n', b'g\n'])
+        self.assertEqual(self.surviving('-r'), [b'f\n', b'g\n'])
+
+    def test_same_result_for_any_hash_seed(self):
+        outputs = set()
+        for seed in ['0', '1', '2', '3', '4', '5']:
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            result = subprocess.run([sys.executable, DEDUP, self.dir_name],
+                                    env=env, capture_output=True, text=True,
+                                    check=True)
+            outputs.add('\n'.join(line for line in result.stdout.split('\n')
+                                  if line.startswith('rm ')))
+        self.assertEqual(len(outputs), 1)
+
+# vim: set expandtab sw=4 ts=4:
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for --link-mode: the temporary names links are made
+    under before replacing a file.
+"""
+
+import io
+import os
+from unittest import mock
+
+from dedup import build_parser
+from dirlist import DirList
+from linker import TEMP_PREFIX, LinkExecutor
+from unit import TempDirTestCase
+
+
+class TestLinkExecutor(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.kept = self.write('a/kept', b'duplicate')
+        # several copies in one directory, each needing a temporary name
+        self.copies = [self.write('b/' + name, b'duplicate')
+                       for name in ['x', 'y', 'z']]
+        self.args = build_parser().parse_args(['--link-mode', 'hardlink'])
+        all_files = DirList([self.dir_name], None, self.args)
+        for f in [self.kept] + self.copies:
+            all_files.hash_file(self.find(all_files, f))
+        self.executor = LinkExecutor(self.args, outfile=io.StringIO())
+        self.files = dict((f, self.find(all_files, f))
+                          for f in [self.kept] + self.copies)
+        self.quiet()
+
+    def find(self, all_files, pathname):
+        for _, e in all_files.contents.items():
+            for dir_entry in e.dirwalk():
+                for _, f in dir_entry.files.items():
+                    if f.pathname == pathname:
+                        return f
+        raise KeyError(pathname)
+
+    def leftovers(self, directory):
+        return sorted(x for x in os.listdir(directory)
+                      if x.startswith(TEMP_PREFIX))
+
+    def test_names_taken(self):
+        # names this pid would try first are in use already
+        taken = [self.write('b/' + TEMP_PREFIX + str(os.getpid()) + '-' +
+                            str(n), b'not ours') for n in [1, 3]]
+        for pathname in self.copies:
+            self.assertTrue(self.executor.swap(self.files[pathname],
+                                               self.files[self.kept]))
+        inode = os.stat(self.kept).st_ino
+        for pathname in self.copies:
+            self.assertEqual(os.stat(pathname).st_ino, inode)
+        for pathname in taken:
+            with open(pathname, 'rb') as f:
+                self.assertEqual(f.read(), b'not ours')
+        self.assertEqual(self.leftovers(os.path.dirname(self.copies[0])),
+                         sorted(os.path.basename(x) for x in taken))
+
+    def test_cleanup(self):
+        f = self.files[self.copies[0]]
+        target = self.files[self.kept]
+        with mock.patch('os.replace', side_effect=PermissionError(13, 'no')):
+            self.assertFalse(self.executor.swap(f, target))
+        self.assertEqual(self.executor.failed, 1)
+        with mock.patch('os.replace', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.executor.swap(f, target)
+        self.assertEqual(self.leftovers(os.path.dirname(f.pathname)), [])
+        self.assertNotEqual(os.stat(f.pathname).st_ino,
+                            os.stat(self.kept).st_ino)
+
+# vim: set expandtab sw=4 ts=4:
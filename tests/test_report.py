@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the report: ReportMap ordering, streaming, and --top.
+"""
+
+import io
+import os
+import re
+import unittest
+import zipfile
+from types import SimpleNamespace
+
+from dedup import analyze, build_parser
+from report import ReportMap, generate_map_commands, generate_reports, \
+    parse_size
+from unit import TempDirTestCase
+
+
+# three winners, saving 30, 200 and 1000 bytes
+LOSERS = {}
+for winner_name, sizes in [('/w/small', [10, 20]), ('/w/big', [1000]),
+                           ('/w/mid', [150, 50])]:
+    LOSERS[winner_name] = [
+        SimpleNamespace(pathname=winner_name.replace('/w/', '/l/') + '/' +
+                        str(len(sizes) - index), bytes=size,
+                        hexdigest=winner_name.encode())
+        for index, size in enumerate(sizes)]
+
+
+def fill(report):
+    """adds every loser, in no particular order"""
+    for winner_name in sorted(LOSERS):
+        for loser in LOSERS[winner_name]:
+            report.add(winner_name, loser)
+
+
+class TestReportMap(unittest.TestCase):
+
+    def setUp(self):
+        self.lookups = []
+
+    def find_losers(self, winner_name, digests):
+        self.lookups.append(winner_name)
+        self.assertEqual(digests, set([winner_name.encode()]))
+        return LOSERS[winner_name]
+
+    def test_totals(self):
+        report = ReportMap('files', self.find_losers)
+        fill(report)
+        self.assertEqual(report.total_marked_bytes, 1230)
+        self.assertEqual(report.marked_count, 5)
+        self.assertEqual(self.lookups, [])
+
+    def test_sections_in_order(self):
+        report = ReportMap('files', self.find_losers)
+        fill(report)
+        sections = report.sections()
+        winner_name, marked_bytes, count, losers = next(sections)
+        self.assertEqual((winner_name, marked_bytes, count),
+                         ('/w/big', 1000, 1))
+        # losers are only looked up as their section comes up
+        self.assertEqual(self.lookups, ['/w/big'])
+        winner_name, marked_bytes, count, losers = next(sections)
+        self.assertEqual((winner_name, marked_bytes, count),
+                         ('/w/mid', 200, 2))
+        self.assertEqual([x.pathname for x in losers],
+                         ['/l/mid/1', '/l/mid/2'])
+        self.assertEqual(self.lookups, ['/w/big', '/w/mid'])
+        # what was handed out is no longer held
+        self.assertEqual(sorted(report.marked_bytes.keys()), ['/w/small'])
+        self.assertEqual(sorted(report.digests.keys()), ['/w/small'])
+        self.assertEqual([x[0] for x in sections], ['/w/small'])
+        self.assertEqual(len(report.digests), 0)
+
+    def test_top(self):
+        report = ReportMap('files', self.find_losers)
+        fill(report)
+        self.assertEqual([x[:3] for x in report.sections(2)],
+                         [('/w/big', 1000, 1), ('/w/mid', 200, 2)])
+        self.assertEqual(self.lookups, [])
+
+    def test_top_summary(self):
+        report = ReportMap('files', self.find_losers)
+        fill(report)
+        out = io.StringIO()
+        generate_map_commands(report, [], out, top=2)
+        text = out.getvalue()
+        self.assertIn('3 to keep and 5 to remove', text)
+        self.assertIn("'/w/big'", text)
+        self.assertIn("'/w/mid'", text)
+        self.assertNotIn("'/w/small'", text)
+        self.assertIn('2 to remove', text)
+        self.assertNotIn('rm ', text)
+
+    def test_script(self):
+        report = ReportMap('files', self.find_losers)
+        fill(report)
+        out = io.StringIO()
+        generate_map_commands(report, [], out)
+        self.assertEqual([line for line in out.getvalue().split('\n')
+                          if line.startswith('rm ')],
+                         ["rm -rf '/l/big/1'", "rm -rf '/l/mid/1'",
+                          "rm -rf '/l/mid/2'", "rm -rf '/l/small/1'",
+                          "rm -rf '/l/small/2'"])
+
+
+class TestGenerateReports(TempDirTestCase):
+
+    def test_losers_found(self):
+        self.write('a/x', b'duplicate file')
+        self.write('a/deeper/x', b'duplicate file')
+        self.write('d1/f', b'a duplicate directory')
+        self.write('dd/d2/f', b'a duplicate directory')
+        self.write('loose/member', b'archived elsewhere')
+        os.makedirs(self.path('old'))
+        for name in ['backup.zip', 'old/backup.zip']:
+            with zipfile.ZipFile(os.path.join(self.dir_name, name),
+                                 'w') as zf:
+                zf.writestr('member', b'archived elsewhere')
+        os.makedirs(self.path('empty'))
+        args = build_parser().parse_args(['-a'])
+        out = io.StringIO()
+        generate_reports(analyze(args, [self.dir_name], out), out, 0)
+        text = out.getvalue()
+        removed = [line[len("rm -rf '" + self.dir_name) + 1:-1]
+                   for line in text.split('\n') if line.startswith('rm ')]
+        # each entry is removed once, and nothing within one removed
+        self.assertEqual(sorted(removed),
+                         ['a/deeper', 'backup.zip', 'dd', 'empty', 'old'])
+        self.assertEqual(sum(int(n) for n in re.findall(
+            r'(\d+) to remove', text)), len(removed))
+
+
+class TestParseSize(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('4K'), 4096)
+        self.assertEqual(parse_size('1.5GiB'), 3 * pow(1024, 3) // 2)
+        self.assertEqual(parse_size('10'), 10)
+
+# vim: set expandtab sw=4 ts=4:
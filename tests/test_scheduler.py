@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the HashScheduler (-o/--schedule-io).
+"""
+
+import os
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import scheduler
+from api import Options
+from dedup import build_parser
+from scheduler import DeviceBudget, HashScheduler
+from hashdbobj import compute_hash
+from unit import TempDirTestCase
+
+
+def make_args(**kwargs):
+    """the options the scheduler looks at"""
+    args = SimpleNamespace(device_workers=8, gentle_io=False,
+                           device_readahead=False, verbosity=0)
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def fake_file(name, device, inode, size=1):
+    """just enough of a FileObj to be scheduled"""
+    return SimpleNamespace(pathname=name, device=device, inode=inode,
+                           bytes=size, hexdigest=None)
+
+
+class TestScheduleOrder(unittest.TestCase):
+    """files are read in on-disk order, one queue per device"""
+
+    def run_scheduler(self, files, offsets):
+        order = []
+        lock = threading.Lock()
+
+        def hash_file(f):
+            with lock:
+                order.append(f.pathname)
+            f.hexdigest = b'x'
+
+        hs = HashScheduler(make_args(), hash_file=hash_file)
+        with mock.patch.object(scheduler, 'physical_offset',
+                               lambda pathname: offsets.get(pathname)):
+            hs.run(files)
+        return hs, order
+
+    def test_physical_order(self):
+        files = [fake_file('c', 1, 1), fake_file('a', 1, 2),
+                 fake_file('b', 1, 3)]
+        _, order = self.run_scheduler(files, {'a': 100, 'b': 200, 'c': 300})
+        self.assertEqual(order, ['a', 'b', 'c'])
+
+    def test_inode_order_without_offsets(self):
+        # files without a known offset follow, in inode order
+        files = [fake_file('z', 1, 9), fake_file('y', 1, 5),
+                 fake_file('x', 1, 7), fake_file('w', 1, 1)]
+        _, order = self.run_scheduler(files, {'w': 50})
+        self.assertEqual(order, ['w', 'y', 'x', 'z'])
+
+    def test_one_queue_per_device(self):
+        files = [fake_file('b2', 2, 2), fake_file('a2', 1, 2),
+                 fake_file('b1', 2, 1), fake_file('a1', 1, 1)]
+        hs, order = self.run_scheduler(files, {})
+        self.assertEqual([x for x in order if x[0] == 'a'], ['a1', 'a2'])
+        self.assertEqual([x for x in order if x[0] == 'b'], ['b1', 'b2'])
+        self.assertEqual(dict(hs.scheduled), {1: 2, 2: 2})
+        self.assertEqual(sorted(hs.budgets.keys()), [1, 2])
+
+    def test_deadline(self):
+        # nothing is read once the deadline has passed
+        files = [fake_file('a', 1, 1), fake_file('b', 1, 2)]
+        hs = HashScheduler(make_args())
+        hs.run(files, deadline=0)
+        self.assertEqual([f.hexdigest for f in files], [None, None])
+
+
+class TestDeviceBudget(unittest.TestCase):
+    """the AIMD controller, fed synthetic throughput samples"""
+
+    def feed(self, budget, rate_of_level, windows, latency=0.001):
+        """runs windows measurement windows, with the throughput each
+        number of readers gets from rate_of_level(); returns the levels
+        """
+        levels = []
+        now = 1000.0
+        for _ in range(windows):
+            budget.start_window(now)
+            budget.window_bytes = rate_of_level(budget.level) * \
+                scheduler.BUDGET_WINDOW
+            budget.window_files = budget.level
+            budget.window_busy = budget.window_bytes * latency
+            now = now + scheduler.BUDGET_WINDOW
+            budget.adjust(now)
+            levels.append(budget.level)
+        return levels
+
+    def test_default_ceiling(self):
+        args = build_parser().parse_args([])
+        self.assertEqual(args.device_workers, 8)
+        self.assertEqual(Options().device_workers, 8)
+        budget = DeviceBudget(1, args.device_workers)
+        self.feed(budget, lambda level: 1e6 * level, 50)
+        self.assertEqual((budget.level, budget.peak), (8, 8))
+
+    def test_single_reader_opt_out(self):
+        budget = DeviceBudget(1, 1)
+        self.feed(budget, lambda level: 1e6 * level, 50)
+        self.assertEqual((budget.level, budget.peak, budget.increases),
+                         (1, 1, 0))
+
+    def test_scales_while_it_pays(self):
+        # an SSD: every reader adds throughput
+        budget = DeviceBudget(1, 8)
+        levels = self.feed(budget, lambda level: 1e6 * level, 10)
+        self.assertEqual(levels[:7], [2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(budget.level, 8)
+        self.assertEqual(budget.decreases, 0)
+
+    def test_no_gain_no_readers(self):
+        # a spinning disk: more readers get nothing more done
+        budget = DeviceBudget(1, 8)
+        levels = self.feed(budget, lambda level: 1e6, 100)
+        self.assertEqual(budget.peak, 2)
+        self.assertEqual(max(levels), 2)
+        # the trial reader is withdrawn straight away, and only tried
+        # again after BUDGET_PROBE_WINDOWS
+        self.assertGreaterEqual(levels.count(1), 95)
+        self.assertLessEqual(budget.increases,
+                             100 // scheduler.BUDGET_PROBE_WINDOWS + 1)
+        self.assertEqual(budget.level, 1)
+
+    def test_plateau(self):
+        # gains up to three readers, nothing beyond
+        budget = DeviceBudget(1, 8)
+        levels = self.feed(budget, lambda level: 1e6 * min(level, 3), 15)
+        self.assertEqual(levels[:4], [2, 3, 4, 3])
+        self.assertEqual(levels[-1], 3)
+        self.assertEqual(budget.peak, 4)
+
+    def test_congestion_halves(self):
+        # thrashing: past four readers, throughput collapses
+        budget = DeviceBudget(1, 8)
+        levels = self.feed(
+            budget, lambda level: 1e6 * level if level <= 4 else 1e5, 6)
+        self.assertEqual(levels[:5], [2, 3, 4, 5, 2])
+        self.assertGreaterEqual(budget.decreases, 1)
+
+
+class TestScheduledHashing(TempDirTestCase):
+    """the digests are the same as hashing in any other order"""
+
+    def test_digests(self):
+        files = []
+        for i in range(20):
+            pathname = self.write('f%02d' % i, os.urandom(1000 + i))
+            st = os.stat(pathname)
+            files.append(fake_file(pathname, st.st_dev, st.st_ino,
+                                   st.st_size))
+        done = []
+        HashScheduler(make_args(device_workers=4), done=done.append).run(files)
+        self.assertEqual(len(done), len(files))
+        for f in files:
+            self.assertEqual(f.hexdigest, compute_hash(f.pathname))
+
+# vim: set expandtab sw=4 ts=4:
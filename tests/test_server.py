@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the --serve query index and socket server.
+"""
+
+import io
+import os
+import json
+import socket
+import threading
+
+from dedup import build_parser
+from dirlist import DirList
+from hashmap import HashMap
+from hashdbobj import compute_hash
+from server import IndexEntry, QueryIndex, QueryServer
+from unit import TempDirTestCase
+
+
+class TestServer(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dup = self.write('a/dup', b'duplicated')
+        self.copy = self.write('b/c/dup', b'duplicated')
+        self.unique = self.write('a/unique', b'only one of these')
+        args = build_parser().parse_args(['--compare-groups', '0'])
+        self.all_files = DirList([self.dir_name], None, args)
+        self.index = QueryIndex.from_hashmap(
+            HashMap(self.all_files, args, io.StringIO()), args)
+
+        self.socket_path = self.path('socket')
+        self.server = QueryServer(self.socket_path, self.index)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.client.connect(self.socket_path)
+        self.responses = self.client.makefile('rb')
+
+    def tearDown(self):
+        self.responses.close()
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def ask(self, line):
+        """sends one line, returns the decoded answer"""
+        self.client.sendall(line.encode('utf-8') + b'\n')
+        return json.loads(self.responses.readline())
+
+    def test_duplicate(self):
+        digest = compute_hash(self.copy).decode('utf-8')
+        expected = {'found': True, 'digest': digest, 'size': 10,
+                    'winner': self.dup, 'copies': [self.copy]}
+        self.assertEqual(self.ask(json.dumps({'digest': digest})), expected)
+        self.assertEqual(self.ask(json.dumps({'digest': digest,
+                                              'size': 10})), expected)
+        self.assertEqual(self.ask(json.dumps({'path': self.copy})),
+                         expected)
+
+    def test_miss(self):
+        digest = compute_hash(self.dup).decode('utf-8')
+        self.assertEqual(self.ask(json.dumps({'digest': '0' * 40})),
+                         {'found': False})
+        self.assertEqual(self.ask(json.dumps({'digest': digest,
+                                              'size': 11})),
+                         {'found': False})
+        self.assertEqual(self.ask(json.dumps({'path': '/not/here'})),
+                         {'found': False})
+
+    def test_malformed(self):
+        digest = compute_hash(self.unique).decode('utf-8')
+        self.assertEqual(self.ask('[{"digest": '), {'error': 'not JSON'})
+        answers = self.ask(json.dumps([5, {'name': 'x'},
+                                       {'digest': digest}]))
+        self.assertEqual(len(answers), 3)
+        self.assertIn('error', answers[0])
+        self.assertIn('error', answers[1])
+        self.assertEqual(answers[2]['winner'], self.unique)
+        # and the connection is still usable afterwards
+        self.assertEqual(self.ask(json.dumps({'path': self.unique})),
+                         answers[2])
+
+    def test_not_strings(self):
+        for query in [{'path': ['x']}, {'digest': {}}, {'digest': 5}]:
+            self.assertIn('error', self.ask(json.dumps(query)))
+        # the connection survives them
+        self.assertEqual(self.ask(json.dumps({'path': self.unique}))['winner'],
+                         self.unique)
+
+    def test_index_entry_depth(self):
+        # entries loaded from the hash cache rank like walked files
+        for _, e in self.all_files.contents.items():
+            for dir_entry in e.dirwalk():
+                for _, f in dir_entry.files.items():
+                    self.assertEqual(IndexEntry(f.pathname, f.bytes).depth,
+                                     f.depth)
+
+# vim: set expandtab sw=4 ts=4:
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for the Throttle and TokenBucket (--max-read-rate,
+    --max-iops and --adaptive-throttle).
+"""
+
+import os
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import throttle
+from throttle import Throttle, TokenBucket
+from hashdbobj import compute_hash
+from unit import TempDirTestCase
+
+
+class FakeTime():
+    """a clock which only moves when told to, or when slept on"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now = self.now + seconds
+
+
+def make_args(**kwargs):
+    args = SimpleNamespace(max_read_rate=None, max_iops=None,
+                           adaptive_throttle=False, gentle_io=False,
+                           device_readahead=False)
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        patcher = mock.patch.object(throttle, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_starts_full(self):
+        bucket = TokenBucket(100)
+        self.assertEqual(bucket.take(100), 0.0)
+
+    def test_debt(self):
+        bucket = TokenBucket(100)
+        bucket.take(100)
+        # 50 tokens short, at 100 per second
+        self.assertAlmostEqual(bucket.take(50), 0.5)
+
+    def test_refill(self):
+        bucket = TokenBucket(100)
+        bucket.take(100)
+        self.clock.now = self.clock.now + 0.25
+        self.assertEqual(bucket.take(25), 0.0)
+        self.assertAlmostEqual(bucket.take(25), 0.25)
+
+    def test_capacity(self):
+        # an idle bucket holds at most one second's worth
+        bucket = TokenBucket(100)
+        self.clock.now = self.clock.now + 60
+        self.assertEqual(bucket.take(100), 0.0)
+        self.assertAlmostEqual(bucket.take(100), 1.0)
+
+    def test_slowdown(self):
+        bucket = TokenBucket(100)
+        bucket.take(100)
+        self.assertAlmostEqual(bucket.take(50, slowdown=2.0), 1.0)
+
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        patcher = mock.patch.object(throttle, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_from_args(self):
+        self.assertIsNone(Throttle.from_args(make_args()))
+        self.assertIsNotNone(Throttle.from_args(make_args(max_iops=10)))
+
+    def test_read_rate(self):
+        t = Throttle(make_args(max_read_rate=1000))
+        for _ in range(5):
+            t.read(1000, 0.0)
+        # the first second's worth is free, the rest is paid for
+        self.assertAlmostEqual(t.throttled_time, 4.0)
+
+    def test_iops(self):
+        t = Throttle(make_args(max_iops=10))
+        t.op(30)
+        self.assertAlmostEqual(t.throttled_time, 2.0)
+
+    def test_adaptive_backoff(self):
+        t = Throttle(make_args(adaptive_throttle=True))
+        for _ in range(10):
+            t.read(4096, 0.005)
+        self.assertEqual(t.slowdown, 1.0)
+        # reads get ten times slower: back off
+        for _ in range(20):
+            t.read(4096, 0.05)
+        self.assertGreater(t.slowdown, 1.0)
+        self.assertGreater(t.backoffs, 0)
+        self.assertGreater(t.throttled_time, 0.0)
+        # and relax again once they recover
+        slowdown = t.slowdown
+        for _ in range(20):
+            t.read(4096, 0.005)
+        self.assertLess(t.slowdown, slowdown)
+
+
+class TestThrottledHashing(TempDirTestCase):
+    """hashing with a throttle really takes as long as the rate says"""
+
+    def test_compute_hash(self):
+        pathname = self.write('f', os.urandom(12 * 65536))
+        unthrottled = compute_hash(pathname)
+        t = Throttle(make_args(max_read_rate=8 * 65536))
+        started = time.monotonic()
+        self.assertEqual(compute_hash(pathname, make_args(), t), unthrottled)
+        # eight buffers a second, the first eight are free
+        self.assertGreater(t.throttled_time, 0.4)
+        self.assertGreaterEqual(time.monotonic() - started,
+                                t.throttled_time * 0.9)
+
+# vim: set expandtab sw=4 ts=4:
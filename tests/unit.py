@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""
+    What the unit tests share: a TestCase with a temporary directory of
+    its own to write files into.  Not itself a test module.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+
+class TempDirTestCase(unittest.TestCase):
+    """each test gets a fresh directory, self.dir_name, removed once the
+    test (and any tearDown) is done
+    """
+
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp(prefix='dedup-unit-')
+        self.addCleanup(shutil.rmtree, self.dir_name)
+
+    def path(self, name):
+        return os.path.join(self.dir_name, name)
+
+    def write(self, name, data):
+        """writes data to name under self.dir_name, making any
+        directories on the way, and returns its pathname
+        """
+        pathname = self.path(name)
+        os.makedirs(os.path.dirname(pathname), exist_ok=True)
+        with open(pathname, 'wb') as f:
+            f.write(data)
+        return pathname
+
+    def quiet(self):
+        """swallows whatever goes to stderr for the rest of the test"""
+        stderr = mock.patch('sys.stderr', io.StringIO())
+        stderr.start()
+        self.addCleanup(stderr.stop)
+
+# vim: set expandtab sw=4 ts=4:
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+    This module describes the Throttle object, which limits how hard we
+    hit the filesystem, and its TokenBucket helper.
+"""
+
+import time
+import threading
+
+# CONSTANTS:
+#
+# Python doesn't really have constants so I'll use ALLCAPS to indicate
+# that I do not expect these values to change. ¯\_(ツ)_/¯
+
+# weight of the newest sample in the read latency moving average:
+LATENCY_ALPHA = 0.1
+
+# back off once reads are this many times slower than the best we've seen:
+LATENCY_BACKOFF_RATIO = 2.0
+
+# latencies below this (in seconds) are page cache hits, not a signal:
+LATENCY_FLOOR = 0.001
+
+# the most we will ever slow down by:
+MAX_SLOWDOWN = 64.0
+
+
+class TokenBucket():
+    """A thread-safe token bucket.  Tokens refill at "rate" per second up
+    to one second's worth.  Taking more tokens than are available puts
+    the bucket in debt, and the caller is told how long to wait for the
+    debt to be repaid.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # TokenBucket.take
+    def take(self, amount, slowdown=1.0):
+        """Takes amount tokens, and returns the number of seconds the
+        caller should wait before proceeding.
+        """
+        with self.lock:
+            now = time.monotonic()
+            rate = self.rate / slowdown
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens = self.tokens - amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / rate
+
+
+class Throttle():
+    """Limits the bytes read and the files opened/stat'd per second, as
+    requested by --max-read-rate and --max-iops.  With
+    --adaptive-throttle it also slows down further whenever read
+    latency rises above the best observed, which usually means somebody
+    else needs the disks.  Keeps track of the time spent waiting.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.bytes = None
+        self.ops = None
+        if args.max_read_rate:
+            self.bytes = TokenBucket(args.max_read_rate)
+        if args.max_iops:
+            self.ops = TokenBucket(args.max_iops)
+        self.adaptive = args.adaptive_throttle
+        self.slowdown = 1.0
+        self.latency = None
+        self.best_latency = None
+        self.backoffs = 0
+        self.throttled_time = 0.0
+        self.lock = threading.Lock()
+
+    # Throttle.from_args
+    @staticmethod
+    def from_args(args):
+        """Returns a Throttle if any throttling was requested, else None"""
+        if args.max_read_rate or args.max_iops or args.adaptive_throttle:
+            return Throttle(args)
+        return None
+
+    # Throttle.wait
+    def wait(self, seconds):
+        """sleeps, and accounts for the time spent throttled"""
+        if seconds <= 0:
+            return
+        time.sleep(seconds)
+        with self.lock:
+            self.throttled_time = self.throttled_time + seconds
+
+    # Throttle.op
+    def op(self, count=1):
+        """called before opening or stat'ing count files"""
+        if self.ops is not None:
+            self.wait(self.ops.take(count, self.slowdown))
+
+    # Throttle.read
+    def read(self, nbytes, latency):
+        """called after reading nbytes, which took latency seconds"""
+        if self.adaptive:
+            self.observe(latency)
+        if self.bytes is not None:
+            self.wait(self.bytes.take(nbytes, self.slowdown))
+        elif self.slowdown > 1.0:
+            # no rate to scale down, so back off by idling in proportion
+            # to how long the disk took to answer us:
+            self.wait(latency * (self.slowdown - 1.0))
+
+    # Throttle.observe
+    def observe(self, latency):
+        """Updates the read latency moving average and adjusts the
+        slowdown: doubled while latency is elevated, and slowly relaxed
+        once it has recovered.
+        """
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = (LATENCY_ALPHA * latency +
+                                (1.0 - LATENCY_ALPHA) * self.latency)
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+            threshold = max(LATENCY_FLOOR,
+                            self.best_latency * LATENCY_BACKOFF_RATIO)
+            if self.latency > threshold:
+                if self.slowdown < MAX_SLOWDOWN:
+                    self.slowdown = min(MAX_SLOWDOWN, self.slowdown * 2.0)
+                    self.backoffs = self.backoffs + 1
+                    # judge the new rate on fresh samples:
+                    self.latency = self.best_latency
+            else:
+                self.slowdown = max(1.0, self.slowdown * 0.95)
+
+# vim: set expandtab sw=4 ts=4: